@@ -4,10 +4,14 @@ from utils.model import Model
 from utils.trainer import Trainer
 from utils.validate import plotImagesAndCaptions
 from utils.validate_metrics import validateCaptions
+from utils.generateVocabulary import loadVocabulary, adaptiveSoftmaxCutoffs
 
 from cocoSource_xcnnfused import imageCaptionModel # here you plug in your modelfile depending on what you have developed: simple rnn, 2 layer, or attention, if you have 3 modelfiles a.py b.py c.py then you do: from a import ... or you have one file with n different imgcapmodels
 
 def main(config, modelParam):
+    if config['outputLayerType'] == 'adaptive' and config['adaptiveSoftmaxCutoffs'] is None:
+        config['adaptiveSoftmaxCutoffs'] = adaptiveSoftmaxCutoffs(loadVocabulary(modelParam['data_dir']), config['vocabulary_size'])
+
     # create an instance of the model you want
     model = Model(config, modelParam, imageCaptionModel)
 
@@ -73,6 +77,19 @@ if __name__ == '__main__':
         #'featurepathstub': 'detectron2m_features' ,
         #'featurepathstub': 'detectron2cocov3_tenmfeatures' ,
         'featurepathstub': 'detectron2_lim10maxfeatures' ,
+        'mixedPrecision': False,  # autocast training, bfloat16 on the cpu, float16 with a GradScaler on the gpu
+        'lossChunkSize': None,  # tokens per block in the fused output layer + cross entropy, None: all tokens at once
+        'checkpointSegment': None,  # time steps per activation checkpoint segment in training, None: no checkpointing
+        'decodeTable': False,  # greedy decoding with a precomputed embedding to first layer gate table, see TokenGateTable
+        'endToken': 0,  # greedy decoding stops a caption at this token ('eeee', see generateVocabulary), None: 40 tokens
+        'beamSize': None,  # beams per image for beam search, validateCaptions then also reports greedy decoding
+        'lengthPenalty': 1.0,  # beam search ranks by log-probability sum / length**lengthPenalty
+        'metricProcesses': 4,  # validateCaptions scores BLEU, METEOR, CIDEr and ROUGE in parallel processes, 1: serial
+        'ciderIndexFile': 'ciderD_val.npz',  # CIDEr-D reference statistics saved in modelsDir, None: in memory only
+        'outputLayerType': 'linear',  # 'linear' | 'adaptive': adaptive softmax with clusters from the word frequencies
+        'adaptiveSoftmaxCutoffs': None,  # None: computed from vocabulary.pickle, see adaptiveSoftmaxCutoffs
+        'rnnBackend': 'custom',  # 'custom' | 'native': teacher forced training on the fused torch.nn rnn kernels
+        'compileMode': None,  # None | 'default' | 'reduce-overhead' | 'max-autotune': torch.compile of the rnn step
         'cellType':  'RNN' #'GRU'  # RNN or GRU or LSTM??
     }
 
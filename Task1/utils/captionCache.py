@@ -0,0 +1,128 @@
+import collections
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+import torch
+
+
+#######################################################################################################################
+class CaptionCache():
+    """
+    LRU cache of generated captions keyed by a hash of the cnn features bytes, so repeated images (re-uploads,
+    thumbnails of the same asset) skip the inputlayer and the decoding.
+
+    The key also covers the model checkpoint id and the decode settings: a cache (or a cache file) of another checkpoint
+    or other settings never returns its captions. The memory is bounded by max_entries, one entry is the hash and the
+    caption (at most 40 tokens and the text), roughly 1 kB.
+    """
+    def __init__(self, checkpoint_id, settings, max_entries=100000, path=None):
+        """
+        Args:
+            checkpoint_id: Identifies the model weights, e.g. checkpointId(model.net)
+            settings     : dict of the decode settings which change the captions
+            max_entries  : Max number of cached captions, the least recently used one is evicted first
+            path         : If not None, the cache is loaded from this file (if it exists) and save() writes it there
+        """
+        self.max_entries = max_entries
+        self.path        = path
+        identity         = json.dumps([checkpoint_id, settings], sort_keys=True, default=str)
+        self.prefix      = hashlib.blake2b(identity.encode(), digest_size=16).digest()
+
+        self.entries   = collections.OrderedDict()
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+        if path is not None and os.path.isfile(path):
+            self.load()
+        return
+
+    def key(self, cnn_features):
+        """
+        Args:
+            cnn_features: Features of one image, tensor or array
+
+        Returns:
+            key: bytes, the hash of the features (dtype, shape and values), the checkpoint id and the settings
+        """
+        if isinstance(cnn_features, torch.Tensor):
+            cnn_features = cnn_features.detach().cpu().numpy()
+        features = np.ascontiguousarray(cnn_features)
+        digest   = hashlib.blake2b(self.prefix, digest_size=16)
+        digest.update(f'{features.dtype.str}{features.shape}'.encode())
+        digest.update(features.data)
+        return digest.digest()
+
+    def get(self, key):
+        """
+        Returns:
+            caption: The cached caption or None (counted as a hit or a miss)
+        """
+        caption = self.entries.get(key)
+        if caption is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return caption
+
+    def put(self, key, caption):
+        self.entries[key] = caption
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return
+
+    def stats(self):
+        """
+        Returns:
+            stats: number of entries, hits, misses, hit rate and evictions
+        """
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / max(self.hits + self.misses, 1),
+            'evictions': self.evictions,
+        }
+
+    def save(self):
+        """
+        Write the entries to self.path (replaced atomically), least recently used first.
+        """
+        if self.path is None:
+            return
+        directory = os.path.dirname(self.path)
+        if directory != '' and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.path + '.tmp', 'wb') as file:
+            pickle.dump({'prefix': self.prefix, 'entries': list(self.entries.items())}, file)
+        os.replace(self.path + '.tmp', self.path)
+        return
+
+    def load(self):
+        with open(self.path, 'rb') as file:
+            stored = pickle.load(file)
+        if stored['prefix'] != self.prefix:
+            print(f'Caption cache {self.path} is of another checkpoint or other decode settings, starting empty')
+            return
+        for key, caption in stored['entries'][-self.max_entries:]:
+            self.entries[key] = caption
+        return
+
+
+def checkpointId(net):
+    """
+    Hash of the model weights (and of the int8 quantization, see quantize_dynamic_int8) as the checkpoint id of
+    CaptionCache, the same for every restore of the same checkpoint.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for name, tensor in net.state_dict().items():
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().data)
+    quantized = [name for name, module in net.named_modules() if getattr(module, 'quantized_weights', None) is not None]
+    digest.update(json.dumps(quantized).encode())
+    return digest.hexdigest()
@@ -206,6 +206,32 @@ def loadVocabulary(data_dir):
         vocabularyDict = pickle.load(input_file)
     return vocabularyDict
 
+def adaptiveSoftmaxCutoffs(vocabularyDict, vocabulary_size, coverage=(0.9, 0.98)):
+    """
+    Cluster cutoffs for nn.AdaptiveLogSoftmaxWithLoss from the word frequencies in "wordCounter".
+
+    The tokens after 'eeee', 'ssss' and 'UNK' are sorted by decreasing word count, so the head holds the most frequent
+    words covering coverage[0] of all words in the captions, the next cluster covers up to coverage[1], etc.
+
+    Args:
+        vocabularyDict : Dictionary from loadVocabulary
+        vocabulary_size: number of different words used by the model
+        coverage       : cumulative word frequency at the end of each cluster but the last
+
+    Returns:
+        cutoffs: increasing list of token indices, all in the range (0, vocabulary_size)
+    """
+    # "wordCounter" has the three special tokens in front, the word counts are in vocabulary (not token) order
+    wordCounter = np.sort(np.asarray(vocabularyDict['wordCounter'])[3:])[::-1][:vocabulary_size-3]
+    countsCumRel = np.cumsum(wordCounter) / np.sum(wordCounter)
+
+    cutoffs = []
+    for fraction in coverage:
+        cutoff = 3 + int(np.searchsorted(countsCumRel, fraction)) + 1
+        if cutoff < vocabulary_size and (len(cutoffs) == 0 or cutoff > cutoffs[-1]):
+            cutoffs.append(cutoff)
+    return cutoffs
+
 if __name__ == "__main__":
     a = 1
     # Create dataClass
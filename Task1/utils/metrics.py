@@ -7,7 +7,13 @@ from pycocoevalcap.rouge import rouge
 from pycocoevalcap.spice import spice
 #from pycocoevalcap.bert import bert
 from pycocoevalcap.tokenizer.ptbtokenizer import PTBTokenizer
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import hashlib
+import math
 import os
+import pickle
+import tempfile
 
 class Score(object):
     """A subclass of this class is an adapter of pycocoevalcap."""
@@ -77,12 +83,339 @@ class BLEU(Score):
         return result
 
 
+class TokenBLEU(object):
+    """
+    BLEU-1..n of bleu.Bleu (corpus level, "closest" reference length) computed with NumPy directly on the token ids,
+    without joining them into strings and counting the n-grams in python. The scores are identical to BLEU with
+    tokenize=False on the space joined token ids.
+
+    The n-grams are keyed by int64 numbers (the tokens as digits in base number of distinct tokens, collision free),
+    the clipped matches are counted with np.unique and bincount over all images at once.
+    """
+    def __init__(self, n=4):
+        self._n = n
+
+    def calculate(self, id_to_prediction, id_to_references):
+        """
+        Args:
+            id_to_prediction: {id: array of the predicted tokens}
+            id_to_references: {id: [array of the tokens of a reference caption, ..]}
+
+        Returns:
+            results: {'bleu_1': .., .., 'bleu_n': ..}
+        """
+        ids        = list(id_to_prediction.keys())
+        hypotheses = [np.asarray(id_to_prediction[id_], dtype=np.int64) for id_ in ids]
+        references = [np.asarray(ref, dtype=np.int64) for id_ in ids for ref in id_to_references[id_]]
+        refImage   = np.repeat(np.arange(len(ids)), [len(id_to_references[id_]) for id_ in ids])
+        hypLengths = np.array([len(tokens) for tokens in hypotheses], dtype=np.int64)
+        refLengths = np.array([len(tokens) for tokens in references], dtype=np.int64)
+
+        # dense token ids, the base of the n-gram keys
+        allTokens = np.concatenate(hypotheses + references + [np.zeros(0, dtype=np.int64)])
+        distinct, dense = np.unique(allTokens, return_inverse=True)
+        base = max(len(distinct), 1)
+        if float(base)**self._n >= 2**63:
+            raise ValueError(f'TokenBLEU: {len(distinct)} distinct tokens do not fit {self._n}-gram keys in int64')
+        hypTokens = dense[:hypLengths.sum()]
+        refTokens = dense[hypLengths.sum():]
+
+        # the closest reference length of every image (the shorter one on a tie)
+        distance = np.abs(refLengths - hypLengths[refImage])
+        closest  = np.full(len(ids), np.iinfo(np.int64).max)
+        np.minimum.at(closest, refImage, distance*(refLengths.max(initial=0) + 1) + refLengths)
+        reflen   = int((closest % (refLengths.max(initial=0) + 1)).sum())
+        testlen  = int(hypLengths.sum())
+
+        guess   = [int(np.maximum(hypLengths - k + 1, 0).sum()) for k in range(1, self._n + 1)]
+        correct = []
+        for k in range(1, self._n + 1):
+            hypImage, hypKeys = ngramKeys(hypTokens, hypLengths, np.arange(len(ids)), k, base)
+            refIndex, refKeys = ngramKeys(refTokens, refLengths, np.arange(len(references)), k, base)
+            if len(hypKeys) == 0 or len(refKeys) == 0:
+                correct.append(0)
+                continue
+            # the (image, n-gram) pairs of the hypotheses and the references share one dense index
+            distinctKeys, key = np.unique(np.concatenate([hypKeys, refKeys]), return_inverse=True)
+            images = np.concatenate([hypImage, refImage[refIndex]])
+            _, pair = np.unique(images*len(distinctKeys) + key.reshape(-1), return_inverse=True)
+            pair = pair.reshape(-1)
+            numbOfPairs = pair.max() + 1
+            hypCounts   = np.bincount(pair[:len(hypKeys)], minlength=numbOfPairs)
+            # the count of an n-gram in each reference, the max over the references of the image clips the matches
+            refPairs, refCounts = np.unique(refIndex*numbOfPairs + pair[len(hypKeys):], return_counts=True)
+            maxCounts = np.zeros(numbOfPairs, dtype=np.int64)
+            np.maximum.at(maxCounts, refPairs % numbOfPairs, refCounts)
+            correct.append(int(np.minimum(hypCounts, maxCounts).sum()))
+
+        # the arithmetic of BleuScorer.compute_score
+        small = 1e-9
+        tiny  = 1e-15
+        bleus = []
+        bleu  = 1.
+        for k in range(self._n):
+            bleu *= float(correct[k] + tiny) / (guess[k] + small)
+            bleus.append(bleu ** (1./(k+1)))
+        ratio = (testlen + tiny) / (reflen + small)
+        if ratio < 1:
+            for k in range(self._n):
+                bleus[k] *= math.exp(1 - 1/ratio)
+        return {f'bleu_{k}': score for k, score in enumerate(bleus, start=1)}
+
+
+def ngramKeys(tokens, lengths, owners, k, base):
+    """
+    The k-grams of concatenated token sequences as int64 keys.
+
+    Args:
+        tokens : The tokens of all sequences concatenated, values in [0, base)
+        lengths: The length of every sequence
+        owners : The owner (e.g. image index) of every sequence
+        k      : The n-gram order
+
+    Returns:
+        owner: The owner of every k-gram
+        keys : sum(tokens[i+j] * base**j for j in range(k)) for every k-gram starting at i
+    """
+    starts = np.cumsum(lengths) - lengths
+    counts = np.maximum(lengths - k + 1, 0)
+    owner  = np.repeat(owners, counts)
+    # the start of every k-gram: the sequence start plus the position in the sequence
+    first  = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+    keys   = np.zeros(len(first), dtype=np.int64)
+    for j in reversed(range(k)):
+        keys = keys*base + tokens[first + j]
+    return owner, keys
+
+
 class CIDEr(Score):
     def __init__(self):
         implementation = cider.Cider()
         super(CIDEr, self).__init__('cider', implementation)
 
 
+class TokenCIDErD(object):
+    """
+    CIDEr-D of cider.Cider (1..n-grams, tf-idf clipped by the reference, gaussian length penalty sigma) on token ids.
+
+    The document frequencies and the tf-idf vectors of the references only depend on the reference set, they are
+    computed once by build() (and kept on disk with save/load, see ciderIndex), calculate() then only processes the
+    hypotheses. The vectors are sparse (row, n-gram column, weight) arrays, the clipped dot products of every hypothesis
+    with its references are one sorted join of (image, n-gram) keys. The scores match cider.Cider on the space joined
+    token ids up to float rounding (the PTB tokenizer does not change token id strings).
+    """
+    def __init__(self, ids, keys, keyOffsets, refImage, refColumns, refRows, refWeights, refNorms, refLengths, refLen,
+                 documentFrequency, base, fingerprint, n=4, sigma=6.0):
+        self.ids               = list(ids)
+        self.index             = {id_: ind for ind, id_ in enumerate(self.ids)}
+        self.keys              = keys  # sorted n-gram keys of every order, order k at keys[keyOffsets[k-1]:keyOffsets[k]]
+        self.keyOffsets        = keyOffsets
+        self.refImage          = refImage  # image of every reference
+        self.refColumns        = refColumns  # the sparse tf-idf vectors of the references
+        self.refRows           = refRows
+        self.refWeights        = refWeights
+        self.refNorms          = refNorms  # shape[numbOfRefs, n]
+        self.refLengths        = refLengths  # the "length" of cider_scorer (the number of bigrams)
+        self.refLen            = refLen  # log of the number of images
+        self.documentFrequency = documentFrequency
+        self.base              = base
+        self.fingerprint       = fingerprint
+        self._n                = n
+        self._sigma            = sigma
+
+    @classmethod
+    def build(cls, id_to_references, n=4, sigma=6.0):
+        """
+        Args:
+            id_to_references: {id: [array of the tokens of a reference caption, ..]}
+        """
+        ids        = sorted(id_to_references.keys())
+        references = [np.asarray(ref, dtype=np.int64) for id_ in ids for ref in id_to_references[id_]]
+        refImage   = np.repeat(np.arange(len(ids)), [len(id_to_references[id_]) for id_ in ids])
+        refLengths = np.array([len(tokens) for tokens in references], dtype=np.int64)
+        tokens     = np.concatenate(references + [np.zeros(0, dtype=np.int64)])
+        base       = int(tokens.max(initial=0)) + 1
+        if float(base)**n >= 2**63:
+            raise ValueError(f'TokenCIDErD: token {base - 1} does not fit {n}-gram keys in int64')
+
+        keys, keyOffsets, rows, columns, counts = [], [0], [], [], []
+        for k in range(1, n + 1):
+            refIndex, refKeys = ngramKeys(tokens, refLengths, np.arange(len(references)), k, base)
+            orderKeys, column = np.unique(refKeys, return_inverse=True)
+            # the term frequency of every n-gram of every reference
+            pairs, count = np.unique(refIndex*len(orderKeys) + column.reshape(-1), return_counts=True)
+            rows.append(pairs // len(orderKeys))
+            columns.append(pairs % len(orderKeys) + keyOffsets[-1])
+            counts.append(count)
+            keys.append(orderKeys)
+            keyOffsets.append(keyOffsets[-1] + len(orderKeys))
+        rows, columns, counts = np.concatenate(rows), np.concatenate(columns), np.concatenate(counts)
+
+        # the number of images with the n-gram in any of their references
+        imageColumns = np.unique(refImage[rows]*keyOffsets[-1] + columns)
+        documentFrequency = np.bincount(imageColumns % keyOffsets[-1], minlength=keyOffsets[-1]).astype(np.float64)
+
+        refLen  = np.log(float(len(ids)))
+        weights = counts*(refLen - np.log(np.maximum(1.0, documentFrequency[columns])))
+        order   = np.searchsorted(np.asarray(keyOffsets), columns, side='right') - 1
+        refNorms = np.sqrt(np.bincount(rows*n + order, weights**2, minlength=len(references)*n)).reshape(-1, n)
+        return cls(ids, np.concatenate(keys), np.asarray(keyOffsets), refImage, columns, rows, weights, refNorms,
+                   np.maximum(refLengths - 1, 0), refLen, documentFrequency, base,
+                   referenceFingerprint(id_to_references), n, sigma)
+
+    def calculate(self, id_to_prediction):
+        """
+        Args:
+            id_to_prediction: {id: array of the predicted tokens}, the same ids as the references of the index
+
+        Returns:
+            results: {'cider': the mean CIDEr-D}
+        """
+        if len(id_to_prediction) != len(self.ids) or any(id_ not in self.index for id_ in id_to_prediction):
+            raise ValueError('TokenCIDErD: the hypotheses are not of the images of the reference index')
+        n = self._n
+        hypotheses = [None]*len(self.ids)
+        for id_, tokens in id_to_prediction.items():
+            hypotheses[self.index[id_]] = np.asarray(tokens, dtype=np.int64)
+        hypLengths = np.array([len(tokens) for tokens in hypotheses], dtype=np.int64)
+        tokens     = np.concatenate(hypotheses + [np.zeros(0, dtype=np.int64)])
+        # the hypothesis n-grams are counted with keys of the dense hypothesis tokens, the ones without a token which
+        # is not in any reference are looked up in the index (else their document frequency is 0)
+        distinct, dense = np.unique(tokens, return_inverse=True)
+        if float(max(len(distinct), 1))**n >= 2**63:
+            raise ValueError(f'TokenCIDErD: {len(distinct)} distinct tokens do not fit {n}-gram keys in int64')
+        dense        = dense.reshape(-1)
+        unknownToken = (tokens < 0) | (tokens >= self.base)
+        indexTokens  = np.where(unknownToken, 0, tokens)
+        images       = np.arange(len(self.ids))
+        numbOfCols   = self.keyOffsets[-1]
+
+        hypImages, hypColumns, hypWeights = [], [], []
+        norms = np.zeros(len(self.ids)*n)
+        for k in range(1, n + 1):
+            image, keys    = ngramKeys(dense, hypLengths, images, k, max(len(distinct), 1))
+            _, indexKeys   = ngramKeys(indexTokens, hypLengths, images, k, self.base)
+            _, unknown     = ngramKeys(unknownToken.astype(np.int64), hypLengths, images, k, 2)
+            orderKeys      = self.keys[self.keyOffsets[k-1]:self.keyOffsets[k]]
+            position       = np.minimum(np.searchsorted(orderKeys, indexKeys), max(len(orderKeys) - 1, 0))
+            known          = (unknown == 0) & (len(orderKeys) > 0)
+            known[known]   = orderKeys[position[known]] == indexKeys[known]
+
+            # the term frequencies of the n-grams of every hypothesis
+            distinctKeys, key = np.unique(keys, return_inverse=True)
+            _, first, counts  = np.unique(image*len(distinctKeys) + key.reshape(-1), return_index=True,
+                                          return_counts=True)
+            pairImage = image[first]
+            pairKnown = known[first]
+            columns   = np.where(pairKnown, self.keyOffsets[k-1] + position[first], 0)
+            df        = np.where(pairKnown, self.documentFrequency[columns], 0.0)
+            weights   = counts*(self.refLen - np.log(np.maximum(1.0, df)))
+            norms    += np.bincount(pairImage*n + k - 1, weights**2, minlength=len(self.ids)*n)
+
+            hypImages.append(pairImage[pairKnown])
+            hypColumns.append(columns[pairKnown])
+            hypWeights.append(weights[pairKnown])
+        hypNorms   = np.sqrt(norms).reshape(-1, n)
+        hypPairs   = np.concatenate(hypImages)*numbOfCols + np.concatenate(hypColumns)
+        hypWeights = np.concatenate(hypWeights)
+        sort       = np.argsort(hypPairs)
+        hypPairs, hypWeights = hypPairs[sort], hypWeights[sort]
+
+        # the clipped dot product of every reference with the hypothesis of its image, per n-gram order
+        refPairs = self.refImage[self.refRows]*numbOfCols + self.refColumns
+        position = np.minimum(np.searchsorted(hypPairs, refPairs), max(len(hypPairs) - 1, 0))
+        matched  = np.zeros(len(refPairs), dtype=bool) if len(hypPairs) == 0 else hypPairs[position] == refPairs
+        refOrder = np.searchsorted(self.keyOffsets, self.refColumns, side='right') - 1
+        products = np.minimum(hypWeights[position[matched]], self.refWeights[matched])*self.refWeights[matched]
+        numbOfRefs = len(self.refImage)
+        val = np.bincount(self.refRows[matched]*n + refOrder[matched], products, minlength=numbOfRefs*n)
+        val = val.reshape(-1, n)
+
+        norm = hypNorms[self.refImage]*self.refNorms
+        val  = np.where(norm != 0, val / np.where(norm != 0, norm, 1.0), val)
+        delta = (np.maximum(hypLengths - 1, 0)[self.refImage] - self.refLengths).astype(np.float64)
+        val  *= np.e**(-(delta[:, None]**2)/(2*self._sigma**2))
+
+        score  = np.zeros((len(self.ids), n))
+        np.add.at(score, self.refImage, val)
+        scores = score.mean(axis=1) / np.bincount(self.refImage, minlength=len(self.ids)) * 10.0
+        return {'cider': float(np.mean(scores))}
+
+    def save(self, path):
+        """
+        Write the index to path (.npz, replaced atomically). The temporary file has a unique name, so concurrent runs
+        do not write into the same file.
+        """
+        directory = os.path.dirname(path)
+        if directory != '' and not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        file = tempfile.NamedTemporaryFile(dir=directory if directory != '' else '.', suffix='.tmp', delete=False)
+        try:
+            with file:
+                np.savez(file, ids=np.array(self.ids), keys=self.keys, keyOffsets=self.keyOffsets,
+                         refImage=self.refImage, refColumns=self.refColumns, refRows=self.refRows,
+                         refWeights=self.refWeights, refNorms=self.refNorms, refLengths=self.refLengths,
+                         refLen=self.refLen, documentFrequency=self.documentFrequency, base=self.base,
+                         fingerprint=self.fingerprint, n=self._n, sigma=self._sigma)
+            os.replace(file.name, path)
+        except BaseException:
+            os.remove(file.name)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as stored:
+            return cls(stored['ids'].tolist(), stored['keys'], stored['keyOffsets'], stored['refImage'],
+                       stored['refColumns'], stored['refRows'], stored['refWeights'], stored['refNorms'],
+                       stored['refLengths'], float(stored['refLen']), stored['documentFrequency'], int(stored['base']),
+                       str(stored['fingerprint']), int(stored['n']), float(stored['sigma']))
+
+
+def referenceFingerprint(id_to_references):
+    """
+    Hash of the ids and the reference tokens, identifies the references of a TokenCIDErD index.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for id_ in sorted(id_to_references.keys()):
+        digest.update(repr(id_).encode())
+        for ref in id_to_references[id_]:
+            digest.update(np.asarray(ref, dtype=np.int64).tobytes())
+            digest.update(b'|')
+    return digest.hexdigest()
+
+
+# fingerprint -> TokenCIDErD, the indices of this process (see ciderIndex)
+ciderIndexCache = {}
+
+
+def ciderIndex(id_to_references, path=None):
+    """
+    The TokenCIDErD index of the references: from memory, else from path if it was saved for the same references,
+    else built (and saved to path, if that fails, e.g. in a read-only directory, it is kept in memory only).
+
+    Args:
+        id_to_references: {id: [array of the tokens of a reference caption, ..]}
+        path            : .npz file of the index, None: in memory only
+    """
+    fingerprint = referenceFingerprint(id_to_references)
+    if fingerprint in ciderIndexCache:
+        return ciderIndexCache[fingerprint]
+    index = None
+    if path is not None and os.path.isfile(path):
+        index = TokenCIDErD.load(path)
+        if index.fingerprint != fingerprint:
+            index = None
+    if index is None:
+        index = TokenCIDErD.build(id_to_references)
+        if path is not None:
+            try:
+                index.save(path)
+            except OSError as error:
+                print(f'CIDEr-D index not saved to {path}: {error}')
+    ciderIndexCache[fingerprint] = index
+    return index
+
+
 class METEOR(Score):
     def __init__(self):
         implementation = meteor.Meteor()
@@ -107,6 +440,126 @@ class ROUGE(Score):
         implementation = rouge.Rouge()
         super(ROUGE, self).__init__('rouge', implementation)
 
+
+class TokenROUGE(Score):
+    """
+    ROUGE-L of rouge.Rouge on token ids: the LCS of all hypothesis-reference pairs is computed at once (see lcsLengths)
+    instead of one python dynamic program per pair. The scores are identical to ROUGE on the space joined token ids
+    (the PTB tokenizer does not change token id strings).
+    """
+    def __init__(self, bit_parallel=True):
+        implementation = TokenRouge(bit_parallel)
+        super(TokenROUGE, self).__init__('rouge', implementation)
+
+    def calculate(self, id_to_prediction, id_to_references, tokenize=False):
+        """
+        Args:
+            id_to_prediction: {id: array of the predicted tokens}
+            id_to_references: {id: [array of the tokens of a reference caption, ..]}
+            tokenize        : Not used, token ids are not tokenized
+        """
+        avg_score, scores = self._implementation.compute_score(id_to_references, id_to_prediction)
+        return {self._score_name: float(avg_score)}
+
+
+class TokenRouge():
+    """
+    The rouge.Rouge implementation for TokenROUGE.
+    """
+    def __init__(self, bit_parallel=True):
+        self.beta         = 1.2
+        self.bit_parallel = bit_parallel
+
+    def compute_score(self, gts, res):
+        """
+        Args:
+            gts: {id: [array of the tokens of a reference caption, ..]}
+            res: {id: array of the predicted tokens}
+
+        Returns:
+            average_score: The mean ROUGE-L over the images
+            scores       : The ROUGE-L of every image, in the order of gts
+        """
+        ids        = list(gts.keys())
+        hypotheses = [np.asarray(res[id_], dtype=np.int64) for id_ in ids]
+        references = [np.asarray(ref, dtype=np.int64) for id_ in ids for ref in gts[id_]]
+        refImage   = np.repeat(np.arange(len(ids)), [len(gts[id_]) for id_ in ids])
+        # rouge.Rouge splits an empty caption into [''], one token which only matches an empty caption
+        empty      = np.array([-1], dtype=np.int64)
+        hypotheses = [tokens if len(tokens) > 0 else empty for tokens in hypotheses]
+        references = [tokens if len(tokens) > 0 else empty for tokens in references]
+
+        hyps, hypLengths = padTokens(hypotheses)
+        refs, refLengths = padTokens(references)
+        lcs = lcsLengths(refs, refLengths, hyps[refImage], hypLengths[refImage], self.bit_parallel)
+
+        precMax = np.zeros(len(ids))
+        recMax  = np.zeros(len(ids))
+        np.maximum.at(precMax, refImage, lcs / hypLengths[refImage].astype(np.float64))
+        np.maximum.at(recMax, refImage, lcs / refLengths.astype(np.float64))
+        nonzero = (precMax != 0) & (recMax != 0)
+        scores  = np.zeros(len(ids))
+        scores[nonzero] = (((1 + self.beta**2)*precMax[nonzero]*recMax[nonzero])
+                           / (recMax[nonzero] + self.beta**2*precMax[nonzero]))
+        return np.mean(scores), scores
+
+
+def padTokens(sequences):
+    """
+    Returns:
+        tokens : The sequences as rows of a padded array, shape[numbOfSequences, max length]
+        lengths: The length of every sequence
+    """
+    lengths = np.array([len(tokens) for tokens in sequences], dtype=np.int64)
+    tokens  = np.zeros((len(sequences), lengths.max(initial=0)), dtype=np.int64)
+    tokens[np.arange(tokens.shape[1]) < lengths[:, None]] = np.concatenate(list(sequences) + [np.zeros(0, np.int64)])
+    return tokens, lengths
+
+
+def lcsLengths(a, aLengths, b, bLengths, bit_parallel=True):
+    """
+    Length of the longest common subsequence of a[p, :aLengths[p]] and b[p, :bLengths[p]] for every row p.
+
+    The dynamic program runs over the positions of a for all rows at once: the row of the table is the running max
+    (np.maximum.accumulate) of the previous row and the matches. With bit_parallel (and b at most 64 tokens) the table
+    row is instead a uint64 bit vector over the positions of b (Hyyro's bit-parallel LCS), one step is a few integer
+    operations on all rows.
+
+    Args:
+        a, b              : Padded token arrays, shape[numbOfPairs, length]
+        aLengths, bLengths: The lengths of the rows
+
+    Returns:
+        lcs: shape[numbOfPairs]
+    """
+    numbOfPairs = a.shape[0]
+    if numbOfPairs == 0:
+        return np.zeros(0, dtype=np.int64)
+    # the padding never matches
+    a = np.where(np.arange(a.shape[1]) < aLengths[:, None], a, np.iinfo(np.int64).min)
+    b = np.where(np.arange(b.shape[1]) < bLengths[:, None], b, np.iinfo(np.int64).max)
+
+    if bit_parallel and b.shape[1] <= 64:
+        bits = np.left_shift(np.uint64(1), np.arange(b.shape[1], dtype=np.uint64))
+        V    = np.full(numbOfPairs, np.iinfo(np.uint64).max, dtype=np.uint64)
+        for i in range(a.shape[1]):
+            matches = np.bitwise_or.reduce(np.where(b == a[:, i:i+1], bits, np.uint64(0)), axis=1)
+            U = V & matches
+            V = (V + U) | (V - U)
+        # the zero bits of V among the positions of b
+        lowBits = np.where(bLengths >= 64, np.iinfo(np.uint64).max,
+                           np.left_shift(np.uint64(1), np.minimum(bLengths, 63).astype(np.uint64)) - np.uint64(1))
+        zeros = ~V & lowBits
+        if hasattr(np, 'bitwise_count'):
+            return np.bitwise_count(zeros).astype(np.int64)
+        return np.unpackbits(zeros.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1).astype(np.int64)
+
+    table = np.zeros((numbOfPairs, b.shape[1] + 1), dtype=np.int64)
+    for i in range(a.shape[1]):
+        diagonal = np.where(b == a[:, i:i+1], table[:, :-1] + 1, 0)
+        table[:, 1:] = np.maximum.accumulate(np.maximum(table[:, 1:], diagonal), axis=1)
+    return table[:, -1]
+
 '''
 class BERT(Score):
     def __init__(self):
@@ -114,3 +567,67 @@ class BERT(Score):
         super(BERT,self).__init__('bert', implementation)
 '''
 
+
+# the adapters scored by calculateMetrics with their tokenize argument, in the order the results are merged
+METRICS = [(BLEU, False), (METEOR, False), (CIDEr, True), (ROUGE, True)]
+
+
+def scoreMetric(metric, tokenize, payload):
+    """
+    One metric of calculateMetrics, runs in a worker process.
+
+    Args:
+        metric  : Score subclass
+        tokenize: Passed to calculate
+        payload : The pickled (id_to_prediction, id_to_references)
+    """
+    id_to_prediction, id_to_references = pickle.loads(payload)
+    return metric().calculate(id_to_prediction, id_to_references, tokenize)
+
+
+def calculateMetrics(id_to_prediction, id_to_references, processes=4, id_to_prediction_tokens=None,
+                     id_to_references_tokens=None, cider_index=None):
+    """
+    All METRICS of the same captions. They do not share any work, with processes > 1 they run concurrently in a
+    process pool (BLEU, CIDEr and ROUGE are pure python, METEOR and the PTB tokenizer wait for java subprocesses), the
+    wall time is about that of the slowest metric. The captions are pickled once, every process gets the same bytes.
+
+    Args:
+        id_to_prediction       : {id: [{'caption': ..}]}
+        id_to_references       : {id: [{'caption': ..}, ..]}
+        processes              : Max number of worker processes, 1: one metric after the other in this process
+        id_to_prediction_tokens: If not None, the captions as token arrays ({id: array}, {id: [array, ..]}),
+        id_to_references_tokens  BLEU and ROUGE are then computed by TokenBLEU and TokenROUGE in this process
+                                 (captions of token id strings)
+        cider_index            : If not None (and the tokens are given), the TokenCIDErD index of the references
+                                 (see ciderIndex), CIDEr is then computed by it in this process
+
+    Returns:
+        results: The merged results of the adapters ('bleu_1'.. 'bleu_4', 'meteor', 'cider', 'rouge')
+    """
+    metrics = METRICS
+    if id_to_prediction_tokens is not None:
+        tokenScored = [BLEU, ROUGE] if cider_index is None else [BLEU, ROUGE, CIDEr]
+        metrics = [(metric, tokenize) for metric, tokenize in METRICS if metric not in tokenScored]
+
+    def tokenMetrics():
+        if id_to_prediction_tokens is not None:
+            results.update(TokenBLEU().calculate(id_to_prediction_tokens, id_to_references_tokens))
+            results.update(TokenROUGE().calculate(id_to_prediction_tokens, id_to_references_tokens))
+            if cider_index is not None:
+                results.update(cider_index.calculate(id_to_prediction_tokens))
+
+    results = {}
+    if processes <= 1 or len(metrics) == 0:
+        tokenMetrics()
+        for metric, tokenize in metrics:
+            results.update(metric().calculate(id_to_prediction, id_to_references, tokenize))
+        return results
+
+    payload = pickle.dumps((id_to_prediction, id_to_references), protocol=pickle.HIGHEST_PROTOCOL)
+    with ProcessPoolExecutor(min(processes, len(metrics))) as pool:
+        futures = [pool.submit(scoreMetric, metric, tokenize, payload) for metric, tokenize in metrics]
+        tokenMetrics()  # meanwhile in this process
+        for future in futures:
+            results.update(future.result())
+    return results
@@ -0,0 +1,157 @@
+import os
+import numpy as np
+import torch
+from torch import nn
+
+from cocoSource_xcnnfused import output_logits
+
+
+#######################################################################################################################
+class EncoderGraph(nn.Module):
+    """
+    The image feature part of imageCaptionModel (self.inputlayer), exported as "encoder.onnx".
+    """
+    def __init__(self, net):
+        super(EncoderGraph, self).__init__()
+        self.inputlayer = net.inputlayer
+        return
+
+    def forward(self, cnn_features):
+        return self.inputlayer(cnn_features)
+
+
+class DecoderStepGraph(nn.Module):
+    """
+    One greedy decoding step of imageCaptionModel (Embedding, the rnn cells and outputlayer), exported as
+    "decoder_step.onnx". The recurrent state is an explicit input and output, the time loop runs in the caller.
+    """
+    def __init__(self, net):
+        super(DecoderStepGraph, self).__init__()
+        self.Embedding         = net.Embedding
+        self.rnn               = net.rnn
+        self.outputlayer       = net.outputlayer
+        self.hidden_state_size = net.hidden_state_sizes
+        return
+
+    def forward(self, tokens, imgfeat, state):
+        updatedstate = self.rnn.step(self.Embedding(tokens), imgfeat, state)
+        out = updatedstate[-1, :, :self.hidden_state_size]
+        # not output_tokens, the data dependent cluster selection of the adaptive softmax would be traced as constant
+        return torch.argmax(output_logits(self.outputlayer, out), dim=1), updatedstate
+
+
+def exportOnnx(model, export_dir, opset_version=17):
+    """
+    Export model.net as an encoder graph and a single decoding step graph, the batch size is dynamic in both.
+
+    Args:
+        model        : instance of utils.model.Model (trained weights restored)
+        export_dir   : directory for "encoder.onnx" and "decoder_step.onnx"
+        opset_version: ONNX opset
+
+    Returns:
+        encoder_path, decoder_path
+    """
+    if not os.path.isdir(export_dir):
+        os.makedirs(export_dir)
+    encoder_path = os.path.join(export_dir, 'encoder.onnx')
+    decoder_path = os.path.join(export_dir, 'decoder_step.onnx')
+
+    net = model.net
+    net.eval()
+    batch_size   = 2
+    weight       = net.Embedding.weight
+    cnn_features = torch.zeros(batch_size, net.number_of_cnn_features, device=weight.device, dtype=weight.dtype)
+    tokens       = torch.ones(batch_size, dtype=torch.long, device=weight.device)
+
+    # the wrappers share the submodules of net, in train mode the export would switch them back to train mode
+    encoder = EncoderGraph(net).eval()
+    decoder = DecoderStepGraph(net).eval()
+
+    with torch.no_grad():
+        imgfeat = encoder(cnn_features)
+        state   = net.get_initial_hidden_state(cnn_features)
+
+        torch.onnx.export(encoder, (cnn_features,), encoder_path, input_names=['cnn_features'],
+                          output_names=['imgfeat'], opset_version=opset_version, dynamo=False,
+                          dynamic_axes={'cnn_features': {0: 'batch'}, 'imgfeat': {0: 'batch'}})
+
+        torch.onnx.export(decoder, (tokens, imgfeat, state), decoder_path,
+                          input_names=['tokens', 'imgfeat', 'state'], output_names=['next_tokens', 'next_state'],
+                          opset_version=opset_version, dynamo=False,
+                          dynamic_axes={'tokens': {0: 'batch'}, 'imgfeat': {0: 'batch'}, 'state': {1: 'batch'},
+                                        'next_tokens': {0: 'batch'}, 'next_state': {1: 'batch'}})
+
+    print(f'"{encoder_path}" and "{decoder_path}" saved')
+    return encoder_path, decoder_path
+
+
+#######################################################################################################################
+class OnnxCaptionGenerator():
+    """
+    Greedy decoding with onnxruntime on the graphs from exportOnnx, numpy in and out. Same decoding as
+    imageCaptionModel.generate: the first token of xTokens is fed in, then 40 predicted tokens.
+    """
+    def __init__(self, export_dir, num_threads=None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+            options.inter_op_num_threads = 1
+        providers = ['CPUExecutionProvider']
+        self.encoder = onnxruntime.InferenceSession(os.path.join(export_dir, 'encoder.onnx'), options,
+                                                    providers=providers)
+        self.decoder = onnxruntime.InferenceSession(os.path.join(export_dir, 'decoder_step.onnx'), options,
+                                                    providers=providers)
+
+        # shape[num_rnn_layers, 'batch', state size]
+        state_shape = self.decoder.get_inputs()[2].shape
+        self.num_rnn_layers = state_shape[0]
+        self.state_size     = state_shape[2]
+        self.seqLen         = 40  # Max sequence length to be generated
+        return
+
+    def generate(self, cnn_features, xTokens, current_hidden_state=None):
+        """
+        Args:
+            cnn_features        : float32 array, shape[batch_size, number_of_cnn_features]
+            xTokens             : int array, shape[batch_size, truncated_backprop_length], only the first token is used
+            current_hidden_state: If not None, the state returned by the previous call
+
+        Returns:
+            tokens              : The predicted tokens, shape[batch_size, 40]
+            current_hidden_state: shape[num_rnn_layers, batch_size, state size]
+        """
+        imgfeat = self.encoder.run(None, {'cnn_features': cnn_features.astype(np.float32)})[0]
+
+        if current_hidden_state is None:
+            current_hidden_state = np.zeros((self.num_rnn_layers, cnn_features.shape[0], self.state_size),
+                                            dtype=np.float32)
+
+        tokens = xTokens[:, 0].astype(np.int64)
+        tokens_series = []
+        for kk in range(self.seqLen):
+            tokens, current_hidden_state = self.decoder.run(None, {'tokens': tokens, 'imgfeat': imgfeat,
+                                                                   'state': current_hidden_state})
+            tokens_series.append(tokens)
+        return np.stack(tokens_series, axis=1), current_hidden_state
+
+
+class OnnxModel():
+    """
+    Stand-in for utils.model.Model in validateCaptions, so the captions (and scores) can be compared to the
+    PyTorch model token for token.
+    """
+    def __init__(self, export_dir, num_threads=None):
+        self.device    = 'cpu'
+        self.generator = OnnxCaptionGenerator(export_dir, num_threads)
+        self.net       = self
+        return
+
+    def generate(self, cnn_features, xTokens, current_hidden_state=None):
+        if current_hidden_state is not None:
+            current_hidden_state = current_hidden_state.numpy()
+        tokens, current_hidden_state = self.generator.generate(cnn_features.numpy(), xTokens.numpy(),
+                                                               current_hidden_state)
+        return torch.from_numpy(tokens), torch.from_numpy(current_hidden_state)
@@ -1,129 +1,146 @@
 from utils.generateVocabulary import loadVocabulary
+import numpy as np
 import torch
+import time
 import matplotlib.pyplot as plt
 import matplotlib.image as mpimg
 
 #from utils.metrics import BLEU, CIDEr, BERT, SPICE, ROUGE, METEOR
-from utils.metrics import BLEU, METEOR , CIDEr,  ROUGE
+from utils.metrics import calculateMetrics, ciderIndex
+
+# data_dir -> (end token, token id strings), the vocabulary is unpickled once (see vocabularyTokens)
+vocabularyCache = {}
+# image path -> the reference captions as token id strings, built once per dataset (see referenceCaptions)
+referenceCache  = {}
 
 def validateCaptions(model, modelParam, config, dataLoader):
-    is_train = False
+    """
+    Caption scores of the greedy decoder (model.net.generate). With config['beamSize'] the captions are also generated
+    with model.net.beam_search, its scores are returned and the greedy ones are added with the prefix "greedy_".
+    """
+    results_dict = scoreCaptions(model, modelParam, config, dataLoader, model.net.generate, 'greedy')
+    if config.get('beamSize', None) is None:
+        return results_dict
+
+    greedy_dict  = results_dict
+    results_dict = scoreCaptions(model, modelParam, config, dataLoader, model.net.beam_search,
+                                 f'beam search, {config["beamSize"]} beams')
+    print(f'{"":22s}{"greedy":>10s}{"beam":>10s}')
+    for key in ['captions_per_second', 'bleu_4', 'meteor', 'cider', 'rouge']:
+        print(f'{key:22s}{float(greedy_dict[key]):10.3f}{float(results_dict[key]):10.3f}')
+    results_dict.update({'greedy_' + key: value for key, value in greedy_dict.items()})
+    return results_dict
+
+
+def scoreCaptions(model, modelParam, config, dataLoader, generate, decoderName):
 
 
 
     references = {}  # references (true captions) for calculating BLEU-4 score
     hypotheses = {}  # hypotheses (predictions)
+    referenceTokens  = {}  # the same as token arrays, for TokenBLEU
+    hypothesisTokens = {}
+
+    endToken, tokenStrings = vocabularyTokens(modelParam['data_dir'])
 
     atiter=-1
+    generationTime = 0  # seconds spent in generate, for the captions per second
     for dataDict in dataLoader.myDataDicts['val']:
     
         #atiter=0
         #dataDict = next(iter(dataLoader.myDataDicts['val']))
 
-        for key in ['xTokens', 'yTokens', 'yWeights', 'cnn_features']:
+        for key in ['xTokens', 'cnn_features']:
             dataDict[key] = dataDict[key].to(model.device)
-        for idx in range(dataDict['numbOfTruncatedSequences']):
-            # for iter in range(1):
-            xTokens = dataDict['xTokens'][:, :, idx]
-            yTokens = dataDict['yTokens'][:, :, idx]
-            yWeights = dataDict['yWeights'][:, :, idx]
-            cnn_features = dataDict['cnn_features']
-            with torch.no_grad():
-              if idx == 0:
-                  logits, current_hidden_state = model.net(cnn_features, xTokens, is_train)
-                  predicted_tokens = logits.argmax(dim=2).detach().cpu()
-              else:
-                  logits, current_hidden_state = model.net(cnn_features, xTokens, is_train, current_hidden_state.detach())
-                  predicted_tokens = torch.cat((predicted_tokens, logits.argmax(dim=2).detach().cpu()), dim=1)
-              
-
-        vocabularyDict = loadVocabulary(modelParam['data_dir'])
-        TokenToWord = vocabularyDict['TokenToWord']
-        #wordToToken
-        #TokenToWord
-
-        #print('predicted_tokens.shape',predicted_tokens.shape)
-
-        #batchInd = 0
-        
-        
-        
-        for batchInd in range(predicted_tokens.shape[0]):
+        startTime = time.perf_counter()
+        # one generation per image: the decoder produces the whole caption (40 tokens) from the start token of the
+        # first truncated sequence, the other truncated sequences only matter for the loss
+        xTokens = dataDict['xTokens'][:, :, 0]
+        cnn_features = dataDict['cnn_features']
+        with torch.inference_mode():
+            tokens, _ = generate(cnn_features, xTokens)
+            predicted_tokens = tokens.detach().cpu()
+        generationTime += time.perf_counter() - startTime  # .cpu() waits for the gpu
+
+
+        # the captions are scored on the token ids, cut at the first end token
+        predictedtokens    = captionTokens(predicted_tokens.numpy(), endToken)
+        predictedsentences = [' '.join(tokenStrings[tokens]) for tokens in predictedtokens]
 
-            tokensentence =[]
-            sentence = []
-            foundEnd = False
-            for kk in range(predicted_tokens.shape[1]):
-                word = TokenToWord[predicted_tokens[batchInd, kk].item()]
-                if word == 'eeee':
-                    foundEnd = True
-                    #break
-                if foundEnd == False:
-                    sentence.append(word)
-                    tokensentence.append( '{:d}'.format(predicted_tokens[batchInd, kk].item()) )
-                    
-            #print captions
-            '''
-            print('\n')
-            print('Generated caption')
-            print(" ".join(sentence))
-            print('\n')
-            print('Original captions:')
-            for kk in range(len(dataDict['orig_captions'][batchInd])):
-                print(dataDict['orig_captions'][batchInd][kk])
-            print('\n')
-            '''
-            
+        for batchInd in range(predicted_tokens.shape[0]):
             if (atiter+0)%500==0:
               print('at iter',atiter)
-            
+
             atiter+=1
-            hypotheses[atiter]=[]
-            references[atiter]=[]
-                    
-            #predictedsentence= ' '.join(sentence)
-            predictedsentence= ' '.join(tokensentence)
-            hypotheses[atiter].append({'caption':predictedsentence}) 
-
-            for kk in range(len(dataDict['allcaptionsAsTokens'][batchInd])):
-                #seq2= dataDict['allcaptions'][batchInd][kk] 
-                seq2= dataDict['allcaptionsAsTokens'][batchInd][kk] 
-                seq2=seq2[1:-1] # drop start and end element
-                
-                seq2 = [  '{:d}'.format(s)  for s in seq2 ] #tokeintegers to string
-                ref = ' '.join(seq2) #concat
-                #print(ref,'|',predictedsentence)
-                references[atiter].append({'caption':ref})
+            # keyed by the image, the CIDEr index of the references is the same in every validation
+            imgPath = dataDict['imgPaths'][batchInd]
+            hypotheses[imgPath] = [{'caption': predictedsentences[batchInd]}]
+            hypothesisTokens[imgPath] = predictedtokens[batchInd]
+            references[imgPath], referenceTokens[imgPath] = referenceCaptions(imgPath,
+                                                                              dataDict['allcaptionsAsTokens'][batchInd])
 
            
     
     
     results_dict = {}
-    print("Calculating Evalaution Metric Scores......\n")
-    avg_bleu_dict = BLEU().calculate(hypotheses, references, tokenize= False)
-    bleu4 = avg_bleu_dict['bleu_4']
-    
-    
-
-    avg_meteor_dict = METEOR().calculate(hypotheses, references, tokenize= False)
-
+    results_dict['captions_per_second'] = len(hypotheses) / generationTime
+    print(f'{decoderName}: generated {len(hypotheses)} captions in {generationTime:.1f} s, {results_dict["captions_per_second"]:.1f} captions/s')
 
-    results_dict.update(avg_bleu_dict)
-
-    results_dict.update(avg_meteor_dict)
-    
-    avg_cider_dict = CIDEr().calculate(hypotheses, references)
-    cider = avg_cider_dict['cider']
-    #avg_bert_dict = BERT().calculate(hypotheses,references)
-    #bert = avg_bert_dict['bert']
-    avg_rouge_dict = ROUGE().calculate(hypotheses,references)
-    results_dict.update(avg_cider_dict)
-    results_dict.update(avg_rouge_dict)   
-
-    print(f'Evaluation results, BLEU-4: {bleu4}, Cider: {cider},  ROUGE: {avg_rouge_dict["rouge"]}, Meteor: {avg_meteor_dict["meteor"]}')
+    print("Calculating Evalaution Metric Scores......\n")
+    # BLEU, CIDEr and ROUGE on the token ids in this process, METEOR meanwhile in config['metricProcesses'] processes
+    startTime = time.perf_counter()
+    cider_index_file = config.get('ciderIndexFile', 'ciderD_val.npz')
+    cider_index_path = None if cider_index_file is None else modelParam['modelsDir'] + cider_index_file
+    cider_index = ciderIndex(referenceTokens, cider_index_path)
+    results_dict.update(calculateMetrics(hypotheses, references, config.get('metricProcesses', 4),
+                                         hypothesisTokens, referenceTokens, cider_index))
+    print(f'scored in {time.perf_counter() - startTime:.1f} s')
+
+    print(f'Evaluation results ({decoderName}), BLEU-4: {results_dict["bleu_4"]}, Cider: {results_dict["cider"]},  '
+          f'ROUGE: {results_dict["rouge"]}, Meteor: {results_dict["meteor"]}')
 
     return results_dict
 
+def vocabularyTokens(data_dir):
+    """
+    Returns:
+        endToken    : The token of 'eeee'
+        tokenStrings: Array of the decimal strings of all tokens, tokenStrings[token] == str(token)
+    """
+    if data_dir not in vocabularyCache:
+        vocabularyDict = loadVocabulary(data_dir)
+        tokenStrings   = np.array([str(token) for token in range(len(vocabularyDict['TokenToWord']))])
+        vocabularyCache[data_dir] = (vocabularyDict['wordToToken']['eeee'], tokenStrings)
+    return vocabularyCache[data_dir]
+
+
+def captionTokens(tokens, endToken):
+    """
+    Args:
+        tokens: The generated tokens, array shape[batch_size, seqLen]
+
+    Returns:
+        captions: list of the tokens of every row up to (without) the first end token
+    """
+    isEnd   = tokens == endToken
+    lengths = np.where(isEnd.any(axis=1), isEnd.argmax(axis=1), tokens.shape[1])
+    return [row[:length] for row, length in zip(tokens, lengths)]
+
+
+def referenceCaptions(imgPath, captionsAsTokens):
+    """
+    The reference captions of an image without the start and end token.
+
+    Returns:
+        captions: list of {'caption': token id string} for the metrics
+        tokens  : list of the token arrays for TokenBLEU
+    """
+    if imgPath not in referenceCache:
+        tokens = [np.asarray(caption[1:-1], dtype=np.int64) for caption in captionsAsTokens]
+        referenceCache[imgPath] = ([{'caption': ' '.join(str(token) for token in caption)} for caption in tokens],
+                                   tokens)
+    return referenceCache[imgPath]
+
 ########################################################################################################################
 
 
@@ -2,6 +2,8 @@ from torch import nn
 import torch.nn.functional as F
 import torch
 import numpy as np
+from torch.func import functional_call
+from torch.utils.checkpoint import checkpoint
 torch.manual_seed(0)
 
 
@@ -20,6 +22,7 @@ class imageCaptionModel(nn.Module):
             self.inputlayer : An instance of nn.Linear, shape[number_of_cnn_features, hidden_state_sizes]
             self.rnn        : An instance of RNN
             self.outputlayer: An instance of nn.Linear, shape[hidden_state_sizes, vocabulary_size]
+                              (nn.AdaptiveLogSoftmaxWithLoss if config['outputLayerType'] == 'adaptive')
         """
         self.config = config
         self.vocabulary_size = config['vocabulary_size']
@@ -28,10 +31,25 @@ class imageCaptionModel(nn.Module):
         self.hidden_state_sizes = config['hidden_state_sizes']
         self.num_rnn_layers = config['num_rnn_layers']
         self.cell_type = config['cellType']
+        self.loss_chunk_size = config.get('lossChunkSize', None)
+        self.output_layer_type = config.get('outputLayerType', 'linear')
+        self.compile_mode = config.get('compileMode', None)
+        self.checkpoint_segment = config.get('checkpointSegment', None)
+        self.decode_table           = config.get('decodeTable', False)
+        self.end_token              = config.get('endToken', None)
+        self.beam_size              = config.get('beamSize', None)
+        self.length_penalty         = config.get('lengthPenalty', 1.0)
+        self.rnn_backend = config.get('rnnBackend', 'custom')
+        self.gru_layout = config.get('gruLayout', 'reset_state')
 
         self.Embedding = nn.Embedding(self.vocabulary_size, self.embedding_size)
 
-        self.outputlayer = nn.Linear(self.hidden_state_sizes, self.vocabulary_size)
+        if self.output_layer_type == 'adaptive':
+            # clusters from the word frequencies, see utils.generateVocabulary.adaptiveSoftmaxCutoffs
+            self.outputlayer = nn.AdaptiveLogSoftmaxWithLoss(self.hidden_state_sizes, self.vocabulary_size,
+                                                             cutoffs=config['adaptiveSoftmaxCutoffs'])
+        else:
+            self.outputlayer = nn.Linear(self.hidden_state_sizes, self.vocabulary_size)
         self.nnmapsize = 512  # the output size for the image features after the processing via self.inputLayer
         self.inputlayer = nn.Sequential(
             nn.Dropout(p=0.25),
@@ -56,7 +74,13 @@ class imageCaptionModel(nn.Module):
 
         else:
             self.rnn = RNN(input_size=self.embedding_size + self.nnmapsize, hidden_state_size=self.hidden_state_sizes,
-                           num_rnn_layers=self.num_rnn_layers, cell_type=self.cell_type)
+                           num_rnn_layers=self.num_rnn_layers, cell_type=self.cell_type,
+                           rnn_backend=self.rnn_backend, gru_layout=self.gru_layout)
+
+        if self.compile_mode is not None:
+            self.rnn.compiled_step = CompiledStep(self.rnn.step, self.compile_mode)
+        self.rnn.checkpoint_segment = self.checkpoint_segment
+        self.rnn.token_gate_table = TokenGateTable() if self.decode_table else None
 
         return
 
@@ -82,9 +106,7 @@ class imageCaptionModel(nn.Module):
         imgfeat_processed = self.inputlayer(cnn_features)
 
         if current_hidden_state is None:
-            initial_hidden_state = torch.zeros(self.num_rnn_layers, cnn_features.shape[0], self.hidden_state_sizes,
-                                               device=torch.device('cuda'))
-
+            initial_hidden_state = self.get_initial_hidden_state(cnn_features)
         else:
             initial_hidden_state = current_hidden_state
 
@@ -94,6 +116,158 @@ class imageCaptionModel(nn.Module):
 
         return logits, current_hidden_state_out
 
+    def forward_loss(self, cnn_features, xTokens, yTokens, yWeights, current_hidden_state=None):
+        """
+        Teacher forced forward pass which computes the loss only on the non-padded positions.
+
+        Args:
+            cnn_features        : Features from the CNN network, shape[batch_size, number_of_cnn_features]
+            xTokens             : Shape[batch_size, truncated_backprop_length]
+            yTokens             : Shape[batch_size, truncated_backprop_length]
+            yWeights            : Shape[batch_size, truncated_backprop_length]
+            current_hidden_state: If not None, "current_hidden_state" should be passed into the rnn module
+
+        Returns:
+            sumLoss             : The total cross entropy loss for all words
+            meanLoss            : The averaged cross entropy loss for all words
+            current_hidden_state: shape[num_rnn_layers, batch_size, hidden_state_sizes]
+        """
+        imgfeat_processed = self.inputlayer(cnn_features)
+
+        if current_hidden_state is None:
+            initial_hidden_state = self.get_initial_hidden_state(cnn_features)
+        else:
+            initial_hidden_state = current_hidden_state
+
+        # without an output layer the rnn returns the last layer hidden states instead of the logits
+        hidden_states, current_hidden_state_out = self.rnn(xTokens, imgfeat_processed, initial_hidden_state, None,
+                                                           self.Embedding, is_train=True)
+
+        sumLoss, meanLoss = masked_loss_fn(hidden_states, self.outputlayer, yTokens, yWeights, self.loss_chunk_size)
+
+        return sumLoss, meanLoss, current_hidden_state_out
+
+    def generate(self, cnn_features, xTokens, current_hidden_state=None):
+        """
+        Greedy decoding which returns the predicted tokens instead of the logits.
+
+        Args:
+            cnn_features        : Features from the CNN network, shape[batch_size, number_of_cnn_features]
+            xTokens             : Shape[batch_size, truncated_backprop_length], only the first token is used
+            current_hidden_state: If not None, "current_hidden_state" should be passed into the rnn module
+
+        Returns:
+            tokens              : The predicted tokens, shape[batch_size, 40]
+            current_hidden_state: shape[num_rnn_layers, batch_size, hidden_state_sizes]
+        """
+        imgfeat_processed = self.inputlayer(cnn_features)
+
+        if current_hidden_state is None:
+            initial_hidden_state = self.get_initial_hidden_state(cnn_features)
+        else:
+            initial_hidden_state = current_hidden_state
+
+        tokens, current_hidden_state_out = self.rnn(xTokens, imgfeat_processed, initial_hidden_state, self.outputlayer,
+                                                    self.Embedding, is_train=False, return_tokens=True,
+                                                    end_token=self.end_token)
+
+        return tokens, current_hidden_state_out
+
+    def beam_search(self, cnn_features, xTokens, current_hidden_state=None):
+        """
+        Beam search decoding with config['beamSize'] beams per image, see the function beam_search. Same inputs and
+        outputs as generate.
+
+        Args:
+            cnn_features        : Features from the CNN network, shape[batch_size, number_of_cnn_features]
+            xTokens             : Shape[batch_size, truncated_backprop_length], only the first token is used
+            current_hidden_state: If not None, "current_hidden_state" should be passed into the rnn module
+
+        Returns:
+            tokens              : The tokens of the best beam, shape[batch_size, 40]
+            current_hidden_state: shape[num_rnn_layers, batch_size, hidden_state_sizes]
+        """
+        imgfeat_processed = self.inputlayer(cnn_features)
+
+        if current_hidden_state is None:
+            initial_hidden_state = self.get_initial_hidden_state(cnn_features)
+        else:
+            initial_hidden_state = current_hidden_state
+
+        step = self.rnn.step if self.rnn.compiled_step is None else self.rnn.compiled_step
+        return beam_search(step, self.outputlayer, self.Embedding, xTokens[:, 0], imgfeat_processed,
+                           initial_hidden_state, self.hidden_state_sizes, self.beam_size, 40, self.end_token,
+                           self.length_penalty)
+
+    def encode(self, cnn_features):
+        """
+        Step-wise decoding, the per image part: computed once per image and reused by every step(), so a caller (e.g. a
+        server streaming the tokens) can run the time loop itself. The rows of a context can be selected or
+        concatenated with select_context and cat_contexts.
+
+        Args:
+            cnn_features: Features from the CNN network, shape[batch_size, number_of_cnn_features]
+
+        Returns:
+            context: dict with the processed image features "imgfeat", shape[batch_size, nnmapsize],
+                     and with decodeTable the image part of the first layer input projection "image_projection"
+                     (else None), see TokenGateTable
+        """
+        context = {'imgfeat': self.inputlayer(cnn_features)}
+
+        image_projection = None
+        if self.rnn.token_gate_table is not None and not torch.is_grad_enabled():
+            image_projection = self.rnn.token_gate_table.image_projection(self.rnn.cells[0], self.Embedding,
+                                                                          context['imgfeat'])
+        context['image_projection'] = image_projection
+        return context
+
+    def step(self, context, state, tokens):
+        """
+        Step-wise decoding, one time step for every row of the context.
+
+        Args:
+            context: From encode
+            state  : The state returned by the previous step, None: the initial state (zeros)
+            tokens : The input tokens, the start token in the first step, shape[batch_size]
+
+        Returns:
+            logits : The logits of the next token (log-probabilities for the adaptive softmax),
+                     shape[batch_size, vocabulary_size]
+            state  : shape[num_rnn_layers, batch_size, hidden_state_sizes]
+        """
+        if state is None:
+            state = self.get_initial_hidden_state(context['imgfeat'])
+
+        if context['image_projection'] is not None:
+            tokens_vector    = None
+            input_projection = context['image_projection'] + self.rnn.token_gate_table.lookup(tokens)
+        else:
+            tokens_vector    = self.Embedding(tokens)
+            input_projection = None
+
+        step  = self.rnn.step if self.rnn.compiled_step is None else self.rnn.compiled_step
+        state = step(tokens_vector, context['imgfeat'], state, input_projection)
+        return output_logits(self.outputlayer, state[-1, :, :self.hidden_state_sizes]), state
+
+    def get_initial_hidden_state(self, cnn_features):
+        """
+        Args:
+            cnn_features: Features from the CNN network, shape[batch_size, number_of_cnn_features]
+
+        Returns:
+            initial_hidden_state: zeros on the device and with the dtype of the model parameters (or autocast),
+                                  shape[num_rnn_layers, batch_size, hidden_state_sizes]
+        """
+        weight = self.Embedding.weight
+        dtype  = weight.dtype
+        if torch.is_autocast_enabled(weight.device.type):
+            # mixedPrecision, the recurrence runs in the autocast dtype (float32 would be kept by type promotion)
+            dtype = torch.get_autocast_dtype(weight.device.type)
+        return torch.zeros(self.num_rnn_layers, cnn_features.shape[0], self.hidden_state_sizes,
+                           device=weight.device, dtype=dtype)
+
+
 
 ######################################################################################################################
 
@@ -165,7 +339,8 @@ class RNN_onelayer_simplified(nn.Module):
 
 
 class RNN(nn.Module):
-    def __init__(self, input_size, hidden_state_size, num_rnn_layers, cell_type='GRU'):
+    def __init__(self, input_size, hidden_state_size, num_rnn_layers, cell_type='GRU', rnn_backend='custom',
+                 gru_layout='reset_state'):
         super(RNN, self).__init__()
         """
         Args:
@@ -173,6 +348,10 @@ class RNN(nn.Module):
             hidden_state_size (Int) : Number of features in the rnn cells (will be equal for all rnn layers)
             num_rnn_layers (Int)    : Number of stacked rnns
             cell_type               : Whether to use vanilla or GRU cells
+            rnn_backend             : 'custom' (python loop over the cells) or 'native' (teacher forced training on the
+                                      fused nn.RNN/nn.GRU/nn.LSTM kernels, decoding still uses the custom loop)
+            gru_layout              : 'reset_state' (GRUCell, the reset gate scales the hidden state before the
+                                      candidate weights) or 'standard' (StandardGRUCell, the nn.GRU equations)
 
         Returns:
             self.cells              : A nn.ModuleList with entities of "RNNCell" or "GRUCell"
@@ -188,24 +367,50 @@ class RNN(nn.Module):
 
         # TODO
         # Your task is to create a list (self.cells) of type "nn.ModuleList" and populated it with cells of type "self.cell_type" - depending on the number of rnn layers
-        self.cells = nn.ModuleList([GRUCell(hidden_state_size=self.hidden_state_size, input_size=input_size_list[i]) for i in range(self.num_rnn_layers)])
+        cell_class = StandardGRUCell if gru_layout == 'standard' else GRUCell
+        self.cells = nn.ModuleList([cell_class(hidden_state_size=self.hidden_state_size, input_size=input_size_list[i]) for i in range(self.num_rnn_layers)])
+
+        self.rnn_backend = rnn_backend
+        if self.rnn_backend == 'native':
+            # kept out of the module tree, the weights always come from self.cells (checkpoints do not change)
+            self.native_rnn = (native_rnn_module(self.cells),)
+
+        self.compiled_step = None  # set by imageCaptionModel for compileMode, see CompiledStep
+        self.checkpoint_segment = None  # set by imageCaptionModel for checkpointSegment, see checkpointed_forward
+        self.token_gate_table = None  # set by imageCaptionModel for decodeTable, see TokenGateTable
 
         return
 
-    def forward(self, xTokens, baseimgfeat, initial_hidden_state, outputLayer, Embedding, is_train=True):
+    def forward(self, xTokens, baseimgfeat, initial_hidden_state, outputLayer, Embedding, is_train=True, return_tokens=False,
+                end_token=None):
         """
         Args:
             xTokens:        shape [batch_size, truncated_backprop_length]
             initial_hidden_state:  shape [num_rnn_layers, batch_size, hidden_state_size]
-            outputLayer:    handle to the last fully connected layer (an instance of nn.Linear)
+            outputLayer:    handle to the last fully connected layer (an instance of nn.Linear). If None (training
+                            only), the hidden states of the last layer are returned instead of the logits
             Embedding:      An instance of nn.Embedding. This is the embedding matrix.
             is_train:       flag: whether or not to feed in the predicated token vector as input for next step
+            return_tokens:  flag: return the predicted tokens instead of the logits (greedy decoding)
+            end_token:      If not None (with return_tokens), rows stop at this token and the loop stops when all
+                            rows are done, the tokens after it are end_token, see drop_finished_rows
 
         Returns:
             logits        : The predicted logits. shape[batch_size, truncated_backprop_length, vocabulary_size]
+                            or the last layer hidden states, shape[batch_size, truncated_backprop_length, hidden_state_sizes]
+                            or the predicted tokens, shape[batch_size, truncated_backprop_length]
             current_state : The hidden state from the last iteration (in time/words).
                             Shape[num_rnn_layers, batch_size, hidden_state_sizes]
         """
+        if is_train == True and self.rnn_backend == 'native':
+            return self.forward_native(xTokens, baseimgfeat, initial_hidden_state, outputLayer, Embedding)
+
+        if is_train == True and self.checkpoint_segment is not None and torch.is_grad_enabled():
+            # activation checkpointing over time, the state is only kept at the segment boundaries
+            step = self.step if self.compiled_step is None else self.compiled_step
+            return checkpointed_forward(step, Embedding(input=xTokens), baseimgfeat, initial_hidden_state, outputLayer,
+                                        self.hidden_state_size, self.checkpoint_segment)
+
         if is_train == True:
             seqLen = xTokens.shape[1]  # truncated_backprop_length
         else:
@@ -224,47 +429,485 @@ class RNN(nn.Module):
         logits_series = []
 
         # current_state = list(torch.unbind(initial_hidden_state, dim=0))
+        # the cell updates of one time step, see self.step (compiled with compileMode)
+        step = self.step if self.compiled_step is None else self.compiled_step
+
+        # greedy decoding with decodeTable: the image part of the first layer input projection is computed once, the
+        # token part is a row of the precomputed table, see TokenGateTable
+        image_projection = None
+        if is_train == False and self.token_gate_table is not None and not torch.is_grad_enabled():
+            image_projection = self.token_gate_table.image_projection(self.cells[0], Embedding, baseimgfeat)
+            tokens = xTokens[:, 0]
+        input_projection = None
+
+        # greedy decoding with end_token: the rows which are done are dropped from the batch, see drop_finished_rows
+        active = None
+        if return_tokens and end_token is not None and is_train == False:
+            active      = torch.arange(xTokens.shape[0], device=xTokens.device)
+            tokens_out  = torch.full((xTokens.shape[0], seqLen), end_token, dtype=torch.long, device=xTokens.device)
+            final_state = initial_hidden_state.clone()
+
         current_state = initial_hidden_state
         for kk in range(seqLen):
-            updatedstate = torch.zeros_like(current_state)
-
-            # TODO
-            # you need to:
-            # create your lvl0input,
-            # update the hidden cell state for every layer with inputs depending on the layer index
-            # if you are at the last layer, then produce logitskk, tokens , run a logits_series.append(logitskk),
-            # see the simplified rnn for the one layer version
-
-            lvl0input = torch.cat((baseimgfeat, tokens_vector), dim=1)
-            updatedstate[0, :] = self.cells[0](lvl0input, current_state[0, :, :])
-
-            for layer in range(1,self.num_rnn_layers):
-                #print("layer: ",layer)
-                updatedstate[layer, :] = self.cells[layer](updatedstate[layer-1,:], current_state[layer, :, :])
-
-            logitskk = outputLayer(updatedstate[self.num_rnn_layers - 1, :])
-
-            tokens = torch.argmax(logitskk, dim=1)
-            logits_series.append(logitskk)
-
-            current_state = updatedstate
-
+            if image_projection is not None:
+                input_projection = image_projection + self.token_gate_table.lookup(tokens)
+            updatedstate = step(tokens_vector, baseimgfeat, current_state, input_projection)
+
+            if outputLayer is None:
+                logits_series.append(updatedstate[self.num_rnn_layers - 1, :])
+            elif return_tokens:
+                tokens = output_tokens(outputLayer, updatedstate[self.num_rnn_layers - 1, :])
+                if active is None:
+                    logits_series.append(tokens)
+                else:
+                    tokens_out[active, kk] = tokens
+            else:
+                logitskk = output_logits(outputLayer, updatedstate[self.num_rnn_layers - 1, :])
+
+                tokens = torch.argmax(logitskk, dim=1)
+                logits_series.append(logitskk)
 
             current_state = updatedstate
+            if active is not None:
+                finished = tokens == end_token
+                if finished.any():  # synchronizes with the gpu once per step
+                    active, current_state, tokens, baseimgfeat, image_projection = drop_finished_rows(
+                        finished, active, final_state, current_state, tokens, baseimgfeat, image_projection)
+                    if active.shape[0] == 0:
+                        break
             if kk < seqLen - 1:
                 if is_train == True:
                     tokens_vector = embed_input_vec[:, kk + 1, :]
-                elif is_train == False:
+                elif is_train == False and image_projection is None:
                     tokens_vector = Embedding(tokens)
 
+        if active is not None:
+            final_state[:, active] = current_state
+            return tokens_out, final_state
+
         # Produce outputs
         logits = torch.stack(logits_series, dim=1)
         # current_state = torch.stack(current_state, dim=0)
         return logits, current_state
 
+    def step(self, tokens_vector, baseimgfeat, current_state, input_projection=None):
+        """
+        One time step through all the layers of the rnn.
+
+        Args:
+            tokens_vector: Embedding of the current input tokens, shape[batch_size, embedding_size]
+            baseimgfeat:   Processed image features, shape[batch_size, nnmapsize]
+            current_state: shape[num_rnn_layers, batch_size, hidden_state_size]
+            input_projection: If not None, the first layer input projection of the image and the tokens
+                          (decodeTable), tokens_vector is not used. shape[batch_size, gate size]
+
+        Returns:
+            updatedstate:  shape[num_rnn_layers, batch_size, hidden_state_size]
+        """
+        if input_projection is not None:
+            # decodeTable, the first layer input projection comes from TokenGateTable
+            updatedstate = [self.cells[0](None, current_state[0], input_projection)]
+        else:
+            # the embedding is float32 also under autocast (mixedPrecision), the cat would promote the cell input
+            # to float32
+            lvl0input = torch.cat((baseimgfeat, tokens_vector.to(baseimgfeat.dtype)), dim=1)
+            updatedstate = [self.cells[0](lvl0input, current_state[0])]
+
+        for layer in range(1, self.num_rnn_layers):
+            updatedstate.append(self.cells[layer](updatedstate[layer-1], current_state[layer]))
+
+        return torch.stack(updatedstate, dim=0)
+
+    def forward_native(self, xTokens, baseimgfeat, initial_hidden_state, outputLayer, Embedding):
+        """
+        Teacher forced forward pass on the fused torch.nn kernel (rnnBackend 'native'), same Args and Returns as forward.
+        """
+        # the image features are part of the input at every time step
+        embed_input_vec = Embedding(input=xTokens)
+        inputs = torch.cat((baseimgfeat[:, None, :].expand(-1, xTokens.shape[1], -1), embed_input_vec), dim=2)
+
+        hidden_states, current_state = native_rnn_forward(self.native_rnn[0], self.cells, inputs, initial_hidden_state)
+
+        if outputLayer is None:
+            return hidden_states, current_state
+        logits = output_logits(outputLayer, hidden_states.reshape(-1, hidden_states.shape[2]))
+        return logits.view(xTokens.shape[0], xTokens.shape[1], -1), current_state
+
+
+######################################################################################################################
+class CompiledStep():
+    """
+    torch.compile of the per time step cell updates ("step" of the rnn classes), used with config['compileMode'].
+
+    Only the step is compiled, the time loop stays in python, so the sequence length (truncated_backprop_length in
+    training, 40 in generation) never becomes part of a compiled graph, and the batch size is marked dynamic. If the
+    compilation fails, e.g. on a CPU machine without a C++ compiler for the inductor backend, the eager step is used.
+    """
+    def __init__(self, step, compile_mode):
+        self.step     = step
+        self.compiled = torch.compile(step, mode=compile_mode, dynamic=True)
+        return
+
+    def __call__(self, *args):
+        if self.compiled is not None:
+            try:
+                return self.compiled(*args)
+            except Exception as error:
+                print('torch.compile of the rnn step failed, falling back to eager mode:', error)
+                self.compiled = None
+        return self.step(*args)
+
+
+######################################################################################################################
+def run_segment(step, embed_segment, baseimgfeat, current_state, outputLayer, hidden_state_size, *step_args):
+    """
+    Teacher forced time steps over one segment of the input sequence, used by checkpointed_forward.
+
+    Returns:
+        outputs      : The last layer hidden states (outputLayer None) or the logits,
+                       shape[batch_size, segment length, hidden_state_size or vocabulary_size]
+        current_state: The state after the last time step of the segment
+    """
+    outputs = []
+    for kk in range(embed_segment.shape[1]):
+        current_state = step(embed_segment[:, kk, :], baseimgfeat, current_state, *step_args)
+        out = current_state[-1, :, :hidden_state_size]
+        outputs.append(out if outputLayer is None else output_logits(outputLayer, out))
+    return torch.stack(outputs, dim=1), current_state
+
+
+def checkpointed_forward(step, embed_input_vec, baseimgfeat, initial_hidden_state, outputLayer, hidden_state_size,
+                         segment_length, *step_args):
+    """
+    Teacher forced time loop with activation checkpointing over time, used with config['checkpointSegment'].
+
+    The sequence is split into segments of segment_length time steps. Only the state at the segment boundaries and the
+    segment outputs are kept for the backward pass, the activations inside a segment (gates, concatenated cell inputs,
+    low precision copies) are recomputed from the boundary state when the gradient reaches the segment.
+
+    Memory/compute trade-off for T = truncated_backprop_length and S = segment_length: the cell activations kept
+    during the forward pass go from T steps to T/S boundary states plus the S steps of the one segment being
+    recomputed in backward, which is smallest around S = sqrt(T). The price is a second forward pass through the cells,
+    about 1/3 more time for a cell bound step (forward ~1/3 of forward + backward), independent of S. With S >= T
+    everything is recomputed at once and nothing is saved. See benchmark_training.py --checkpoint-segments.
+
+    Args:
+        step                : The rnn step, step(tokens_vector, baseimgfeat, current_state, *step_args)
+        embed_input_vec     : shape[batch_size, truncated_backprop_length, embedding_size]
+        baseimgfeat         : Processed image features, shape[batch_size, nnmapsize]
+        initial_hidden_state: shape[num_rnn_layers, batch_size, hidden_state_size]
+        outputLayer         : None (the hidden states are returned, see masked_loss_fn) or the output layer
+        hidden_state_size   : Size of the hidden state part of the state
+        segment_length      : Time steps per checkpointed segment
+
+    Returns:
+        outputs      : shape[batch_size, truncated_backprop_length, hidden_state_size or vocabulary_size]
+        current_state: The hidden state from the last time step
+    """
+    outputs = []
+    current_state = initial_hidden_state
+    for start in range(0, embed_input_vec.shape[1], segment_length):
+        segment_outputs, current_state = checkpoint(run_segment, step, embed_input_vec[:, start:start+segment_length],
+                                                    baseimgfeat, current_state, outputLayer, hidden_state_size,
+                                                    *step_args, use_reentrant=False)
+        outputs.append(segment_outputs)
+    return torch.cat(outputs, dim=1), current_state
+
+
+######################################################################################################################
+class TokenGateTable():
+    """
+    Greedy decoding with config['decodeTable']. The first rnn layer gets [image features, token embedding] as input, so
+    with fixed weights the token part of its gate pre-activations is a row of the [vocabulary_size, gate size] table
+    Embedding.weight @ W_token, and the image part (with the bias) only depends on the image. A decoding step then
+    gathers one row per token instead of multiplying the embedding through the first layer weights.
+
+    The table is built on first use and rebuilt when the embedding or the first cell changes (optimizer step,
+    load_state_dict, .to()). It holds vocabulary_size x gate size values, the gate size is hidden_state_sizes times the
+    number of gates (4 for LSTM, 3 for GRU, 1 for RNN). Cells without input_projection, or with int8 weights, decode
+    as before.
+    """
+    def __init__(self):
+        self.version      = None
+        self.table        = None
+        self.image_weight = None
+        self.bias         = None
+        return
+
+    def image_projection(self, cell, Embedding, baseimgfeat):
+        """
+        Args:
+            cell       : The first rnn cell
+            Embedding  : An instance of nn.Embedding
+            baseimgfeat: Processed image features, shape[batch_size, nnmapsize]
+
+        Returns:
+            image_projection: baseimgfeat @ W_image + bias, shape[batch_size, gate size], or None if the table can not
+                              be used for the cell
+        """
+        if not hasattr(cell, 'input_projection') or cell.quantized_weights is not None:
+            return None
+
+        version = [(parameter.data_ptr(), parameter._version, parameter.dtype)
+                   for parameter in [Embedding.weight] + list(cell.parameters())]
+        if version != self.version:
+            with torch.no_grad():
+                weight, bias = cell.input_projection()
+                image_size        = baseimgfeat.shape[1]
+                self.image_weight = weight[:image_size].clone()
+                self.table        = torch.mm(Embedding.weight, weight[image_size:])
+                self.bias         = bias.clone()
+            self.version = version
+        return torch.addmm(self.bias, baseimgfeat, self.image_weight)
+
+    def lookup(self, tokens):
+        """
+        Args:
+            tokens: shape[batch_size]
+
+        Returns:
+            The token part of the first layer gate pre-activations, shape[batch_size, gate size]
+        """
+        return self.table[tokens]
+
+
+######################################################################################################################
+def drop_finished_rows(finished, active, final_state, current_state, *batch_tensors):
+    """
+    Early termination of greedy decoding with config['endToken']: the rows which emitted the end token leave the
+    active batch, so the following steps only run on the unfinished rows.
+
+    Args:
+        finished     : The rows which emitted the end token, bool, shape[active batch_size]
+        active       : The batch index of every active row, shape[active batch_size]
+        final_state  : The returned state, the state of the finished rows is written to it,
+                       shape[num_rnn_layers, batch_size, hidden_state_size]
+        current_state: The state of the active rows, shape[num_rnn_layers, active batch_size, hidden_state_size]
+        batch_tensors: Other tensors with one row per active row (tokens, image features, ...), None is passed through
+
+    Returns:
+        active, current_state, *batch_tensors of the unfinished rows
+    """
+    final_state[:, active[finished]] = current_state[:, finished]
+    keep = torch.logical_not(finished)
+    return [active[keep], current_state[:, keep]] + [None if tensor is None else tensor[keep] for tensor in batch_tensors]
+
+
+def beam_search(step, outputLayer, Embedding, tokens, baseimgfeat, initial_hidden_state, hidden_state_size, beam_size,
+                seqLen, end_token, length_penalty, *step_args):
+    """
+    Batched beam search, used by imageCaptionModel.beam_search with config['beamSize'].
+
+    The beams are an extra batch dimension: row image*beam_size + beam of the state (and of the image features and
+    step_args) holds one beam. Every step scores all [batch_size, beam_size, vocabulary_size] extensions and keeps the
+    beam_size best per image with one topk, the state and the token history of the kept beams are reordered with
+    index_select. The beams are ranked by the length normalized log-probability sum / length**length_penalty.
+
+    A beam which emitted end_token is kept with its score and only continued with end_token. An image is done when all
+    its beams are finished, or when its best finished beam beats the best score an unfinished beam could still reach
+    (its log-probability sum can only decrease, normalized with the longest length seqLen). Done images are removed
+    from the batch, the loop stops when all images are done.
+
+    Args:
+        step                : The rnn step, step(tokens_vector, baseimgfeat, current_state, *step_args)
+        outputLayer         : nn.Linear or nn.AdaptiveLogSoftmaxWithLoss
+        Embedding           : An instance of nn.Embedding
+        tokens              : The first input tokens, shape[batch_size]
+        baseimgfeat         : Processed image features, shape[batch_size, nnmapsize]
+        initial_hidden_state: shape[num_rnn_layers, batch_size, hidden_state_size]
+        hidden_state_size   : Size of the hidden state part of the state
+        beam_size           : Number of beams per image
+        seqLen              : Max sequence length to be generated
+        end_token           : The end token, None: all beams run seqLen steps
+        length_penalty      : Exponent of the length normalization, 0: plain log-probability sum
+        step_args           : Further step arguments, the tensors have one row per image
+
+    Returns:
+        tokens       : The tokens of the best beam, end_token after its end, shape[batch_size, seqLen]
+        current_state: The state of the best beam after its last token, shape[num_rnn_layers, batch_size, state size]
+    """
+    batch_size = tokens.shape[0]
+    device     = tokens.device
+    pad        = 0 if end_token is None else end_token
+
+    # all beams start as copies of the image row
+    tokens        = tokens.repeat_interleave(beam_size, dim=0)
+    baseimgfeat   = baseimgfeat.repeat_interleave(beam_size, dim=0)
+    current_state = initial_hidden_state.repeat_interleave(beam_size, dim=1)
+    step_args     = [arg.repeat_interleave(beam_size, dim=0) if torch.is_tensor(arg) else arg for arg in step_args]
+
+    # only the first of the identical beams is extended in the first step
+    scores = torch.full((batch_size, beam_size), float('-inf'), device=device)
+    scores[:, 0] = 0
+    lengths  = torch.zeros((batch_size, beam_size), device=device)
+    finished = torch.zeros((batch_size, beam_size), dtype=torch.bool, device=device)
+    history  = torch.full((batch_size*beam_size, seqLen), pad, dtype=torch.long, device=device)
+
+    active      = torch.arange(batch_size, device=device)
+    tokens_out  = torch.full((batch_size, seqLen), pad, dtype=torch.long, device=device)
+    final_state = initial_hidden_state.clone()
+
+    for kk in range(seqLen):
+        updatedstate = step(Embedding(tokens), baseimgfeat, current_state, *step_args)
+        log_probs = output_log_probs(outputLayer, updatedstate[-1, :, :hidden_state_size]).float()
+        # a finished beam keeps the state after its end token
+        current_state = torch.where(finished.view(1, -1, 1), current_state, updatedstate)
+        vocabulary_size = log_probs.shape[1]
+        log_probs = log_probs.view(-1, beam_size, vocabulary_size)
+        if end_token is not None:
+            # a finished beam is only continued with the end token, at no cost and without getting longer
+            frozen = torch.full_like(log_probs[:1, :1], float('-inf'))
+            frozen[..., end_token] = 0
+            log_probs = torch.where(finished[:, :, None], frozen, log_probs)
+        candidate_lengths = lengths + torch.logical_not(finished)
+
+        candidates = scores[:, :, None] + log_probs
+        normalized = candidates / candidate_lengths[:, :, None]**length_penalty
+        _, index   = torch.topk(normalized.view(-1, beam_size*vocabulary_size), beam_size, dim=1)
+        beam       = torch.div(index, vocabulary_size, rounding_mode='floor')
+        tokens     = index % vocabulary_size
+
+        scores  = torch.gather(candidates.view(-1, beam_size*vocabulary_size), 1, index)
+        lengths = torch.gather(candidate_lengths, 1, beam)
+        rows    = (beam + beam_size*torch.arange(beam.shape[0], device=device)[:, None]).view(-1)
+        current_state = current_state.index_select(1, rows)
+        history       = history.index_select(0, rows)
+        history[:, kk] = tokens.view(-1)
+        if end_token is not None:
+            finished = torch.gather(finished, 1, beam) | (tokens == end_token)
+        tokens = tokens.view(-1)
+
+        normalized = scores / lengths**length_penalty
+        if kk == seqLen - 1:
+            done = torch.ones_like(active, dtype=torch.bool)
+        else:
+            best_finished = torch.where(finished, normalized, torch.full_like(normalized, float('-inf'))).max(dim=1)[0]
+            best_bound    = torch.where(finished, torch.full_like(scores, float('-inf')), scores).max(dim=1)[0]
+            done = best_finished >= best_bound / seqLen**length_penalty
+        if done.any():  # synchronizes with the gpu once per step
+            # the best finished beam, the best beam of all if none is finished (seqLen reached)
+            ranking = torch.where(finished | torch.logical_not(finished.any(dim=1, keepdim=True)), normalized,
+                                  torch.full_like(normalized, float('-inf')))
+            best = ranking.argmax(dim=1) + beam_size*torch.arange(beam.shape[0], device=device)
+            tokens_out[active[done]]     = history[best[done]]
+            final_state[:, active[done]] = current_state[:, best[done]]
+
+            keep = torch.logical_not(done)
+            if not keep.any():
+                break
+            rows_keep = keep.repeat_interleave(beam_size)
+            active, scores, lengths, finished = active[keep], scores[keep], lengths[keep], finished[keep]
+            tokens, baseimgfeat, history = tokens[rows_keep], baseimgfeat[rows_keep], history[rows_keep]
+            current_state = current_state[:, rows_keep]
+            step_args     = [arg[rows_keep] if torch.is_tensor(arg) else arg for arg in step_args]
+
+    return tokens_out, final_state
+
+
+######################################################################################################################
+def select_context(context, index):
+    """
+    The rows "index" of a context from imageCaptionModel.encode (index: tensor of row indices or bool mask).
+    """
+    return {key: None if value is None else value[index] for key, value in context.items()}
+
+
+def cat_contexts(contexts):
+    """
+    Concatenation of the rows of contexts from imageCaptionModel.encode (of the same model).
+    """
+    return {key: None if contexts[0][key] is None else torch.cat([context[key] for context in contexts], dim=0)
+            for key in contexts[0]}
+
+
+######################################################################################################################
+def pack_int8(weight, bias=None):
+    """
+    Symmetric per output channel int8 quantization of a weight for torch.ops.quantized.linear_dynamic (CPU only).
+
+    Args:
+        weight: shape[out_features, in_features] (the nn.Linear layout)
+        bias  : shape[out_features] or None
+
+    Returns:
+        packed: the prepacked int8 weight and float bias
+    """
+    weight = weight.detach().float().contiguous()
+    scales = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+    zero_points = torch.zeros(weight.shape[0], dtype=torch.long)
+    qweight = torch.quantize_per_channel(weight, scales.double(), zero_points, 0, torch.qint8)
+    return torch.ops.quantized.linear_prepack(qweight, None if bias is None else bias.detach().float().contiguous())
+
+
+def cell_mm(cell, input, name, bias=None):
+    """
+    torch.mm(input, cell.<name>) (+ bias), or the int8 matmul with a dynamically quantized input once the cell is
+    quantized (see quantize_dynamic_int8). The bias is added by torch.addmm, under autocast (mixedPrecision) the gate
+    pre-activations then stay in the low precision dtype instead of being promoted by the float32 bias.
+    """
+    if cell.quantized_weights is None:
+        if bias is None:
+            return torch.mm(input, getattr(cell, name))
+        return torch.addmm(bias, input, getattr(cell, name))
+    output = torch.ops.quantized.linear_dynamic(input, cell.quantized_weights[name])
+    return output if bias is None else output + bias
+
+
+def projected_mm(cell, state, name, input_projection):
+    """
+    input_projection + state @ (the state rows of cell.<name>), used when the cell input part x @ W_x + bias of the gate
+    is already given (decoding with config['decodeTable'], see TokenGateTable)
+    """
+    return torch.addmm(input_projection, state, getattr(cell, name)[cell.input_size:])
+
+
+class DynamicInt8Linear(nn.Module):
+    """
+    nn.Linear with int8 weights, the input is quantized per call (CPU only), see quantize_dynamic_int8.
+    """
+    def __init__(self, linear):
+        super(DynamicInt8Linear, self).__init__()
+        self.in_features  = linear.in_features
+        self.out_features = linear.out_features
+        self.packed       = pack_int8(linear.weight, linear.bias)
+        return
+
+    def forward(self, input):
+        return torch.ops.quantized.linear_dynamic(input, self.packed)
+
+
+def quantize_dynamic_int8(net):
+    """
+    Post-training dynamic int8 quantization of the rnn cells and the output layer for CPU decoding. The weights are
+    quantized once (per output channel), the activations per matrix multiplication. The quantized net can only be used
+    for inference.
+
+    Args:
+        net: imageCaptionModel on the cpu with the trained weights
+
+    Returns:
+        net: the same module, quantized in place
+    """
+    for cell in net.rnn.cells:
+        if not hasattr(cell, 'quantize_dynamic'):
+            raise ValueError(f'{type(cell).__name__} has no int8 mode')
+        cell.quantize_dynamic()
+
+    if isinstance(net.outputlayer, nn.AdaptiveLogSoftmaxWithLoss):
+        net.outputlayer.head = DynamicInt8Linear(net.outputlayer.head)
+        for tail in net.outputlayer.tail:
+            for ii in range(len(tail)):
+                tail[ii] = DynamicInt8Linear(tail[ii])
+    else:
+        net.outputlayer = DynamicInt8Linear(net.outputlayer)
+    return net
+
 
 ########################################################################################################################
 class GRUCell(nn.Module):
+    native_mode = None  # the reset gate is applied before the hidden state weights, nn.GRU: see StandardGRUCell
+    quantized_weights = None  # int8 weights for decoding, see quantize_dynamic_int8
+
     def __init__(self, hidden_state_size, input_size):
         super(GRUCell, self).__init__()
         """
@@ -300,6 +943,7 @@ class GRUCell(nn.Module):
         """
 
         self.hidden_state_sizes = hidden_state_size
+        self.input_size = input_size
 
         self.weight_u = nn.Parameter(
             torch.randn(input_size + hidden_state_size, hidden_state_size) / np.sqrt(input_size + hidden_state_size))
@@ -314,12 +958,14 @@ class GRUCell(nn.Module):
         self.bias = nn.Parameter(torch.zeros(1, hidden_state_size))
         return
 
-    def forward(self, x, state_old):
+    def forward(self, x, state_old, input_projection=None):
         ""
         """
         Args:
             x: tensor with shape [batch_size, inputSize]
             state_old: tensor with shape [batch_size, hidden_state_sizes]
+            input_projection: If not None, x @ W_x + bias of the reset, update and candidate weights from TokenGateTable
+                              (decoding), x is not used
 
         Returns:
             state_new: The updated hidden state of the recurrent cell. Shape [batch_size, hidden_state_sizes]
@@ -331,11 +977,15 @@ class GRUCell(nn.Module):
         #print("state_old: ", state_old.shape)
         #print("bias_r: ", self.bias_r.shape)
 
-        input_cat = torch.cat((x, state_old), dim=1)
-        reset = torch.mm(input_cat, self.weight_r) + self.bias_r
+        if input_projection is None:
+            input_cat = torch.cat((x, state_old), dim=1)
+            reset = cell_mm(self, input_cat, 'weight_r', self.bias_r)
+            update = cell_mm(self, input_cat, 'weight_u', self.bias_u)
+        else:
+            projection_r, projection_u, projection = torch.chunk(input_projection, 3, dim=1)
+            reset = projected_mm(self, state_old, 'weight_r', projection_r)
+            update = projected_mm(self, state_old, 'weight_u', projection_u)
         reset = torch.sigmoid(reset)
-
-        update = torch.mm(input_cat, self.weight_u) + self.bias_u
         update = torch.sigmoid(update)
 
         #TODO REMOVE
@@ -350,7 +1000,8 @@ class GRUCell(nn.Module):
         #TODO REMOVE
         #print("product:   ", product.shape)
 
-        reset_cat = torch.cat((x, product), dim=1)
+        if input_projection is None:
+            reset_cat = torch.cat((x, product), dim=1)
 
         #TODO REMOVE
         """
@@ -358,7 +1009,10 @@ class GRUCell(nn.Module):
         print("weight:    ", self.weight.shape)
         """
 
-        cand_hidden = torch.mm(reset_cat, self.weight) + self.bias
+        if input_projection is None:
+            cand_hidden = cell_mm(self, reset_cat, 'weight', self.bias)
+        else:
+            cand_hidden = projected_mm(self, product, 'weight', projection)
         cand_hidden = torch.tanh(cand_hidden)
 
         #TODO REMOVE
@@ -368,9 +1022,141 @@ class GRUCell(nn.Module):
         state_new = hidden_state_update
         return state_new
 
+    def input_projection(self):
+        """
+        Returns:
+            weight, bias: The rows of weight_r, weight_u and weight applied to the cell input x, concatenated,
+                          shape[inputSize, 3*hidden_state_sizes], and the biases, see TokenGateTable
+        """
+        weight = torch.cat((self.weight_r[:self.input_size], self.weight_u[:self.input_size],
+                            self.weight[:self.input_size]), dim=1)
+        return weight, torch.cat((self.bias_r[0], self.bias_u[0], self.bias[0]))
+
+    def quantize_dynamic(self):
+        """
+        int8 weights for CPU decoding, used by cell_mm, see quantize_dynamic_int8.
+        """
+        self.quantized_weights = {'weight_r': pack_int8(self.weight_r.t()),
+                                  'weight_u': pack_int8(self.weight_u.t()),
+                                  'weight': pack_int8(self.weight.t())}
+        return
+
+
+######################################################################################################################
+class StandardGRUCell(nn.Module):
+    native_mode = 'GRU'  # same equations and gate order (reset, update, candidate) as nn.GRU
+    quantized_weights = None  # int8 weights for decoding, see quantize_dynamic_int8
+
+    def __init__(self, hidden_state_size, input_size):
+        super(StandardGRUCell, self).__init__()
+        """
+        GRU cell with the equations of nn.GRU (config['gruLayout'] 'standard'): the reset gate is applied after the
+        hidden state weights, to h @ W_hn + b_hn, instead of to the hidden state before the weights as in GRUCell. So
+        the hidden state part of the three gates is one matrix multiplication per step, and the teacher forced pass can
+        run on the fused nn.GRU kernel (rnnBackend 'native').
+
+        Args:
+            hidden_state_size: Integer defining the size of the hidden state of rnn cell
+            inputSize: Integer defining the number of input features to the rnn
+
+        Returns:
+            self.weight_ih: A nn.Parameter with shape [3*hidden_state_sizes, inputSize], the reset, update and
+                            candidate weights of the cell input stacked (the nn.GRU layout). Initialized using variance
+                            scaling with zero mean.
+
+            self.weight_hh: A nn.Parameter with shape [3*hidden_state_sizes, hidden_state_sizes], the same for the
+                            hidden state. Initialized using variance scaling with zero mean.
+
+            self.bias_ih: A nn.Parameter with shape [1, 3*hidden_state_sizes]. Initialized to zero.
+
+            self.bias_hh: A nn.Parameter with shape [1, 3*hidden_state_sizes]. Initialized to zero.
+
+        Tips:
+            Variance scaling:  Var[W] = 1/n
+        """
+        self.input_size = input_size
+        self.hidden_state_size = hidden_state_size
+
+        self.weight_ih = nn.Parameter(
+            torch.randn(3*hidden_state_size, input_size) / np.sqrt(input_size + hidden_state_size))
+        self.weight_hh = nn.Parameter(
+            torch.randn(3*hidden_state_size, hidden_state_size) / np.sqrt(input_size + hidden_state_size))
+        self.bias_ih = nn.Parameter(torch.zeros(1, 3*hidden_state_size))
+        self.bias_hh = nn.Parameter(torch.zeros(1, 3*hidden_state_size))
+        return
+
+    def forward(self, x, state_old, input_projection=None):
+        """
+        Args:
+            x: tensor with shape [batch_size, inputSize]
+            state_old: tensor with shape [batch_size, hidden_state_sizes]
+            input_projection: If not None, x @ W_ih + bias_ih of the three gates from TokenGateTable (decoding), x is
+                              not used
+
+        Returns:
+            state_new: The updated hidden state of the recurrent cell. Shape [batch_size, hidden_state_sizes]
+
+        """
+        if self.quantized_weights is None:
+            # F.linear and not addmm(bias, input, weight.t()), autocast caches the cast of the weight once
+            gates_h = F.linear(state_old, self.weight_hh, self.bias_hh)
+        else:
+            gates_h = torch.ops.quantized.linear_dynamic(state_old, self.quantized_weights['weight_hh'])
+        if input_projection is not None:
+            gates_x = input_projection
+        elif self.quantized_weights is None:
+            gates_x = F.linear(x, self.weight_ih, self.bias_ih)
+        else:
+            gates_x = torch.ops.quantized.linear_dynamic(x, self.quantized_weights['weight_ih'])
+        reset_x, update_x, candidate_x = torch.chunk(gates_x, 3, dim=1)
+        reset_h, update_h, candidate_h = torch.chunk(gates_h, 3, dim=1)
+
+        reset = torch.sigmoid(reset_x + reset_h)
+        update = torch.sigmoid(update_x + update_h)
+        cand_hidden = torch.tanh(candidate_x + reset * candidate_h)
+
+        state_new = update * state_old + (1 - update) * cand_hidden
+        return state_new
+
+    def input_projection(self):
+        """
+        Returns:
+            weight, bias: self.weight_ih transposed to shape[inputSize, 3*hidden_state_sizes] and bias_ih, see
+                          TokenGateTable
+        """
+        return self.weight_ih.t(), self.bias_ih[0]
+
+    def quantize_dynamic(self):
+        """
+        int8 weights (with the biases) for CPU decoding, see quantize_dynamic_int8.
+        """
+        self.quantized_weights = {'weight_ih': pack_int8(self.weight_ih, self.bias_ih[0]),
+                                  'weight_hh': pack_int8(self.weight_hh, self.bias_hh[0])}
+        return
+
+    def native_weights(self):
+        """
+        Returns:
+            weight_ih, weight_hh, bias_ih, bias_hh: the weights in the layout of nn.GRU (the parameters themselves)
+        """
+        return self.weight_ih, self.weight_hh, self.bias_ih[0], self.bias_hh[0]
+
+    def load_native_weights(self, weight_ih, weight_hh, bias_ih, bias_hh):
+        """
+        Copy weights in the layout of nn.GRU into the cell, inverse of native_weights.
+        """
+        with torch.no_grad():
+            self.weight_ih.copy_(weight_ih)
+            self.weight_hh.copy_(weight_hh)
+            self.bias_ih.copy_(bias_ih[None])
+            self.bias_hh.copy_(bias_hh[None])
+
 
 ######################################################################################################################
 class RNNsimpleCell(nn.Module):
+    native_mode = 'RNN_TANH'  # same equations as nn.RNN with tanh, see native_weights
+    quantized_weights = None  # int8 weights for decoding, see quantize_dynamic_int8
+
     def __init__(self, hidden_state_size, input_size):
         super(RNNsimpleCell, self).__init__()
         """
@@ -387,6 +1173,7 @@ class RNNsimpleCell(nn.Module):
         Tips:
             Variance scaling:  Var[W] = 1/n
         """
+        self.input_size = input_size
         self.hidden_state_size = hidden_state_size
 
         self.weight = nn.Parameter(
@@ -394,24 +1181,63 @@ class RNNsimpleCell(nn.Module):
         self.bias = nn.Parameter(torch.zeros(1, hidden_state_size))
         return
 
-    def forward(self, x, state_old):
+    def forward(self, x, state_old, input_projection=None):
         """
         Args:
             x: tensor with shape [batch_size, inputSize]
             state_old: tensor with shape [batch_size, hidden_state_sizes]
+            input_projection: If not None, x @ W_x + bias from TokenGateTable (decoding), x is not used
 
         Returns:
             state_new: The updated hidden state of the recurrent cell. Shape [batch_size, hidden_state_sizes]
 
         """
+        if input_projection is not None:
+            return torch.tanh(projected_mm(self, state_old, 'weight', input_projection))
+
         x2 = torch.cat((x, state_old), dim=1)
-        state_new = torch.tanh(torch.mm(x2, self.weight) + self.bias)
+        state_new = torch.tanh(cell_mm(self, x2, 'weight', self.bias))
         return state_new
 
+    def input_projection(self):
+        """
+        Returns:
+            weight, bias: The rows of self.weight applied to the cell input x, shape[inputSize, hidden_state_sizes],
+                          and the bias, see TokenGateTable
+        """
+        return self.weight[:self.input_size], self.bias[0]
+
+    def quantize_dynamic(self):
+        """
+        int8 weights for CPU decoding, used by cell_mm, see quantize_dynamic_int8.
+        """
+        self.quantized_weights = {'weight': pack_int8(self.weight.t())}
+        return
+
+    def native_weights(self):
+        """
+        Returns:
+            weight_ih, weight_hh, bias_ih, bias_hh: the weights in the layout of nn.RNN (tanh nonlinearity), still
+                                                    connected to self.weight and self.bias in the autograd graph
+        """
+        weight_ih = self.weight[:self.input_size].t()
+        weight_hh = self.weight[self.input_size:].t()
+        return weight_ih, weight_hh, self.bias[0], torch.zeros_like(self.bias[0])
+
+    def load_native_weights(self, weight_ih, weight_hh, bias_ih, bias_hh):
+        """
+        Copy weights in the layout of nn.RNN (tanh nonlinearity) into the cell, inverse of native_weights.
+        """
+        with torch.no_grad():
+            self.weight.copy_(torch.cat((weight_ih, weight_hh), dim=1).t())
+            self.bias.copy_((bias_ih + bias_hh)[None])
+
 
 ######################################################################################################################
 
 class LSTMCell(nn.Module):
+    native_mode = None  # the gates also see the memory cell, which nn.LSTM does not support
+
     def __init__(self, hidden_state_size, input_size):
         super(LSTMCell, self).__init__()
         """
@@ -459,6 +1285,83 @@ class LSTMCell(nn.Module):
         return state_new
 
 
+######################################################################################################################
+def native_rnn_module(cells):
+    """
+    torch.nn.RNN/GRU/LSTM with the same structure as "cells", created on the meta device so it holds no weights of its
+    own. It is evaluated with torch.func.functional_call and the weights of the cells, see native_rnn_forward.
+
+    Args:
+        cells: nn.ModuleList of cells with a torch.nn equivalent ("native_mode" is not None)
+
+    Returns:
+        native_rnn: weightless nn.RNN, nn.GRU or nn.LSTM, batch_first=True
+    """
+    native_mode = cells[0].native_mode
+    if native_mode is None:
+        raise ValueError(f'{type(cells[0]).__name__} has no torch.nn equivalent, use rnnBackend "custom" or gruLayout "standard"')
+
+    native_class = {'RNN_TANH': nn.RNN, 'GRU': nn.GRU, 'LSTM': nn.LSTM}[native_mode]
+    return native_class(cells[0].input_size, cells[0].hidden_state_size, num_layers=len(cells), batch_first=True,
+                        device='meta')
+
+
+def native_weights(cells):
+    """
+    Returns:
+        params: the weights of "cells" named as the parameters of the torch.nn module from native_rnn_module
+    """
+    params = {}
+    for layer, cell in enumerate(cells):
+        for name, weight in zip(['weight_ih', 'weight_hh', 'bias_ih', 'bias_hh'], cell.native_weights()):
+            params[f'{name}_l{layer}'] = weight
+    return params
+
+
+def native_rnn_forward(native_rnn, cells, inputs, initial_hidden_state):
+    """
+    Run the whole sequence on the fused torch.nn kernel with the weights of "cells" (gradients flow back to the cells).
+
+    Args:
+        native_rnn          : module from native_rnn_module(cells)
+        cells               : nn.ModuleList of cells
+        inputs              : shape[batch_size, truncated_backprop_length, input_size]
+        initial_hidden_state: shape[num_rnn_layers, batch_size, hidden_state_size] (2*hidden_state_size for LSTM)
+
+    Returns:
+        hidden_states: Last layer hidden states, shape[batch_size, truncated_backprop_length, hidden_state_size]
+        current_state: shape[num_rnn_layers, batch_size, hidden_state_size] (2*hidden_state_size for LSTM)
+    """
+    if cells[0].native_mode == 'LSTM':
+        hx = tuple(torch.chunk(initial_hidden_state, 2, dim=2))
+        hidden_states, (h_n, c_n) = functional_call(native_rnn, native_weights(cells), (inputs, hx))
+        return hidden_states, torch.cat((h_n, c_n), dim=2)
+
+    return functional_call(native_rnn, native_weights(cells), (inputs, initial_hidden_state.contiguous()))
+
+
+def cells_to_native(cells):
+    """
+    Returns:
+        native_rnn: a stand-alone torch.nn RNN/GRU/LSTM holding a copy of the weights of "cells"
+    """
+    native_rnn = native_rnn_module(cells)
+    native_rnn = native_rnn.to_empty(device=cells[0].native_weights()[0].device)
+    with torch.no_grad():
+        for name, weight in native_weights(cells).items():
+            getattr(native_rnn, name).copy_(weight)
+    return native_rnn
+
+
+def native_to_cells(native_rnn, cells):
+    """
+    Copy the weights of a torch.nn RNN/GRU/LSTM into "cells", inverse of cells_to_native.
+    """
+    for layer, cell in enumerate(cells):
+        cell.load_native_weights(*[getattr(native_rnn, f'{name}_l{layer}') for name in ['weight_ih', 'weight_hh', 'bias_ih', 'bias_hh']])
+    return cells
+
+
 ######################################################################################################################
 def loss_fn(logits, yTokens, yWeights):
     """
@@ -489,6 +1392,147 @@ def loss_fn(logits, yTokens, yWeights):
 
     return sumLoss, meanLoss
 
+
+######################################################################################################################
+def masked_loss_fn(hidden_states, outputLayer, yTokens, yWeights, chunk_size=None):
+    """
+    Weighted softmax cross entropy loss computed only on the positions where "yWeights" is nonzero.
+
+    The hidden states of the non-padded positions are gathered and projected through "outputLayer" in one matrix
+    multiplication, the full logits tensor shape[batch_size, truncated_backprop_length, vocabulary_size] is never built.
+
+    Args:
+        hidden_states   : Last layer hidden states, shape[batch_size, truncated_backprop_length, hidden_state_sizes]
+        outputLayer     : handle to the last fully connected layer (an instance of nn.Linear)
+        yTokens (labels): Shape[batch_size, truncated_backprop_length]
+        yWeights        : Shape[batch_size, truncated_backprop_length]
+        chunk_size      : If not None, the output layer and the cross entropy are evaluated in blocks of "chunk_size"
+                          tokens with ChunkedLinearCrossEntropy, which does not store the logits for the backward pass.
+                          Not used with the adaptive softmax, which computes its own loss.
+
+    Returns:
+        sumLoss: The total cross entropy loss for all words
+        meanLoss: The averaged cross entropy loss for all words
+    """
+    eps = 0.0000000001  # used to not divide on zero
+
+    yWeights = yWeights.reshape(-1)
+    valid    = yWeights.nonzero().squeeze(1)
+
+    hidden_states = hidden_states.reshape(-1, hidden_states.shape[2]).index_select(0, valid)
+    yTokens       = yTokens.reshape(-1).index_select(0, valid)
+    # the output layer follows autocast (mixedPrecision), the cross entropy is computed in float32
+    if isinstance(outputLayer, nn.AdaptiveLogSoftmaxWithLoss):
+        losses = -outputLayer(hidden_states, yTokens).output.float()
+    elif chunk_size is None:
+        losses = F.cross_entropy(input=outputLayer(hidden_states).float(), target=yTokens, reduction='none')
+    else:
+        # the blocks are computed in float32, the memory saving comes from not storing the logits
+        with torch.autocast(device_type=hidden_states.device.type, enabled=False):
+            losses = ChunkedLinearCrossEntropy.apply(hidden_states.float(), outputLayer.weight, outputLayer.bias,
+                                                     yTokens, chunk_size)
+
+    sumLoss  = (losses * yWeights.index_select(0, valid)).sum()
+    meanLoss = sumLoss / (yWeights.sum() + eps)
+
+    return sumLoss, meanLoss
+
+
+######################################################################################################################
+def output_logits(outputLayer, hidden):
+    """
+    Args:
+        outputLayer: nn.Linear or nn.AdaptiveLogSoftmaxWithLoss
+        hidden     : shape[batch_size, hidden_state_sizes]
+
+    Returns:
+        logits: shape[batch_size, vocabulary_size] (log-probabilities for the adaptive softmax)
+    """
+    if isinstance(outputLayer, nn.AdaptiveLogSoftmaxWithLoss):
+        return outputLayer.log_prob(hidden)
+    return outputLayer(hidden)
+
+
+def output_tokens(outputLayer, hidden):
+    """
+    Greedy (argmax) token prediction. The adaptive softmax only evaluates a tail cluster for the rows where
+    the cluster wins in the head.
+
+    Args:
+        outputLayer: nn.Linear or nn.AdaptiveLogSoftmaxWithLoss
+        hidden     : shape[batch_size, hidden_state_sizes]
+
+    Returns:
+        tokens: shape[batch_size]
+    """
+    if isinstance(outputLayer, nn.AdaptiveLogSoftmaxWithLoss):
+        return outputLayer.predict(hidden)
+    return torch.argmax(outputLayer(hidden), dim=1)
+
+
+def output_log_probs(outputLayer, hidden):
+    """
+    Args:
+        outputLayer: nn.Linear or nn.AdaptiveLogSoftmaxWithLoss
+        hidden     : shape[batch_size, hidden_state_sizes]
+
+    Returns:
+        log_probs: The log-probabilities of all tokens, shape[batch_size, vocabulary_size]
+    """
+    if isinstance(outputLayer, nn.AdaptiveLogSoftmaxWithLoss):
+        return outputLayer.log_prob(hidden)
+    return torch.log_softmax(outputLayer(hidden), dim=1)
+
+
+######################################################################################################################
+class ChunkedLinearCrossEntropy(torch.autograd.Function):
+    """
+    Fused output layer and softmax cross entropy, evaluated in blocks of "chunk_size" tokens.
+
+    Only the log-sum-exp per token is kept for the backward pass, the logits of each block are recomputed there instead
+    of storing the full [number_of_tokens, vocabulary_size] logits and softmax. The losses and gradients are the same as
+    for F.cross_entropy(F.linear(hidden, weight, bias), target, reduction='none').
+    """
+
+    @staticmethod
+    def forward(ctx, hidden, weight, bias, target, chunk_size):
+        losses = hidden.new_empty(hidden.shape[0])
+        lse    = hidden.new_empty(hidden.shape[0])
+        for start in range(0, hidden.shape[0], chunk_size):
+            end    = start + chunk_size
+            logits = F.linear(hidden[start:end], weight, bias)
+            lse[start:end]    = torch.logsumexp(logits, dim=1)
+            losses[start:end] = lse[start:end] - logits.gather(1, target[start:end, None]).squeeze(1)
+
+        ctx.save_for_backward(hidden, weight, bias, target, lse)
+        ctx.chunk_size = chunk_size
+        return losses
+
+    @staticmethod
+    def backward(ctx, grad_losses):
+        hidden, weight, bias, target, lse = ctx.saved_tensors
+
+        grad_hidden = torch.empty_like(hidden) if ctx.needs_input_grad[0] else None
+        grad_weight = torch.zeros_like(weight) if ctx.needs_input_grad[1] else None
+        grad_bias   = torch.zeros_like(bias) if bias is not None and ctx.needs_input_grad[2] else None
+
+        for start in range(0, hidden.shape[0], ctx.chunk_size):
+            end    = start + ctx.chunk_size
+            chunk  = hidden[start:end]
+            # d loss / d logits = softmax - one_hot(target)
+            grad_logits = torch.exp(F.linear(chunk, weight, bias) - lse[start:end, None])
+            grad_logits[torch.arange(chunk.shape[0], device=chunk.device), target[start:end]] -= 1
+            grad_logits *= grad_losses[start:end, None]
+
+            if grad_hidden is not None:
+                grad_hidden[start:end] = grad_logits.mm(weight)
+            if grad_weight is not None:
+                grad_weight += grad_logits.t().mm(chunk)
+            if grad_bias is not None:
+                grad_bias += grad_logits.sum(dim=0)
+
+        return grad_hidden, grad_weight, grad_bias, None, None
+
 # ########################################################################################################################
 # if __name__ == '__main__':
 #
@@ -0,0 +1,372 @@
+import asyncio
+import base64
+import collections
+import json
+import sys
+import time
+
+import numpy as np
+import torch
+
+from utils.captionCache import CaptionCache, checkpointId
+# max length of a request line, the Task4 region features are ~400 kB base64 (the asyncio default is 64 kB)
+STREAM_LIMIT = 2**24
+
+
+#######################################################################################################################
+class CaptionServer():
+    """
+    Micro-batching caption inference around a restored utils.model.Model.
+
+    Concurrent requests are queued, the batching loop takes the first waiting request and then collects more for at
+    most max_wait_ms or until max_batch_size requests are together, runs one batched model.net.generate and hands every
+    request its own caption. The decoding runs in a worker thread, so the event loop keeps accepting requests meanwhile.
+
+    Requests with different cnn feature shapes (e.g. a different number of regions) are decoded in separate batches.
+
+    With continuous=True a batch does not wait for its longest caption: the decoding runs step by step
+    (model.net.encode / model.net.step) and when a row emits the end token (or reaches max_length) its request is
+    answered and its slot is refilled with a waiting request at the next step. max_wait_ms is not used then.
+
+    With cache_size > 0 the captions are cached by the hash of the cnn features (see utils.captionCache), a repeated
+    image is answered without decoding and a request for an image which is being decoded waits for that caption.
+    """
+    def __init__(self, model, max_batch_size=64, max_wait_ms=5.0, start_token=1, end_token=0, TokenToWord=None,
+                 latency_window=10000, continuous=False, max_length=40, cache_size=0, cache_path=None):
+        """
+        Args:
+            model         : instance of utils.model.Model (trained weights restored)
+            max_batch_size: Max number of requests decoded together
+            max_wait_ms   : Max time the first request of a batch waits for more requests
+            start_token   : The token fed in first ('ssss')
+            end_token     : The caption ends before this token ('eeee')
+            TokenToWord   : If not None, the vocabulary from loadVocabulary, the captions are also returned as text
+            latency_window: Number of latest requests the latency percentiles are computed from
+            continuous    : Continuous batching, finished rows are refilled with new requests at every step
+            max_length    : Continuous batching, max number of tokens of a caption (40 as in RNN.forward)
+            cache_size    : Max number of cached captions, 0: no cache
+            cache_path    : If not None, the cache is loaded from and saved (in stop()) to this file
+        """
+        self.model          = model
+        self.max_batch_size = max_batch_size
+        self.max_wait       = max_wait_ms / 1000
+        self.start_token    = start_token
+        self.end_token      = end_token
+        self.TokenToWord    = TokenToWord
+        self.continuous     = continuous
+        self.max_length     = max_length
+
+        self.cache = None
+        if cache_size > 0:
+            # the checkpoint and every setting the captions depend on is part of the cache key
+            settings   = {'start_token': start_token, 'end_token': end_token, 'max_length': max_length,
+                          'config': getattr(model.net, 'config', None)}
+            self.cache = CaptionCache(checkpointId(model.net), settings, cache_size, cache_path)
+        self.decoding  = {}  # cache key -> future of the requests being decoded
+        self.coalesced = 0  # requests which waited for the decoding of the same image by another request
+
+        self.running     = None  # continuous batching, the rows being decoded, only used by the worker thread
+        self.queue       = None  # created in start(), it belongs to the running event loop
+        self.task        = None
+        self.requests    = 0
+        self.batch_sizes = collections.Counter()
+        self.latencies   = collections.deque(maxlen=latency_window)
+        return
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        loop = self.continuous_loop() if self.continuous else self.batching_loop()
+        self.task  = asyncio.get_running_loop().create_task(loop)
+        return
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        if self.cache is not None:
+            self.cache.save()
+        return
+
+    async def caption(self, cnn_features):
+        """
+        Args:
+            cnn_features: Features of one image, tensor or array, shape[number_of_cnn_features]
+                          (shape[number_of_regions, number_of_cnn_features] for Task4)
+
+        Returns:
+            tokens : The caption tokens, without the end token
+            caption: The caption text if the server has the vocabulary, else None
+        """
+        cnn_features = torch.as_tensor(cnn_features, dtype=torch.float32)
+        if self.cache is None:
+            future = asyncio.get_running_loop().create_future()
+            await self.queue.put((cnn_features, time.perf_counter(), future))
+            return await future
+
+        key = self.cache.key(cnn_features)
+        if key in self.decoding:
+            self.coalesced += 1
+            return await asyncio.shield(self.decoding[key])
+        caption = self.cache.get(key)
+        if caption is not None:
+            return caption
+
+        future = asyncio.get_running_loop().create_future()
+        self.decoding[key] = future
+        try:
+            await self.queue.put((cnn_features, time.perf_counter(), future))
+            caption = await future
+        finally:
+            del self.decoding[key]
+        self.cache.put(key, caption)
+        return caption
+
+    async def batching_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch    = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            shapes = collections.defaultdict(list)
+            for request in batch:
+                shapes[tuple(request[0].shape)].append(request)
+            for requests in shapes.values():
+                try:
+                    captions = await loop.run_in_executor(None, self.decode, [request[0] for request in requests])
+                except Exception as error:
+                    for _, _, future in requests:
+                        if not future.done():
+                            future.set_exception(error)
+                    continue
+                now = time.perf_counter()
+                self.batch_sizes[len(requests)] += 1
+                for (_, arrival, future), caption in zip(requests, captions):
+                    self.requests += 1
+                    self.latencies.append(now - arrival)
+                    if not future.done():
+                        future.set_result(caption)
+
+    async def continuous_loop(self):
+        loop    = asyncio.get_running_loop()
+        waiting = collections.deque()
+        slots   = []  # (arrival, future, tokens) of the running rows, in the row order of self.running
+        while True:
+            if not slots and not waiting:
+                waiting.append(await self.queue.get())
+            while not self.queue.empty():
+                waiting.append(self.queue.get_nowait())
+
+            # a request joins if its features have the shape of the running rows
+            joining = []
+            while waiting and len(slots) + len(joining) < self.max_batch_size:
+                rows = slots + joining
+                if rows and waiting[0][0].shape != rows[0][0].shape:
+                    break
+                joining.append(waiting.popleft())
+            slots += [(features, arrival, future, []) for features, arrival, future in joining]
+
+            try:
+                tokens, finished = await loop.run_in_executor(None, self.decode_step,
+                                                              [request[0] for request in joining])
+            except Exception as error:
+                for _, _, future, _ in slots:
+                    if not future.done():
+                        future.set_exception(error)
+                slots = []
+                self.running = None
+                continue
+            now = time.perf_counter()
+            self.batch_sizes[len(slots)] += 1
+
+            remaining = []
+            for slot, token, done in zip(slots, tokens, finished):
+                _, arrival, future, caption = slot
+                if token != self.end_token:
+                    caption.append(token)
+                if not done:
+                    remaining.append(slot)
+                    continue
+                self.requests += 1
+                self.latencies.append(now - arrival)
+                if not future.done():
+                    future.set_result(self.caption_text(caption))
+            slots = remaining
+
+    def decode_step(self, features):
+        """
+        One step of the continuous batching, runs in the worker thread. The new requests are encoded and appended to
+        the running rows, the finished rows are removed after the step.
+
+        Args:
+            features: list of cnn features of the requests joining the batch (can be empty)
+
+        Returns:
+            tokens  : list of the predicted token of every running row (joined ones last)
+            finished: list of bool, the row emitted the end token or reached max_length
+        """
+        net = self.model.net
+        # select_context and cat_contexts of the model file the net comes from, it is chosen by the caller
+        modelFile = sys.modules[type(net).__module__]
+        with torch.inference_mode():
+            if len(features) > 0:
+                context = net.encode(torch.stack(features).to(self.model.device))
+                state   = net.get_initial_hidden_state(context['imgfeat'])
+                inputs  = torch.full((len(features),), self.start_token, dtype=torch.long, device=self.model.device)
+                lengths = torch.zeros(len(features), dtype=torch.long, device=self.model.device)
+                if self.running is None:
+                    self.running = (context, state, inputs, lengths)
+                else:
+                    running_context, running_state, running_inputs, running_lengths = self.running
+                    self.running = (modelFile.cat_contexts([running_context, context]),
+                                    torch.cat([running_state, state], dim=1),
+                                    torch.cat([running_inputs, inputs]),
+                                    torch.cat([running_lengths, lengths]))
+
+            context, state, inputs, lengths = self.running
+            logits, state = net.step(context, state, inputs)
+            tokens   = torch.argmax(logits, dim=1)
+            lengths  = lengths + 1
+            finished = (tokens == self.end_token) | (lengths >= self.max_length)
+
+            active = ~finished
+            if not bool(active.any()):
+                self.running = None
+            elif bool(finished.any()):
+                self.running = (modelFile.select_context(context, active), state[:, active], tokens[active], lengths[active])
+            else:
+                self.running = (context, state, tokens, lengths)
+        return tokens.cpu().tolist(), finished.cpu().tolist()
+
+    def caption_text(self, tokens):
+        text = None if self.TokenToWord is None else ' '.join(self.TokenToWord[token] for token in tokens)
+        return tokens, text
+
+    def decode(self, features):
+        """
+        One batched greedy decoding, runs in the worker thread.
+
+        Args:
+            features: list of cnn features of the same shape
+
+        Returns:
+            captions: list of (tokens, caption text or None)
+        """
+        # the grad mode is per thread
+        with torch.inference_mode():
+            cnn_features = torch.stack(features).to(self.model.device)
+            xTokens = torch.full((len(features), 1), self.start_token, dtype=torch.long, device=self.model.device)
+            tokens, _ = self.model.net.generate(cnn_features, xTokens)
+        captions = []
+        for row in tokens.cpu().tolist():
+            if self.end_token in row:
+                row = row[:row.index(self.end_token)]
+            captions.append(self.caption_text(row))
+        return captions
+
+    def stats(self):
+        """
+        Returns:
+            stats: queue depth, number of requests, batch size distribution and latency percentiles
+                   (with continuous batching a batch is one step, its size the number of running rows),
+                   the requests and latencies are of the decoded captions, the cache stats are under "cache"
+        """
+        latencies = 1000*np.array(self.latencies) if len(self.latencies) > 0 else np.zeros(1)
+        batches   = sum(self.batch_sizes.values())
+        return {
+            'queue_depth': 0 if self.queue is None else self.queue.qsize(),
+            'requests': self.requests,
+            'batches': batches,
+            'mean_batch_size': sum(size*count for size, count in self.batch_sizes.items()) / max(batches, 1),
+            'batch_sizes': {size: self.batch_sizes[size] for size in sorted(self.batch_sizes)},
+            'latency_p50_ms': float(np.percentile(latencies, 50)),
+            'latency_p99_ms': float(np.percentile(latencies, 99)),
+            'cache': None if self.cache is None else dict(self.cache.stats(), coalesced=self.coalesced),
+        }
+
+    async def handle_connection(self, reader, writer):
+        """
+        JSON lines protocol, one request per line:
+            {"id": .., "shape": [..], "features": base64 of the float32 cnn features}
+                -> {"id": .., "tokens": [..], "caption": ".." or null} or {"id": .., "error": ".."}
+            {"id": .., "op": "stats"} -> {"id": .., **the stats dict}
+        The responses of one connection come back in the order the captions finish, matched by "id".
+        """
+        lock    = asyncio.Lock()
+        pending = set()
+
+        async def respond(message):
+            async with lock:
+                writer.write((json.dumps(message) + '\n').encode())
+                await writer.drain()
+
+        async def answer(request):
+            try:
+                features = np.frombuffer(base64.b64decode(request['features']), dtype=np.float32).copy()
+                tokens, caption = await self.caption(features.reshape(request['shape']))
+                await respond({'id': request.get('id'), 'tokens': tokens, 'caption': caption})
+            except Exception as error:
+                await respond({'id': request.get('id'), 'error': str(error)})
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = json.loads(line)
+                if request.get('op') == 'stats':
+                    await respond(dict(self.stats(), id=request.get('id')))
+                else:
+                    task = asyncio.get_running_loop().create_task(answer(request))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.wait(pending)
+        finally:
+            writer.close()
+        return
+
+    async def serve(self, host='127.0.0.1', port=8765, stats_interval=None):
+        """
+        Serve the JSON lines protocol (see handle_connection) on host:port until cancelled.
+
+        Args:
+            stats_interval: If not None, print the stats every stats_interval seconds
+        """
+        await self.start()
+        server = await asyncio.start_server(self.handle_connection, host, port, limit=STREAM_LIMIT)
+        print(f'caption server on {host}:{port}, max_batch_size={self.max_batch_size}, '
+              f'max_wait_ms={1000*self.max_wait:.1f}, continuous={self.continuous}')
+        try:
+            async with server:
+                if stats_interval is None:
+                    await server.serve_forever()
+                else:
+                    while True:
+                        await asyncio.sleep(stats_interval)
+                        print(self.stats())
+        finally:
+            await self.stop()
+        return
+
+
+def encodeRequest(cnn_features, request_id=None):
+    """
+    A request line of the JSON lines protocol of CaptionServer for one image.
+
+    Args:
+        cnn_features: array, shape[number_of_cnn_features] (or shape[number_of_regions, number_of_cnn_features])
+        request_id  : Returned with the response
+    """
+    features = np.ascontiguousarray(cnn_features, dtype=np.float32)
+    return json.dumps({'id': request_id, 'shape': list(features.shape),
+                       'features': base64.b64encode(features.tobytes()).decode('ascii')}) + '\n'
@@ -89,14 +89,23 @@ class Trainer():
                     logits, current_hidden_state_Ref = model.net(cnn_features, xTokens,  is_train, current_hidden_state.detach())
                 '''
                 
-                logits, current_hidden_state = model.net(cnn_features, xTokens,  is_train)
-                sumLoss, meanLoss = model.loss_fn(logits, yTokens, yWeights)
+                # mixed precision if model.amp_dtype is not None, see Model
+                with torch.autocast(device_type=model.amp_device_type, dtype=model.amp_dtype, enabled=model.amp_dtype is not None):
+                    if is_train:
+                        # teacher forcing, the output layer is only applied to the non-padded positions
+                        sumLoss, meanLoss, current_hidden_state = model.net.forward_loss(cnn_features, xTokens, yTokens, yWeights)
+                    else:
+                        logits, current_hidden_state = model.net(cnn_features, xTokens,  is_train)
+                        with torch.autocast(device_type=model.amp_device_type, enabled=False):
+                            sumLoss, meanLoss = model.loss_fn(logits.float(), yTokens, yWeights)
                 
                 
                 if mode == 'train':
                     model.optimizer.zero_grad()
-                    meanLoss.backward(retain_graph=False)
-                    model.optimizer.step()
+                    # the scaler only scales with float16, otherwise this is meanLoss.backward() and optimizer.step()
+                    model.scaler.scale(meanLoss).backward(retain_graph=False)
+                    model.scaler.step(model.optimizer)
+                    model.scaler.update()
                     if model.scheduler is not None:
                         model.scheduler.step()
                 
@@ -7,7 +7,6 @@ import matplotlib.image as mpimg
 #from utils.metrics import BLEU, CIDEr, SPICE, ROUGE, METEOR
 
 def plotImagesAndCaptions(model, modelParam, config, dataLoader):
-    is_train = False
     # dataDict = next(iter(dataLoader.myDataDicts['val']))
 
     fig, ax = plt.subplots()
@@ -28,11 +27,11 @@ def plotImagesAndCaptions(model, modelParam, config, dataLoader):
         yWeights = dataDict['yWeights'][:, :, idx]
         cnn_features = dataDict['cnn_features']
         if idx == 0:
-            logits, current_hidden_state = model.net(cnn_features, xTokens, is_train)
-            predicted_tokens = logits.argmax(dim=2).detach().cpu()
+            tokens, current_hidden_state = model.net.generate(cnn_features, xTokens)
+            predicted_tokens = tokens.detach().cpu()
         else:
-            logits, current_hidden_state = model.net(cnn_features, xTokens, is_train, current_hidden_state)
-            predicted_tokens = torch.cat((predicted_tokens, logits.argmax(dim=2).detach().cpu()), dim=1)
+            tokens, current_hidden_state = model.net.generate(cnn_features, xTokens, current_hidden_state)
+            predicted_tokens = torch.cat((predicted_tokens, tokens.detach().cpu()), dim=1)
 
 
     vocabularyDict = loadVocabulary(modelParam['data_dir'])
@@ -1,13 +1,35 @@
+import asyncio
+import torch
+
 from utils.dataLoader import DataLoaderWrapper
 from utils.saverRestorer import SaverRestorer
 from utils.model import Model
 from utils.trainer import Trainer
 from utils.validate import plotImagesAndCaptions
 from utils.validate_metrics import validateCaptions
+from utils.generateVocabulary import loadVocabulary, adaptiveSoftmaxCutoffs
+from utils.onnxExport import exportOnnx, OnnxModel
+from utils.server import CaptionServer
 
-from cocoSource_xcnnfused import imageCaptionModel # here you plug in your modelfile depending on what you have developed: simple rnn, 2 layer, or attention, if you have 3 modelfiles a.py b.py c.py then you do: from a import ... or you have one file with n different imgcapmodels
+from cocoSource_xcnnfused import imageCaptionModel, quantize_dynamic_int8 # here you plug in your modelfile depending on what you have developed: simple rnn, 2 layer, or attention, if you have 3 modelfiles a.py b.py c.py then you do: from a import ... or you have one file with n different imgcapmodels
 
 def main(config, modelParam):
+    validation = modelParam['inference'] == True and modelParam['serve']['enabled'] == False
+    if validation and modelParam['onnx']['runtime'] == True and config.get('beamSize') is not None:
+        # checked before the restore, OnnxModel only exports the greedy decoding step
+        raise ValueError('modelParam["onnx"]["runtime"] supports greedy decoding only, set config["beamSize"] to None')
+
+    if modelParam['inference'] == True and modelParam['cuda']['use_cuda'] == False:
+        # cpu inference, the thread pools have to be set before torch runs anything in parallel
+        if modelParam['cpuThreads']['inter_op'] is not None:
+            torch.set_num_interop_threads(modelParam['cpuThreads']['inter_op'])
+        if modelParam['cpuThreads']['intra_op'] is not None:
+            torch.set_num_threads(modelParam['cpuThreads']['intra_op'])
+        print(f'CPU inference, intra-op threads: {torch.get_num_threads()}, inter-op threads: {torch.get_num_interop_threads()}')
+
+    if config['outputLayerType'] == 'adaptive' and config['adaptiveSoftmaxCutoffs'] is None:
+        config['adaptiveSoftmaxCutoffs'] = adaptiveSoftmaxCutoffs(loadVocabulary(modelParam['data_dir']), config['vocabulary_size'])
+
     # create an instance of the model you want
     model = Model(config, modelParam, imageCaptionModel)
 
@@ -16,6 +38,19 @@ def main(config, modelParam):
 
     if modelParam['inference'] == True:
         model        = saveRestorer.restore(model)
+        if modelParam['onnx']['export'] == True:
+            exportOnnx(model, modelParam['modelsDir']+modelParam['modelName']+'onnx/')
+        if modelParam['serve']['enabled'] == True:
+            # micro-batching caption server instead of the validation, see utils.server and load_generator.py
+            model.net.eval()
+            server = CaptionServer(model, modelParam['serve']['maxBatchSize'], modelParam['serve']['maxWaitMs'],
+                                   TokenToWord=loadVocabulary(modelParam['data_dir'])['TokenToWord'],
+                                   continuous=modelParam['serve']['continuous'],
+                                   cache_size=modelParam['serve']['cacheSize'],
+                                   cache_path=modelParam['serve']['cachePath'])
+            asyncio.run(server.serve(modelParam['serve']['host'], modelParam['serve']['port'],
+                                     modelParam['serve']['statsInterval']))
+            return
 
     # create your data generator
     dataLoader = DataLoaderWrapper(config, modelParam)
@@ -28,9 +63,26 @@ def main(config, modelParam):
 
     #plotImagesAndCaptions
     if modelParam['inference'] == True:
-        #plotImagesAndCaptions(model, modelParam, config, dataLoader)
-        validateCaptions(model, modelParam, config, dataLoader)
-        #plotImagesAndCaptions(model, modelParam, config, dataLoader)
+        model.net.eval()
+        if modelParam['onnx']['runtime'] == True:
+            # greedy decoding with onnxruntime on the exported graphs instead of model.net (no beam search, see main)
+            model = OnnxModel(modelParam['modelsDir']+modelParam['modelName']+'onnx/', modelParam['cpuThreads']['intra_op'])
+        with torch.inference_mode():
+            #plotImagesAndCaptions(model, modelParam, config, dataLoader)
+            resultsdict = validateCaptions(model, modelParam, config, dataLoader)
+            #plotImagesAndCaptions(model, modelParam, config, dataLoader)
+        if modelParam['cuda']['use_cuda'] == False:
+            print(f'captions per second per core: {resultsdict["captions_per_second"] / torch.get_num_threads():.2f}')
+
+        if modelParam['int8'] == True and modelParam['cuda']['use_cuda'] == False and modelParam['onnx']['runtime'] == False:
+            # validate again with int8 cells and output layer, and compare to the float model above
+            quantize_dynamic_int8(model.net)
+            with torch.inference_mode():
+                resultsdictInt8 = validateCaptions(model, modelParam, config, dataLoader)
+            print(f'{"":20s}{"float32":>10s}{"int8":>10s}')
+            for key in ['bleu_4', 'meteor', 'cider', 'captions_per_second']:
+                print(f'{key:20s}{resultsdict[key]:10.4f}{resultsdictInt8[key]:10.4f}')
+            print(f'int8 speedup: {resultsdictInt8["captions_per_second"] / resultsdict["captions_per_second"]:.2f}')
 
 
 
@@ -47,6 +99,20 @@ if __name__ == '__main__':
         'cuda': {'use_cuda': True,  # Use_cuda=True: use GPU
                  'device_idx': 0},  # Select gpu index: 0,1,2,3
         'numbOfCPUThreadsUsed': 10,  # Number of cpu threads use in the dataloader
+        'cpuThreads': {'intra_op': None,  # use_cuda=False: torch threads per operator (None: torch default)
+                       'inter_op': None},  # use_cuda=False: torch threads running operators in parallel
+        'onnx': {'export': False,  # export encoder.onnx and decoder_step.onnx to modelsDir/modelName/onnx/
+                 'runtime': False},  # greedy inference with onnxruntime on the exported graphs (cpu), needs beamSize None
+        'int8': False,  # use_cuda=False: also validate with dynamic int8 quantized cells and output layer, compare scores and speed
+        'serve': {'enabled': False,  # inference: serve captions over tcp instead of validating, see utils.server
+                  'host': '127.0.0.1',
+                  'port': 8765,
+                  'maxBatchSize': 64,  # max requests decoded together
+                  'maxWaitMs': 5.0,  # max time the first request of a batch waits for more requests
+                  'continuous': True,  # refill the rows of finished captions with new requests at every step
+                  'cacheSize': 100000,  # max cached captions of repeated images, 0: no cache
+                  'cachePath': None,  # file the caption cache is kept in between runs, None: in memory only
+                  'statsInterval': 10},  # seconds between printed queue depth, batch sizes and latencies, None: off
         'numbOfEpochs': 99,  # Number of epochs
         'data_dir': data_dir,  # data directory
         'img_dir': 'loss_images_test/',
@@ -75,6 +141,16 @@ if __name__ == '__main__':
         #'featurepathstub': 'detectron2m_features' ,
         #'featurepathstub': 'detectron2cocov3_tenmfeatures' ,
         'featurepathstub': 'detectron2_lim10maxfeatures' ,
+        'outputLayerType': 'linear',  # 'linear' | 'adaptive': adaptive softmax with clusters from the word frequencies
+        'adaptiveSoftmaxCutoffs': None,  # None: computed from vocabulary.pickle, see adaptiveSoftmaxCutoffs
+        'compileMode': None,  # None | 'default' | 'reduce-overhead' | 'max-autotune': torch.compile of the rnn step
+        'decodeTable': False,  # greedy decoding with a precomputed embedding to first layer gate table, see TokenGateTable
+        'endToken': 0,  # greedy decoding stops a caption at this token ('eeee', see generateVocabulary), None: 40 tokens
+        'beamSize': None,  # beams per image for beam search, validateCaptions then also reports greedy decoding
+        'lengthPenalty': 1.0,  # beam search ranks by log-probability sum / length**lengthPenalty
+        'metricProcesses': 4,  # validateCaptions scores BLEU, METEOR, CIDEr and ROUGE in parallel processes, 1: serial
+        'ciderIndexFile': 'ciderD_val.npz',  # CIDEr-D reference statistics saved in modelsDir, None: in memory only
+        'lstmLayout': 'memory',  # 'memory': the lstm gates also see the memory cell | 'standard': gates see [x, h]
         'cellType':  'LSTM' #'GRU'  # RNN or GRU or LSTM??
     }
 
@@ -1,5 +1,6 @@
 from torch import nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import torch
 import numpy as np
 torch.manual_seed(0)
@@ -19,9 +20,11 @@ class imageCaptionModel(nn.Module):
 
         Returns:
             self.Embedding  : An instance of nn.Embedding, shape[vocabulary_size, embedding_size]
-            self.inputlayer : An instance of nn.Linear, shape[number_of_cnn_features, hidden_state_sizes]
+            self.inputlayer : An instance of nn.Conv1d applied to every region, shape[number_of_cnn_features, nnmapsize]
+            self.attentionlayer: An instance of RegionAttention over the processed regions
             self.rnn        : An instance of RNN
             self.outputlayer: An instance of nn.Linear, shape[hidden_state_sizes, vocabulary_size]
+                              (nn.AdaptiveLogSoftmaxWithLoss if config['outputLayerType'] == 'adaptive')
         """
         self.config = config
         self.vocabulary_size = config['vocabulary_size']
@@ -30,11 +33,25 @@ class imageCaptionModel(nn.Module):
         self.hidden_state_sizes = config['hidden_state_sizes']
         self.num_rnn_layers = config['num_rnn_layers']
         self.cell_type = config['cellType']
-        self.last_layer_size = 10 + 2*config['hidden_state_sizes'] #+ self.embedding_size
+        self.loss_chunk_size = config.get('lossChunkSize', None)
+        self.output_layer_type = config.get('outputLayerType', 'linear')
+        self.compile_mode = config.get('compileMode', None)
+        self.checkpoint_segment = config.get('checkpointSegment', None)
+        self.decode_table           = config.get('decodeTable', False)
+        self.end_token              = config.get('endToken', None)
+        self.beam_size              = config.get('beamSize', None)
+        self.length_penalty         = config.get('lengthPenalty', 1.0)
+        self.lstm_layout = config.get('lstmLayout', 'memory')
+        self.attention_size = config.get('attentionSize', 256)
 
         self.Embedding = nn.Embedding(self.vocabulary_size, self.embedding_size)
 
-        self.outputlayer = nn.Linear(self.hidden_state_sizes, self.vocabulary_size)
+        if self.output_layer_type == 'adaptive':
+            # clusters from the word frequencies, see utils.generateVocabulary.adaptiveSoftmaxCutoffs
+            self.outputlayer = nn.AdaptiveLogSoftmaxWithLoss(self.hidden_state_sizes, self.vocabulary_size,
+                                                             cutoffs=config['adaptiveSoftmaxCutoffs'])
+        else:
+            self.outputlayer = nn.Linear(self.hidden_state_sizes, self.vocabulary_size)
         self.nnmapsize = 512  # the output size for the image features after the processing via self.inputLayer
 
         self.inputlayer = nn.Sequential(
@@ -44,14 +61,10 @@ class imageCaptionModel(nn.Module):
             nn.LeakyReLU()
         )
 
-        self.attentionlayer = nn.Sequential(
-            nn.MaxPool1d(10),
-            nn.Dropout(p=0.25),
-            nn.Linear(2*self.hidden_state_sizes, 50),
-            nn.LeakyReLU(),
-            nn.Linear(50, 10),
-            nn.Softmax()
-        )
+        # the layers above the first get [hidden state of the layer below, attended regions]
+        self.attentionlayer = RegionAttention(query_size=self.hidden_state_sizes, region_size=self.nnmapsize,
+                                              attention_size=self.attention_size)
+        self.last_layer_size = self.hidden_state_sizes + self.nnmapsize
 
         self.simplifiedrnn = False
 
@@ -70,18 +83,26 @@ class imageCaptionModel(nn.Module):
 
         else:
             self.rnn = RNN(input_size=self.embedding_size + self.nnmapsize, hidden_state_size=self.hidden_state_sizes,
-                           num_rnn_layers=self.num_rnn_layers, last_layer_size=self.last_layer_size, cell_type=self.cell_type)
+                           num_rnn_layers=self.num_rnn_layers, last_layer_size=self.last_layer_size, cell_type=self.cell_type,
+                           lstm_layout=self.lstm_layout)
+
+        if self.compile_mode is not None:
+            self.rnn.compiled_step = CompiledStep(self.rnn.step, self.compile_mode)
+        self.rnn.checkpoint_segment = self.checkpoint_segment
+        self.rnn.token_gate_table = TokenGateTable() if self.decode_table else None
 
         return
 
-    def forward(self, cnn_features, xTokens, is_train, current_hidden_state=None):
+    def forward(self, cnn_features, xTokens, is_train, current_hidden_state=None, encoded=None):
         """
         Args:
-            cnn_features        : Features from the CNN network, shape[batch_size, number_of_cnn_features]
+            cnn_features        : Features from the CNN network, shape[batch_size, number_of_regions, number_of_cnn_features]
             xTokens             : Shape[batch_size, truncated_backprop_length]
             is_train            : "is_train" is a flag used to select whether or not to use estimated token as input
             current_hidden_state: If not None, "current_hidden_state" should be passed into the rnn module
                                   shape[num_rnn_layers, batch_size, hidden_state_sizes]
+            encoded             : If not None, encode_regions(cnn_features) computed by the caller, so the TBPTT chunks
+                                  of a batch (without gradients) encode the regions once
 
         Returns:
             logits              : Shape[batch_size, truncated_backprop_length, vocabulary_size]
@@ -94,27 +115,216 @@ class imageCaptionModel(nn.Module):
         #print("cnn shape: ", cnn_features.shape)
 
 
-        imgfeat_processed = torch.squeeze(self.inputlayer(cnn_features.transpose(1,2)),2)
+        if encoded is None:
+            encoded = self.encode_regions(cnn_features)
+        imgfeat_processed, keys, regions = encoded
 
 
         if current_hidden_state is None:
-            if self.cell_type == 'LSTM':
-                initial_hidden_state = torch.zeros((self.num_rnn_layers, cnn_features.shape[0], 2*self.hidden_state_sizes),
-                                               device=torch.device('cuda'))
-            else:
-
-                initial_hidden_state = torch.zeros((self.num_rnn_layers, cnn_features.shape[0], self.hidden_state_sizes),
-                                               device=torch.device('cuda'))
+            initial_hidden_state = self.get_initial_hidden_state(cnn_features)
         else:
             initial_hidden_state = current_hidden_state
 
 
         # use self.rnn to calculate "logits" and "current_hidden_state"
         logits, current_hidden_state_out = self.rnn(xTokens, imgfeat_processed, initial_hidden_state, self.outputlayer, self.attentionlayer,
-                                                    self.Embedding, is_train)
+                                                    keys, regions, self.Embedding, is_train)
 
         return logits, current_hidden_state_out
 
+    def forward_loss(self, cnn_features, xTokens, yTokens, yWeights, current_hidden_state=None, encoded=None):
+        """
+        Teacher forced forward pass which computes the loss only on the non-padded positions.
+
+        Args:
+            cnn_features        : Features from the CNN network, shape[batch_size, number_of_regions, number_of_cnn_features]
+            xTokens             : Shape[batch_size, truncated_backprop_length]
+            yTokens             : Shape[batch_size, truncated_backprop_length]
+            yWeights            : Shape[batch_size, truncated_backprop_length]
+            current_hidden_state: If not None, "current_hidden_state" should be passed into the rnn module
+            encoded             : If not None, encode_regions(cnn_features) computed by the caller, so the TBPTT chunks
+                                  of a batch (without gradients) encode the regions once
+
+        Returns:
+            sumLoss             : The total cross entropy loss for all words
+            meanLoss            : The averaged cross entropy loss for all words
+            current_hidden_state: shape[num_rnn_layers, batch_size, hidden_state_sizes]
+        """
+        if encoded is None:
+            encoded = self.encode_regions(cnn_features)
+        imgfeat_processed, keys, regions = encoded
+
+        if current_hidden_state is None:
+            initial_hidden_state = self.get_initial_hidden_state(cnn_features)
+        else:
+            initial_hidden_state = current_hidden_state
+
+        # without an output layer the rnn returns the last layer hidden states instead of the logits
+        hidden_states, current_hidden_state_out = self.rnn(xTokens, imgfeat_processed, initial_hidden_state, None,
+                                                           self.attentionlayer, keys, regions, self.Embedding,
+                                                           is_train=True)
+
+        sumLoss, meanLoss = masked_loss_fn(hidden_states, self.outputlayer, yTokens, yWeights, self.loss_chunk_size)
+
+        return sumLoss, meanLoss, current_hidden_state_out
+
+    def generate(self, cnn_features, xTokens, current_hidden_state=None, encoded=None):
+        """
+        Greedy decoding which returns the predicted tokens instead of the logits.
+
+        Args:
+            cnn_features        : Features from the CNN network, shape[batch_size, number_of_regions, number_of_cnn_features]
+            xTokens             : Shape[batch_size, truncated_backprop_length], only the first token is used
+            current_hidden_state: If not None, "current_hidden_state" should be passed into the rnn module
+            encoded             : If not None, encode_regions(cnn_features) computed by the caller, so the TBPTT chunks
+                                  of a batch (without gradients) encode the regions once
+
+        Returns:
+            tokens              : The predicted tokens, shape[batch_size, 40]
+            current_hidden_state: shape[num_rnn_layers, batch_size, hidden_state_sizes]
+        """
+        if encoded is None:
+            encoded = self.encode_regions(cnn_features)
+        imgfeat_processed, keys, regions = encoded
+
+        if current_hidden_state is None:
+            initial_hidden_state = self.get_initial_hidden_state(cnn_features)
+        else:
+            initial_hidden_state = current_hidden_state
+
+        tokens, current_hidden_state_out = self.rnn(xTokens, imgfeat_processed, initial_hidden_state, self.outputlayer,
+                                                    self.attentionlayer, keys, regions, self.Embedding, is_train=False,
+                                                    return_tokens=True, end_token=self.end_token)
+
+        return tokens, current_hidden_state_out
+
+    def beam_search(self, cnn_features, xTokens, current_hidden_state=None, encoded=None):
+        """
+        Beam search decoding with config['beamSize'] beams per image, see the function beam_search. Same inputs and
+        outputs as generate.
+
+        Args:
+            cnn_features        : Features from the CNN network, shape[batch_size, number_of_regions, number_of_cnn_features]
+            xTokens             : Shape[batch_size, truncated_backprop_length], only the first token is used
+            current_hidden_state: If not None, "current_hidden_state" should be passed into the rnn module
+            encoded             : If not None, encode_regions(cnn_features) computed by the caller, so the TBPTT chunks
+                                  of a batch (without gradients) encode the regions once
+
+        Returns:
+            tokens              : The tokens of the best beam, shape[batch_size, 40]
+            current_hidden_state: shape[num_rnn_layers, batch_size, hidden_state_sizes]
+        """
+        if encoded is None:
+            encoded = self.encode_regions(cnn_features)
+        imgfeat_processed, keys, regions = encoded
+
+        if current_hidden_state is None:
+            initial_hidden_state = self.get_initial_hidden_state(cnn_features)
+        else:
+            initial_hidden_state = current_hidden_state
+
+        step = self.rnn.step if self.rnn.compiled_step is None else self.rnn.compiled_step
+        return beam_search(step, self.outputlayer, self.Embedding, xTokens[:, 0], imgfeat_processed,
+                           initial_hidden_state, self.hidden_state_sizes, self.beam_size, 40, self.end_token,
+                           self.length_penalty, self.attentionlayer, keys, regions)
+
+    def encode(self, cnn_features):
+        """
+        Step-wise decoding, the per image part: computed once per image and reused by every step(), so a caller (e.g. a
+        server streaming the tokens) can run the time loop itself. The rows of a context can be selected or
+        concatenated with select_context and cat_contexts.
+
+        Args:
+            cnn_features: Features from the CNN network, shape[batch_size, number_of_regions, number_of_cnn_features]
+
+        Returns:
+            context: dict with the processed image features "imgfeat", shape[batch_size, nnmapsize],
+                     the attention keys "keys" and the processed regions "regions" (see encode_regions)
+                     and with decodeTable the image part of the first layer input projection "image_projection"
+                     (else None), see TokenGateTable
+        """
+        imgfeat_processed, keys, regions = self.encode_regions(cnn_features)
+        context = {'imgfeat': imgfeat_processed, 'keys': keys, 'regions': regions}
+
+        image_projection = None
+        if self.rnn.token_gate_table is not None and not torch.is_grad_enabled():
+            image_projection = self.rnn.token_gate_table.image_projection(self.rnn.cells[0], self.Embedding,
+                                                                          context['imgfeat'])
+        context['image_projection'] = image_projection
+        return context
+
+    def step(self, context, state, tokens):
+        """
+        Step-wise decoding, one time step for every row of the context.
+
+        Args:
+            context: From encode
+            state  : The state returned by the previous step, None: the initial state (zeros)
+            tokens : The input tokens, the start token in the first step, shape[batch_size]
+
+        Returns:
+            logits : The logits of the next token (log-probabilities for the adaptive softmax),
+                     shape[batch_size, vocabulary_size]
+            state  : shape[num_rnn_layers, batch_size, hidden_state_sizes]
+        """
+        if state is None:
+            state = self.get_initial_hidden_state(context['imgfeat'])
+
+        if context['image_projection'] is not None:
+            tokens_vector    = None
+            input_projection = context['image_projection'] + self.rnn.token_gate_table.lookup(tokens)
+        else:
+            tokens_vector    = self.Embedding(tokens)
+            input_projection = None
+
+        step  = self.rnn.step if self.rnn.compiled_step is None else self.rnn.compiled_step
+        state = step(tokens_vector, context['imgfeat'], state, self.attentionlayer, context['keys'], context['regions'],
+                     input_projection)
+        return output_logits(self.outputlayer, state[-1, :, :self.hidden_state_sizes]), state
+
+    def encode_regions(self, cnn_features):
+        """
+        The per image part of the network: the processed regions (the attention values), their attention keys and the
+        mean over the regions as the image feature of the first rnn layer. Computed once per call, not per time step;
+        a caller running several TBPTT chunks of the same batch can compute it once and pass it as "encoded" to
+        forward/generate.
+
+        Args:
+            cnn_features: Features from the CNN network, shape[batch_size, number_of_regions, number_of_cnn_features]
+                          (or shape[batch_size, number_of_cnn_features] for a single region)
+
+        Returns:
+            imgfeat_processed: shape[batch_size, nnmapsize]
+            keys             : shape[batch_size, number_of_regions, attention_size]
+            regions          : shape[batch_size, number_of_regions, nnmapsize]
+        """
+        features = cnn_features if cnn_features.dim() == 3 else cnn_features[:, None, :]
+        # the Conv1d with kernel_size=1 is a linear layer applied to every region
+        regions = self.inputlayer(features.transpose(1, 2)).transpose(1, 2)
+        return regions.mean(dim=1), self.attentionlayer.project_keys(regions), regions
+
+    def get_initial_hidden_state(self, cnn_features):
+        """
+        Args:
+            cnn_features: Features from the CNN network, shape[batch_size, number_of_cnn_features]
+
+        Returns:
+            initial_hidden_state: zeros on the device and with the dtype of the model parameters (or autocast),
+                                  shape[num_rnn_layers, batch_size, hidden_state_sizes]
+                                  (2*hidden_state_sizes for LSTM as the state holds the memory cell)
+        """
+        weight = self.Embedding.weight
+        dtype  = weight.dtype
+        if torch.is_autocast_enabled(weight.device.type):
+            # mixedPrecision, the recurrence runs in the autocast dtype (float32 would be kept by type promotion)
+            dtype = torch.get_autocast_dtype(weight.device.type)
+        if self.cell_type == 'LSTM':
+            return torch.zeros((self.num_rnn_layers, cnn_features.shape[0], 2*self.hidden_state_sizes),
+                               device=weight.device, dtype=dtype)
+        return torch.zeros((self.num_rnn_layers, cnn_features.shape[0], self.hidden_state_sizes),
+                           device=weight.device, dtype=dtype)
+
+
 
 ######################################################################################################################
 
@@ -186,7 +396,8 @@ class RNN_onelayer_simplified(nn.Module):
 
 
 class RNN(nn.Module):
-    def __init__(self, input_size, hidden_state_size, num_rnn_layers, last_layer_size, cell_type='GRU'):
+    def __init__(self, input_size, hidden_state_size, num_rnn_layers, last_layer_size, cell_type='GRU',
+                 lstm_layout='memory'):
         super(RNN, self).__init__()
         """
         Args:
@@ -194,6 +405,8 @@ class RNN(nn.Module):
             hidden_state_size (Int) : Number of features in the rnn cells (will be equal for all rnn layers)
             num_rnn_layers (Int)    : Number of stacked rnns
             cell_type               : Whether to use vanilla or GRU cells
+            lstm_layout             : 'memory' (LSTMCell, the gates also see the memory cell) or 'standard'
+                                      (StandardLSTMCell, the gates see [x, h] only)
 
         Returns:
             self.cells              : A nn.ModuleList with entities of "RNNCell" or "GRUCell"
@@ -215,24 +428,46 @@ class RNN(nn.Module):
         #if cell_type == 'GRU':
         #    self.cells = nn.ModuleList([GRUCell(hidden_state_size=self.hidden_state_size, input_size=input_size) for i in range(self.num_rnn_layers)])
         #elif cell_type == 'LSTM':
-        self.cells = nn.ModuleList([LSTMCell(hidden_state_size=self.hidden_state_size, input_size=input_size_list[i]) for i in range(self.num_rnn_layers)])
+        cell_class = StandardLSTMCell if lstm_layout == 'standard' else LSTMCell
+        self.cells = nn.ModuleList([cell_class(hidden_state_size=self.hidden_state_size, input_size=input_size_list[i]) for i in range(self.num_rnn_layers)])
+
+        self.compiled_step = None  # set by imageCaptionModel for compileMode, see CompiledStep
+        self.checkpoint_segment = None  # set by imageCaptionModel for checkpointSegment, see checkpointed_forward
+        self.token_gate_table = None  # set by imageCaptionModel for decodeTable, see TokenGateTable
 
         return
 
-    def forward(self, xTokens, baseimgfeat, initial_hidden_state, outputLayer, attentionlayer, Embedding, is_train=True):
+    def forward(self, xTokens, baseimgfeat, initial_hidden_state, outputLayer, attentionlayer, keys, regions, Embedding,
+                is_train=True, return_tokens=False, end_token=None):
         """
         Args:
             xTokens:        shape [batch_size, truncated_backprop_length]
+            baseimgfeat:    Processed image features, shape[batch_size, nnmapsize]
             initial_hidden_state:  shape [num_rnn_layers, batch_size, hidden_state_size]
-            outputLayer:    handle to the last fully connected layer (an instance of nn.Linear)
+            attentionlayer: An instance of RegionAttention, used between the rnn layers
+            keys:           The attention keys of the regions, shape[batch_size, number_of_regions, attention_size]
+            regions:        The processed regions, shape[batch_size, number_of_regions, nnmapsize]
+            outputLayer:    handle to the last fully connected layer (an instance of nn.Linear). If None (training
+                            only), the hidden states of the last layer are returned instead of the logits
             Embedding:      An instance of nn.Embedding. This is the embedding matrix.
             is_train:       flag: whether or not to feed in the predicated token vector as input for next step
+            return_tokens:  flag: return the predicted tokens instead of the logits (greedy decoding)
+            end_token:      If not None (with return_tokens), rows stop at this token and the loop stops when all
+                            rows are done, the tokens after it are end_token, see drop_finished_rows
 
         Returns:
             logits        : The predicted logits. shape[batch_size, truncated_backprop_length, vocabulary_size]
+                            or the last layer hidden states, shape[batch_size, truncated_backprop_length, hidden_state_sizes]
+                            or the predicted tokens, shape[batch_size, truncated_backprop_length]
             current_state : The hidden state from the last iteration (in time/words).
                             Shape[num_rnn_layers, batch_size, hidden_state_sizes]
         """
+        if is_train == True and self.checkpoint_segment is not None and torch.is_grad_enabled():
+            # activation checkpointing over time, the state is only kept at the segment boundaries
+            step = self.step if self.compiled_step is None else self.compiled_step
+            return checkpointed_forward(step, Embedding(input=xTokens), baseimgfeat, initial_hidden_state, outputLayer,
+                                        self.hidden_state_size, self.checkpoint_segment, attentionlayer, keys, regions)
+
         if is_train == True:
             seqLen = xTokens.shape[1]  # truncated_backprop_length
         else:
@@ -251,54 +486,515 @@ class RNN(nn.Module):
         logits_series = []
 
         # current_state = list(torch.unbind(initial_hidden_state, dim=0))
+        # the cell updates of one time step, see self.step (compiled with compileMode)
+        step = self.step if self.compiled_step is None else self.compiled_step
+
+        # greedy decoding with decodeTable: the image part of the first layer input projection is computed once, the
+        # token part is a row of the precomputed table, see TokenGateTable
+        image_projection = None
+        if is_train == False and self.token_gate_table is not None and not torch.is_grad_enabled():
+            image_projection = self.token_gate_table.image_projection(self.cells[0], Embedding, baseimgfeat)
+            tokens = xTokens[:, 0]
+        input_projection = None
+
+        # greedy decoding with end_token: the rows which are done are dropped from the batch, see drop_finished_rows
+        active = None
+        if return_tokens and end_token is not None and is_train == False:
+            active      = torch.arange(xTokens.shape[0], device=xTokens.device)
+            tokens_out  = torch.full((xTokens.shape[0], seqLen), end_token, dtype=torch.long, device=xTokens.device)
+            final_state = initial_hidden_state.clone()
+
         current_state = initial_hidden_state
         for kk in range(seqLen):
-            updatedstate = torch.zeros_like(current_state)
-
-            # TODO
-            # you need to:
-            # create your lvl0input,
-            # update the hidden cell state for every layer with inputs depending on the layer index
-            # if you are at the last layer, then produce logitskk, tokens , run a logits_series.append(logitskk),
-            # see the simplified rnn for the one layer version
-
-            #print("baseimgfeat: ", baseimgfeat.shape)
-
-            lvl0input = torch.cat((baseimgfeat, tokens_vector), dim=1)
-            #print("Current shape: ", current_state.shape)
-            #updatedstate[0, :] = self.cells[0](lvl0input, current_state[0, :, :])
-            updatedstate[0, :] = self.cells[0].forward(lvl0input, current_state[0,:])
-
-
-            for layer in range(1, self.num_rnn_layers):
-                attention = torch.cat((current_state[layer-1,:], attentionlayer(current_state[layer-1,:])), dim=1)
-                updatedstate[layer, :] = self.cells[layer].forward(attention, current_state[layer,:])
-
+            if image_projection is not None:
+                input_projection = image_projection + self.token_gate_table.lookup(tokens)
+            updatedstate = step(tokens_vector, baseimgfeat, current_state, attentionlayer, keys, regions, input_projection)
 
             out = updatedstate[self.num_rnn_layers - 1, : , :self.hidden_state_size]
 
             #print("out: ", out.shape)
 
-            logitskk = outputLayer(out)
-
+            if outputLayer is None:
+                logits_series.append(out)
+            elif return_tokens:
+                tokens = output_tokens(outputLayer, out)
+                if active is None:
+                    logits_series.append(tokens)
+                else:
+                    tokens_out[active, kk] = tokens
+            else:
+                logitskk = output_logits(outputLayer, out)
 
-            tokens = torch.argmax(logitskk, dim=1)
-            logits_series.append(logitskk)
+                tokens = torch.argmax(logitskk, dim=1)
+                logits_series.append(logitskk)
 
             current_state = updatedstate
+            if active is not None:
+                finished = tokens == end_token
+                if finished.any():  # synchronizes with the gpu once per step
+                    active, current_state, tokens, baseimgfeat, image_projection, keys, regions = drop_finished_rows(
+                        finished, active, final_state, current_state, tokens, baseimgfeat, image_projection, keys, regions)
+                    if active.shape[0] == 0:
+                        break
 
 
             if kk < seqLen - 1:
                 if is_train == True:
                     tokens_vector = embed_input_vec[:, kk + 1, :]
-                elif is_train == False:
+                elif is_train == False and image_projection is None:
                     tokens_vector = Embedding(tokens)
 
+        if active is not None:
+            final_state[:, active] = current_state
+            return tokens_out, final_state
+
         # Produce outputs
         logits = torch.stack(logits_series, dim=1)
         # current_state = torch.stack(current_state, dim=0)
         return logits, current_state
 
+    def step(self, tokens_vector, baseimgfeat, current_state, attentionlayer, keys, regions, input_projection=None):
+        """
+        One time step through all the layers of the rnn.
+
+        Args:
+            tokens_vector: Embedding of the current input tokens, shape[batch_size, embedding_size]
+            baseimgfeat:   Processed image features, shape[batch_size, nnmapsize]
+            current_state: shape[num_rnn_layers, batch_size, hidden_state_size]
+            attentionlayer: handle to the attention layer between the rnn layers
+            keys:          The attention keys of the regions, shape[batch_size, number_of_regions, attention_size]
+            regions:       The processed regions, shape[batch_size, number_of_regions, nnmapsize]
+            input_projection: If not None, the first layer input projection of the image and the tokens
+                          (decodeTable), tokens_vector is not used. shape[batch_size, gate size]
+
+        Returns:
+            updatedstate:  shape[num_rnn_layers, batch_size, hidden_state_size]
+        """
+        if input_projection is not None:
+            # decodeTable, the first layer input projection comes from TokenGateTable
+            updatedstate = [self.cells[0](None, current_state[0], input_projection)]
+        else:
+            # the embedding is float32 also under autocast (mixedPrecision), the cat would promote the cell input
+            # to float32
+            lvl0input = torch.cat((baseimgfeat, tokens_vector.to(baseimgfeat.dtype)), dim=1)
+            updatedstate = [self.cells[0](lvl0input, current_state[0])]
+
+        for layer in range(1, self.num_rnn_layers):
+            # the hidden state of the layer below attends over the regions
+            hidden = updatedstate[layer-1][:, :self.hidden_state_size]
+            attention = torch.cat((hidden, attentionlayer(hidden, keys, regions)), dim=1)
+            updatedstate.append(self.cells[layer](attention, current_state[layer]))
+
+        return torch.stack(updatedstate, dim=0)
+
+
+######################################################################################################################
+class RegionAttention(nn.Module):
+    """
+    Scaled dot-product attention of the rnn over the image regions. The keys are projected once per image
+    (project_keys, see imageCaptionModel.encode_regions), a time step is one batched [batch_size, number_of_regions]
+    score and a weighted sum of the regions.
+    """
+    def __init__(self, query_size, region_size, attention_size):
+        super(RegionAttention, self).__init__()
+        self.key   = nn.Linear(region_size, attention_size)
+        self.query = nn.Linear(query_size, attention_size, bias=False)
+        self.scale = attention_size ** -0.5
+        return
+
+    def project_keys(self, regions):
+        """
+        Args:
+            regions: shape[batch_size, number_of_regions, region_size]
+
+        Returns:
+            keys   : shape[batch_size, number_of_regions, attention_size]
+        """
+        return self.key(regions)
+
+    def forward(self, query, keys, regions):
+        """
+        Args:
+            query  : The hidden state, shape[batch_size, query_size]
+            keys   : From project_keys, shape[batch_size, number_of_regions, attention_size]
+            regions: The values, shape[batch_size, number_of_regions, region_size]
+
+        Returns:
+            context: The attention weighted sum of the regions, shape[batch_size, region_size]
+        """
+        scores  = torch.bmm(keys, self.query(query)[:, :, None])[:, :, 0] * self.scale
+        weights = torch.softmax(scores, dim=1)
+        return torch.bmm(weights[:, None, :], regions)[:, 0, :]
+
+
+######################################################################################################################
+class CompiledStep():
+    """
+    torch.compile of the per time step cell updates ("step" of the rnn classes), used with config['compileMode'].
+
+    Only the step is compiled, the time loop stays in python, so the sequence length (truncated_backprop_length in
+    training, 40 in generation) never becomes part of a compiled graph, and the batch size is marked dynamic. If the
+    compilation fails, e.g. on a CPU machine without a C++ compiler for the inductor backend, the eager step is used.
+    """
+    def __init__(self, step, compile_mode):
+        self.step     = step
+        self.compiled = torch.compile(step, mode=compile_mode, dynamic=True)
+        return
+
+    def __call__(self, *args):
+        if self.compiled is not None:
+            try:
+                return self.compiled(*args)
+            except Exception as error:
+                print('torch.compile of the rnn step failed, falling back to eager mode:', error)
+                self.compiled = None
+        return self.step(*args)
+
+
+######################################################################################################################
+def run_segment(step, embed_segment, baseimgfeat, current_state, outputLayer, hidden_state_size, *step_args):
+    """
+    Teacher forced time steps over one segment of the input sequence, used by checkpointed_forward.
+
+    Returns:
+        outputs      : The last layer hidden states (outputLayer None) or the logits,
+                       shape[batch_size, segment length, hidden_state_size or vocabulary_size]
+        current_state: The state after the last time step of the segment
+    """
+    outputs = []
+    for kk in range(embed_segment.shape[1]):
+        current_state = step(embed_segment[:, kk, :], baseimgfeat, current_state, *step_args)
+        out = current_state[-1, :, :hidden_state_size]
+        outputs.append(out if outputLayer is None else output_logits(outputLayer, out))
+    return torch.stack(outputs, dim=1), current_state
+
+
+def checkpointed_forward(step, embed_input_vec, baseimgfeat, initial_hidden_state, outputLayer, hidden_state_size,
+                         segment_length, *step_args):
+    """
+    Teacher forced time loop with activation checkpointing over time, used with config['checkpointSegment'].
+
+    The sequence is split into segments of segment_length time steps. Only the state at the segment boundaries and the
+    segment outputs are kept for the backward pass, the activations inside a segment (gates, concatenated cell inputs,
+    low precision copies) are recomputed from the boundary state when the gradient reaches the segment.
+
+    Memory/compute trade-off for T = truncated_backprop_length and S = segment_length: the cell activations kept
+    during the forward pass go from T steps to T/S boundary states plus the S steps of the one segment being
+    recomputed in backward, which is smallest around S = sqrt(T). The price is a second forward pass through the cells,
+    about 1/3 more time for a cell bound step (forward ~1/3 of forward + backward), independent of S. With S >= T
+    everything is recomputed at once and nothing is saved. See benchmark_training.py --checkpoint-segments.
+
+    Args:
+        step                : The rnn step, step(tokens_vector, baseimgfeat, current_state, *step_args)
+        embed_input_vec     : shape[batch_size, truncated_backprop_length, embedding_size]
+        baseimgfeat         : Processed image features, shape[batch_size, nnmapsize]
+        initial_hidden_state: shape[num_rnn_layers, batch_size, hidden_state_size]
+        outputLayer         : None (the hidden states are returned, see masked_loss_fn) or the output layer
+        hidden_state_size   : Size of the hidden state part of the state
+        segment_length      : Time steps per checkpointed segment
+
+    Returns:
+        outputs      : shape[batch_size, truncated_backprop_length, hidden_state_size or vocabulary_size]
+        current_state: The hidden state from the last time step
+    """
+    outputs = []
+    current_state = initial_hidden_state
+    for start in range(0, embed_input_vec.shape[1], segment_length):
+        segment_outputs, current_state = checkpoint(run_segment, step, embed_input_vec[:, start:start+segment_length],
+                                                    baseimgfeat, current_state, outputLayer, hidden_state_size,
+                                                    *step_args, use_reentrant=False)
+        outputs.append(segment_outputs)
+    return torch.cat(outputs, dim=1), current_state
+
+
+######################################################################################################################
+class TokenGateTable():
+    """
+    Greedy decoding with config['decodeTable']. The first rnn layer gets [image features, token embedding] as input, so
+    with fixed weights the token part of its gate pre-activations is a row of the [vocabulary_size, gate size] table
+    Embedding.weight @ W_token, and the image part (with the bias) only depends on the image. A decoding step then
+    gathers one row per token instead of multiplying the embedding through the first layer weights.
+
+    The table is built on first use and rebuilt when the embedding or the first cell changes (optimizer step,
+    load_state_dict, .to()). It holds vocabulary_size x gate size values, the gate size is hidden_state_sizes times the
+    number of gates (4 for LSTM, 3 for GRU, 1 for RNN). Cells without input_projection, or with int8 weights, decode
+    as before.
+    """
+    def __init__(self):
+        self.version      = None
+        self.table        = None
+        self.image_weight = None
+        self.bias         = None
+        return
+
+    def image_projection(self, cell, Embedding, baseimgfeat):
+        """
+        Args:
+            cell       : The first rnn cell
+            Embedding  : An instance of nn.Embedding
+            baseimgfeat: Processed image features, shape[batch_size, nnmapsize]
+
+        Returns:
+            image_projection: baseimgfeat @ W_image + bias, shape[batch_size, gate size], or None if the table can not
+                              be used for the cell
+        """
+        if not hasattr(cell, 'input_projection') or cell.quantized_weights is not None:
+            return None
+
+        version = [(parameter.data_ptr(), parameter._version, parameter.dtype)
+                   for parameter in [Embedding.weight] + list(cell.parameters())]
+        if version != self.version:
+            with torch.no_grad():
+                weight, bias = cell.input_projection()
+                image_size        = baseimgfeat.shape[1]
+                self.image_weight = weight[:image_size].clone()
+                self.table        = torch.mm(Embedding.weight, weight[image_size:])
+                self.bias         = bias.clone()
+            self.version = version
+        return torch.addmm(self.bias, baseimgfeat, self.image_weight)
+
+    def lookup(self, tokens):
+        """
+        Args:
+            tokens: shape[batch_size]
+
+        Returns:
+            The token part of the first layer gate pre-activations, shape[batch_size, gate size]
+        """
+        return self.table[tokens]
+
+
+######################################################################################################################
+def drop_finished_rows(finished, active, final_state, current_state, *batch_tensors):
+    """
+    Early termination of greedy decoding with config['endToken']: the rows which emitted the end token leave the
+    active batch, so the following steps only run on the unfinished rows.
+
+    Args:
+        finished     : The rows which emitted the end token, bool, shape[active batch_size]
+        active       : The batch index of every active row, shape[active batch_size]
+        final_state  : The returned state, the state of the finished rows is written to it,
+                       shape[num_rnn_layers, batch_size, hidden_state_size]
+        current_state: The state of the active rows, shape[num_rnn_layers, active batch_size, hidden_state_size]
+        batch_tensors: Other tensors with one row per active row (tokens, image features, ...), None is passed through
+
+    Returns:
+        active, current_state, *batch_tensors of the unfinished rows
+    """
+    final_state[:, active[finished]] = current_state[:, finished]
+    keep = torch.logical_not(finished)
+    return [active[keep], current_state[:, keep]] + [None if tensor is None else tensor[keep] for tensor in batch_tensors]
+
+
+def beam_search(step, outputLayer, Embedding, tokens, baseimgfeat, initial_hidden_state, hidden_state_size, beam_size,
+                seqLen, end_token, length_penalty, *step_args):
+    """
+    Batched beam search, used by imageCaptionModel.beam_search with config['beamSize'].
+
+    The beams are an extra batch dimension: row image*beam_size + beam of the state (and of the image features and
+    step_args) holds one beam. Every step scores all [batch_size, beam_size, vocabulary_size] extensions and keeps the
+    beam_size best per image with one topk, the state and the token history of the kept beams are reordered with
+    index_select. The beams are ranked by the length normalized log-probability sum / length**length_penalty.
+
+    A beam which emitted end_token is kept with its score and only continued with end_token. An image is done when all
+    its beams are finished, or when its best finished beam beats the best score an unfinished beam could still reach
+    (its log-probability sum can only decrease, normalized with the longest length seqLen). Done images are removed
+    from the batch, the loop stops when all images are done.
+
+    Args:
+        step                : The rnn step, step(tokens_vector, baseimgfeat, current_state, *step_args)
+        outputLayer         : nn.Linear or nn.AdaptiveLogSoftmaxWithLoss
+        Embedding           : An instance of nn.Embedding
+        tokens              : The first input tokens, shape[batch_size]
+        baseimgfeat         : Processed image features, shape[batch_size, nnmapsize]
+        initial_hidden_state: shape[num_rnn_layers, batch_size, hidden_state_size]
+        hidden_state_size   : Size of the hidden state part of the state
+        beam_size           : Number of beams per image
+        seqLen              : Max sequence length to be generated
+        end_token           : The end token, None: all beams run seqLen steps
+        length_penalty      : Exponent of the length normalization, 0: plain log-probability sum
+        step_args           : Further step arguments, the tensors have one row per image
+
+    Returns:
+        tokens       : The tokens of the best beam, end_token after its end, shape[batch_size, seqLen]
+        current_state: The state of the best beam after its last token, shape[num_rnn_layers, batch_size, state size]
+    """
+    batch_size = tokens.shape[0]
+    device     = tokens.device
+    pad        = 0 if end_token is None else end_token
+
+    # all beams start as copies of the image row
+    tokens        = tokens.repeat_interleave(beam_size, dim=0)
+    baseimgfeat   = baseimgfeat.repeat_interleave(beam_size, dim=0)
+    current_state = initial_hidden_state.repeat_interleave(beam_size, dim=1)
+    step_args     = [arg.repeat_interleave(beam_size, dim=0) if torch.is_tensor(arg) else arg for arg in step_args]
+
+    # only the first of the identical beams is extended in the first step
+    scores = torch.full((batch_size, beam_size), float('-inf'), device=device)
+    scores[:, 0] = 0
+    lengths  = torch.zeros((batch_size, beam_size), device=device)
+    finished = torch.zeros((batch_size, beam_size), dtype=torch.bool, device=device)
+    history  = torch.full((batch_size*beam_size, seqLen), pad, dtype=torch.long, device=device)
+
+    active      = torch.arange(batch_size, device=device)
+    tokens_out  = torch.full((batch_size, seqLen), pad, dtype=torch.long, device=device)
+    final_state = initial_hidden_state.clone()
+
+    for kk in range(seqLen):
+        updatedstate = step(Embedding(tokens), baseimgfeat, current_state, *step_args)
+        log_probs = output_log_probs(outputLayer, updatedstate[-1, :, :hidden_state_size]).float()
+        # a finished beam keeps the state after its end token
+        current_state = torch.where(finished.view(1, -1, 1), current_state, updatedstate)
+        vocabulary_size = log_probs.shape[1]
+        log_probs = log_probs.view(-1, beam_size, vocabulary_size)
+        if end_token is not None:
+            # a finished beam is only continued with the end token, at no cost and without getting longer
+            frozen = torch.full_like(log_probs[:1, :1], float('-inf'))
+            frozen[..., end_token] = 0
+            log_probs = torch.where(finished[:, :, None], frozen, log_probs)
+        candidate_lengths = lengths + torch.logical_not(finished)
+
+        candidates = scores[:, :, None] + log_probs
+        normalized = candidates / candidate_lengths[:, :, None]**length_penalty
+        _, index   = torch.topk(normalized.view(-1, beam_size*vocabulary_size), beam_size, dim=1)
+        beam       = torch.div(index, vocabulary_size, rounding_mode='floor')
+        tokens     = index % vocabulary_size
+
+        scores  = torch.gather(candidates.view(-1, beam_size*vocabulary_size), 1, index)
+        lengths = torch.gather(candidate_lengths, 1, beam)
+        rows    = (beam + beam_size*torch.arange(beam.shape[0], device=device)[:, None]).view(-1)
+        current_state = current_state.index_select(1, rows)
+        history       = history.index_select(0, rows)
+        history[:, kk] = tokens.view(-1)
+        if end_token is not None:
+            finished = torch.gather(finished, 1, beam) | (tokens == end_token)
+        tokens = tokens.view(-1)
+
+        normalized = scores / lengths**length_penalty
+        if kk == seqLen - 1:
+            done = torch.ones_like(active, dtype=torch.bool)
+        else:
+            best_finished = torch.where(finished, normalized, torch.full_like(normalized, float('-inf'))).max(dim=1)[0]
+            best_bound    = torch.where(finished, torch.full_like(scores, float('-inf')), scores).max(dim=1)[0]
+            done = best_finished >= best_bound / seqLen**length_penalty
+        if done.any():  # synchronizes with the gpu once per step
+            # the best finished beam, the best beam of all if none is finished (seqLen reached)
+            ranking = torch.where(finished | torch.logical_not(finished.any(dim=1, keepdim=True)), normalized,
+                                  torch.full_like(normalized, float('-inf')))
+            best = ranking.argmax(dim=1) + beam_size*torch.arange(beam.shape[0], device=device)
+            tokens_out[active[done]]     = history[best[done]]
+            final_state[:, active[done]] = current_state[:, best[done]]
+
+            keep = torch.logical_not(done)
+            if not keep.any():
+                break
+            rows_keep = keep.repeat_interleave(beam_size)
+            active, scores, lengths, finished = active[keep], scores[keep], lengths[keep], finished[keep]
+            tokens, baseimgfeat, history = tokens[rows_keep], baseimgfeat[rows_keep], history[rows_keep]
+            current_state = current_state[:, rows_keep]
+            step_args     = [arg[rows_keep] if torch.is_tensor(arg) else arg for arg in step_args]
+
+    return tokens_out, final_state
+
+
+######################################################################################################################
+def select_context(context, index):
+    """
+    The rows "index" of a context from imageCaptionModel.encode (index: tensor of row indices or bool mask).
+    """
+    return {key: None if value is None else value[index] for key, value in context.items()}
+
+
+def cat_contexts(contexts):
+    """
+    Concatenation of the rows of contexts from imageCaptionModel.encode (of the same model).
+    """
+    return {key: None if contexts[0][key] is None else torch.cat([context[key] for context in contexts], dim=0)
+            for key in contexts[0]}
+
+
+######################################################################################################################
+def pack_int8(weight, bias=None):
+    """
+    Symmetric per output channel int8 quantization of a weight for torch.ops.quantized.linear_dynamic (CPU only).
+
+    Args:
+        weight: shape[out_features, in_features] (the nn.Linear layout)
+        bias  : shape[out_features] or None
+
+    Returns:
+        packed: the prepacked int8 weight and float bias
+    """
+    weight = weight.detach().float().contiguous()
+    scales = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+    zero_points = torch.zeros(weight.shape[0], dtype=torch.long)
+    qweight = torch.quantize_per_channel(weight, scales.double(), zero_points, 0, torch.qint8)
+    return torch.ops.quantized.linear_prepack(qweight, None if bias is None else bias.detach().float().contiguous())
+
+
+def cell_mm(cell, input, name, bias=None):
+    """
+    torch.mm(input, cell.<name>) (+ bias), or the int8 matmul with a dynamically quantized input once the cell is
+    quantized (see quantize_dynamic_int8). The bias is added by torch.addmm, under autocast (mixedPrecision) the gate
+    pre-activations then stay in the low precision dtype instead of being promoted by the float32 bias.
+    """
+    if cell.quantized_weights is None:
+        if bias is None:
+            return torch.mm(input, getattr(cell, name))
+        return torch.addmm(bias, input, getattr(cell, name))
+    output = torch.ops.quantized.linear_dynamic(input, cell.quantized_weights[name])
+    return output if bias is None else output + bias
+
+
+def projected_mm(cell, state, name, input_projection):
+    """
+    input_projection + state @ (the state rows of cell.<name>), used when the cell input part x @ W_x + bias of the gate
+    is already given (decoding with config['decodeTable'], see TokenGateTable)
+    """
+    return torch.addmm(input_projection, state, getattr(cell, name)[cell.input_size:])
+
+
+class DynamicInt8Linear(nn.Module):
+    """
+    nn.Linear with int8 weights, the input is quantized per call (CPU only), see quantize_dynamic_int8.
+    """
+    def __init__(self, linear):
+        super(DynamicInt8Linear, self).__init__()
+        self.in_features  = linear.in_features
+        self.out_features = linear.out_features
+        self.packed       = pack_int8(linear.weight, linear.bias)
+        return
+
+    def forward(self, input):
+        return torch.ops.quantized.linear_dynamic(input, self.packed)
+
+
+def quantize_dynamic_int8(net):
+    """
+    Post-training dynamic int8 quantization of the rnn cells and the output layer for CPU decoding. The weights are
+    quantized once (per output channel), the activations per matrix multiplication. The quantized net can only be used
+    for inference.
+
+    Args:
+        net: imageCaptionModel on the cpu with the trained weights
+
+    Returns:
+        net: the same module, quantized in place
+    """
+    for cell in net.rnn.cells:
+        if not hasattr(cell, 'quantize_dynamic'):
+            raise ValueError(f'{type(cell).__name__} has no int8 mode')
+        cell.quantize_dynamic()
+
+    if isinstance(net.outputlayer, nn.AdaptiveLogSoftmaxWithLoss):
+        net.outputlayer.head = DynamicInt8Linear(net.outputlayer.head)
+        for tail in net.outputlayer.tail:
+            for ii in range(len(tail)):
+                tail[ii] = DynamicInt8Linear(tail[ii])
+    else:
+        net.outputlayer = DynamicInt8Linear(net.outputlayer)
+    return net
+
 
 ########################################################################################################################
 class GRUCell(nn.Module):
@@ -408,6 +1104,8 @@ class GRUCell(nn.Module):
 
 ######################################################################################################################
 class RNNsimpleCell(nn.Module):
+    quantized_weights = None  # int8 weights for decoding, see quantize_dynamic_int8
+
     def __init__(self, hidden_state_size, input_size):
         super(RNNsimpleCell, self).__init__()
         """
@@ -426,29 +1124,52 @@ class RNNsimpleCell(nn.Module):
         """
         self.hidden_state_size = hidden_state_size
 
+        self.input_size = input_size
+
         self.weight = nn.Parameter(
             torch.randn(input_size + hidden_state_size, hidden_state_size) / np.sqrt(input_size + hidden_state_size))
         self.bias = nn.Parameter(torch.zeros(1, hidden_state_size))
         return
 
-    def forward(self, x, state_old):
+    def forward(self, x, state_old, input_projection=None):
         """
         Args:
             x: tensor with shape [batch_size, inputSize]
             state_old: tensor with shape [batch_size, hidden_state_sizes]
+            input_projection: If not None, x @ W_x + bias from TokenGateTable (decoding), x is not used
 
         Returns:
             state_new: The updated hidden state of the recurrent cell. Shape [batch_size, hidden_state_sizes]
 
         """
+        if input_projection is not None:
+            return torch.tanh(projected_mm(self, state_old, 'weight', input_projection))
+
         x2 = torch.cat((x, state_old), dim=1)
-        state_new = torch.tanh(torch.mm(x2, self.weight) + self.bias)
+        state_new = torch.tanh(cell_mm(self, x2, 'weight', self.bias))
         return state_new
 
+    def input_projection(self):
+        """
+        Returns:
+            weight, bias: The rows of self.weight applied to the cell input x, shape[inputSize, hidden_state_sizes],
+                          and the bias, see TokenGateTable
+        """
+        return self.weight[:self.input_size], self.bias[0]
+
+    def quantize_dynamic(self):
+        """
+        int8 weights for CPU decoding, used by cell_mm, see quantize_dynamic_int8.
+        """
+        self.quantized_weights = {'weight': pack_int8(self.weight.t())}
+        return
+
 
 ######################################################################################################################
 
 class LSTMCell(nn.Module):
+    quantized_weights = None  # int8 weights for decoding, see quantize_dynamic_int8
+
     def __init__(self, hidden_state_size, input_size):
         super(LSTMCell, self).__init__()
         """
@@ -464,6 +1185,7 @@ class LSTMCell(nn.Module):
             Variance scaling:  Var[W] = 1/n
         """
         self.hidden_state_size = hidden_state_size
+        self.input_size = input_size
 
         # TODO:
         self.weight_f = nn.Parameter(
@@ -484,11 +1206,13 @@ class LSTMCell(nn.Module):
 
         return
 
-    def forward(self, x, state_old):
+    def forward(self, x, state_old, input_projection=None):
         """
         Args:
             x: tensor with shape [batch_size, inputSize]
             state_old: tensor with shape [batch_size, 2*hidden_state_sizes]
+            input_projection: If not None, x @ W_x + bias of the input, forget, output and candidate memory weights from
+                              TokenGateTable (decoding), x is not used
 
         Returns:
             state_new: The updated hidden state of the recurrent cell. Shape [batch_size, hidden_state_sizes]
@@ -502,27 +1226,23 @@ class LSTMCell(nn.Module):
         #print()
 
         # TODO:
-        input_cat = torch.cat((x, state_old), dim=1)
-
-        #print("input_cat: ", input_cat.shape)
-        #print("weight_i : ", self.weight_i.shape)
-        #print("bias_i:    ", self.bias_i.shape)
-
-        #print("Weight_i: ", self.weight_f.shape)
-        #print("bias_i:   ", self.bias_i.shape)
-
-        input_gate = torch.sigmoid(torch.mm(input_cat, self.weight_i) + self.bias_i)
-        #input_gate = torch.sigmoid(input_gate)
-
-        forget_gate = torch.sigmoid(torch.mm(input_cat, self.weight_f) + self.bias_f)
-        #forget_gate = torch.sigmoid(forget_gate)
-
-        #print("Forget:   ", forget_gate.shape)
+        if input_projection is None:
+            input_cat = torch.cat((x, state_old), dim=1)
+            input_gate = cell_mm(self, input_cat, 'weight_i', self.bias_i)
+            forget_gate = cell_mm(self, input_cat, 'weight_f', self.bias_f)
+            output_gate = cell_mm(self, input_cat, 'weight_o', self.bias_o)
+            candidate_memory = cell_mm(self, input_cat, 'weight_meminput', self.bias_meminput)
+        else:
+            input_gate, forget_gate, output_gate, candidate_memory = torch.chunk(input_projection, 4, dim=1)
+            input_gate = projected_mm(self, state_old, 'weight_i', input_gate)
+            forget_gate = projected_mm(self, state_old, 'weight_f', forget_gate)
+            output_gate = projected_mm(self, state_old, 'weight_o', output_gate)
+            candidate_memory = projected_mm(self, state_old, 'weight_meminput', candidate_memory)
 
-        output_gate = torch.sigmoid(torch.mm(input_cat, self.weight_o) + self.bias_o)
-        #output_gate = torch.sigmoid(output_gate)
+        input_gate = torch.sigmoid(input_gate)
+        forget_gate = torch.sigmoid(forget_gate)
+        output_gate = torch.sigmoid(output_gate)
 
-        candidate_memory = torch.mm(input_cat, self.weight_meminput) + self.bias_meminput
         candidate_mem_tanh = torch.tanh(candidate_memory.clone())
 
         #print("forget:    ", forget_gate.shape)
@@ -549,6 +1269,108 @@ class LSTMCell(nn.Module):
 
         return state_new
 
+    def input_projection(self):
+        """
+        Returns:
+            weight, bias: The rows of weight_i, weight_f, weight_o and weight_meminput applied to the cell input x,
+                          concatenated, shape[inputSize, 4*hidden_state_sizes], and the biases, see TokenGateTable
+        """
+        names = ['weight_i', 'weight_f', 'weight_o', 'weight_meminput']
+        weight = torch.cat([getattr(self, name)[:self.input_size] for name in names], dim=1)
+        return weight, torch.cat((self.bias_i[0], self.bias_f[0], self.bias_o[0], self.bias_meminput[0]))
+
+    def quantize_dynamic(self):
+        """
+        int8 weights for CPU decoding, used by cell_mm, see quantize_dynamic_int8.
+        """
+        self.quantized_weights = {'weight_i': pack_int8(self.weight_i.t()),
+                                  'weight_f': pack_int8(self.weight_f.t()),
+                                  'weight_o': pack_int8(self.weight_o.t()),
+                                  'weight_meminput': pack_int8(self.weight_meminput.t())}
+        return
+
+
+######################################################################################################################
+class StandardLSTMCell(nn.Module):
+    quantized_weights = None  # int8 weights for decoding, see quantize_dynamic_int8
+
+    def __init__(self, hidden_state_size, input_size):
+        super(StandardLSTMCell, self).__init__()
+        """
+        LSTM cell where the gates only see [x, h], the memory cell is not part of the gate input (config['lstmLayout']
+        'standard'). Compared to LSTMCell every gate has hidden_state_size fewer inputs, and the four gates are computed
+        in one matrix multiplication.
+
+        Args:
+            hidden_state_size: Integer defining the size of the hidden state of rnn cell
+            inputSize: Integer defining the number of input features to the rnn
+
+            note: the state tensor has 2*hidden_state_size as for LSTMCell, it holds [hidden state, memory cell]
+        Returns:
+            self.weight: A nn.Parameter with shape [4*hidden_state_sizes, inputSize+hidden_state_sizes], the input,
+                         forget, candidate memory and output gate weights stacked (the nn.Linear/nn.LSTM layout, which
+                         is the faster operand layout for the CPU GEMM). Initialized using variance scaling with zero
+                         mean.
+
+            self.bias: A nn.Parameter with shape [1, 4*hidden_state_sizes]. Initialized to zero.
+
+        Tips:
+            Variance scaling:  Var[W] = 1/n
+        """
+        self.input_size = input_size
+        self.hidden_state_size = hidden_state_size
+
+        self.weight = nn.Parameter(
+            torch.randn(4*hidden_state_size, input_size + hidden_state_size) / np.sqrt(input_size + hidden_state_size))
+        self.bias = nn.Parameter(torch.zeros(1, 4*hidden_state_size))
+        return
+
+    def forward(self, x, state_old, input_projection=None):
+        """
+        Args:
+            x: tensor with shape [batch_size, inputSize]
+            state_old: tensor with shape [batch_size, 2*hidden_state_sizes]
+            input_projection: If not None, x @ W_x + bias of the four gates from TokenGateTable (decoding), x is not used
+
+        Returns:
+            state_new: The updated state [hidden state, memory cell]. Shape [batch_size, 2*hidden_state_sizes]
+
+        """
+        hidden_old = state_old[:, :self.hidden_state_size]
+        memory_old = state_old[:, self.hidden_state_size:]
+
+        if input_projection is not None:
+            gates = torch.addmm(input_projection, hidden_old, self.weight[:, self.input_size:].t())
+        else:
+            input_cat = torch.cat((x, hidden_old), dim=1)
+            if self.quantized_weights is None:
+                # F.linear and not addmm(bias, input_cat, weight.t()), autocast caches the cast of the weight once
+                gates = F.linear(input_cat, self.weight, self.bias)
+            else:
+                gates = torch.ops.quantized.linear_dynamic(input_cat, self.quantized_weights['weight'])
+        input_gate, forget_gate, candidate_memory, output_gate = torch.chunk(gates, 4, dim=1)
+
+        memory_cell = torch.sigmoid(forget_gate) * memory_old + torch.sigmoid(input_gate) * torch.tanh(candidate_memory)
+        hidden_state = torch.sigmoid(output_gate) * torch.tanh(memory_cell)
+
+        state_new = torch.cat((hidden_state, memory_cell), dim=1)
+        return state_new
+
+    def input_projection(self):
+        """
+        Returns:
+            weight, bias: The columns of self.weight applied to the cell input x, transposed to
+                          shape[inputSize, 4*hidden_state_sizes], and the bias, see TokenGateTable
+        """
+        return self.weight[:, :self.input_size].t(), self.bias[0]
+
+    def quantize_dynamic(self):
+        """
+        int8 weights (with the bias) for CPU decoding, see quantize_dynamic_int8.
+        """
+        self.quantized_weights = {'weight': pack_int8(self.weight, self.bias[0])}
+        return
+
 
 ######################################################################################################################
 def loss_fn(logits, yTokens, yWeights):
@@ -580,6 +1402,147 @@ def loss_fn(logits, yTokens, yWeights):
 
     return sumLoss, meanLoss
 
+
+######################################################################################################################
+def masked_loss_fn(hidden_states, outputLayer, yTokens, yWeights, chunk_size=None):
+    """
+    Weighted softmax cross entropy loss computed only on the positions where "yWeights" is nonzero.
+
+    The hidden states of the non-padded positions are gathered and projected through "outputLayer" in one matrix
+    multiplication, the full logits tensor shape[batch_size, truncated_backprop_length, vocabulary_size] is never built.
+
+    Args:
+        hidden_states   : Last layer hidden states, shape[batch_size, truncated_backprop_length, hidden_state_sizes]
+        outputLayer     : handle to the last fully connected layer (an instance of nn.Linear)
+        yTokens (labels): Shape[batch_size, truncated_backprop_length]
+        yWeights        : Shape[batch_size, truncated_backprop_length]
+        chunk_size      : If not None, the output layer and the cross entropy are evaluated in blocks of "chunk_size"
+                          tokens with ChunkedLinearCrossEntropy, which does not store the logits for the backward pass.
+                          Not used with the adaptive softmax, which computes its own loss.
+
+    Returns:
+        sumLoss: The total cross entropy loss for all words
+        meanLoss: The averaged cross entropy loss for all words
+    """
+    eps = 0.0000000001  # used to not divide on zero
+
+    yWeights = yWeights.reshape(-1)
+    valid    = yWeights.nonzero().squeeze(1)
+
+    hidden_states = hidden_states.reshape(-1, hidden_states.shape[2]).index_select(0, valid)
+    yTokens       = yTokens.reshape(-1).index_select(0, valid)
+    # the output layer follows autocast (mixedPrecision), the cross entropy is computed in float32
+    if isinstance(outputLayer, nn.AdaptiveLogSoftmaxWithLoss):
+        losses = -outputLayer(hidden_states, yTokens).output.float()
+    elif chunk_size is None:
+        losses = F.cross_entropy(input=outputLayer(hidden_states).float(), target=yTokens, reduction='none')
+    else:
+        # the blocks are computed in float32, the memory saving comes from not storing the logits
+        with torch.autocast(device_type=hidden_states.device.type, enabled=False):
+            losses = ChunkedLinearCrossEntropy.apply(hidden_states.float(), outputLayer.weight, outputLayer.bias,
+                                                     yTokens, chunk_size)
+
+    sumLoss  = (losses * yWeights.index_select(0, valid)).sum()
+    meanLoss = sumLoss / (yWeights.sum() + eps)
+
+    return sumLoss, meanLoss
+
+
+######################################################################################################################
+def output_logits(outputLayer, hidden):
+    """
+    Args:
+        outputLayer: nn.Linear or nn.AdaptiveLogSoftmaxWithLoss
+        hidden     : shape[batch_size, hidden_state_sizes]
+
+    Returns:
+        logits: shape[batch_size, vocabulary_size] (log-probabilities for the adaptive softmax)
+    """
+    if isinstance(outputLayer, nn.AdaptiveLogSoftmaxWithLoss):
+        return outputLayer.log_prob(hidden)
+    return outputLayer(hidden)
+
+
+def output_tokens(outputLayer, hidden):
+    """
+    Greedy (argmax) token prediction. The adaptive softmax only evaluates a tail cluster for the rows where
+    the cluster wins in the head.
+
+    Args:
+        outputLayer: nn.Linear or nn.AdaptiveLogSoftmaxWithLoss
+        hidden     : shape[batch_size, hidden_state_sizes]
+
+    Returns:
+        tokens: shape[batch_size]
+    """
+    if isinstance(outputLayer, nn.AdaptiveLogSoftmaxWithLoss):
+        return outputLayer.predict(hidden)
+    return torch.argmax(outputLayer(hidden), dim=1)
+
+
+def output_log_probs(outputLayer, hidden):
+    """
+    Args:
+        outputLayer: nn.Linear or nn.AdaptiveLogSoftmaxWithLoss
+        hidden     : shape[batch_size, hidden_state_sizes]
+
+    Returns:
+        log_probs: The log-probabilities of all tokens, shape[batch_size, vocabulary_size]
+    """
+    if isinstance(outputLayer, nn.AdaptiveLogSoftmaxWithLoss):
+        return outputLayer.log_prob(hidden)
+    return torch.log_softmax(outputLayer(hidden), dim=1)
+
+
+######################################################################################################################
+class ChunkedLinearCrossEntropy(torch.autograd.Function):
+    """
+    Fused output layer and softmax cross entropy, evaluated in blocks of "chunk_size" tokens.
+
+    Only the log-sum-exp per token is kept for the backward pass, the logits of each block are recomputed there instead
+    of storing the full [number_of_tokens, vocabulary_size] logits and softmax. The losses and gradients are the same as
+    for F.cross_entropy(F.linear(hidden, weight, bias), target, reduction='none').
+    """
+
+    @staticmethod
+    def forward(ctx, hidden, weight, bias, target, chunk_size):
+        losses = hidden.new_empty(hidden.shape[0])
+        lse    = hidden.new_empty(hidden.shape[0])
+        for start in range(0, hidden.shape[0], chunk_size):
+            end    = start + chunk_size
+            logits = F.linear(hidden[start:end], weight, bias)
+            lse[start:end]    = torch.logsumexp(logits, dim=1)
+            losses[start:end] = lse[start:end] - logits.gather(1, target[start:end, None]).squeeze(1)
+
+        ctx.save_for_backward(hidden, weight, bias, target, lse)
+        ctx.chunk_size = chunk_size
+        return losses
+
+    @staticmethod
+    def backward(ctx, grad_losses):
+        hidden, weight, bias, target, lse = ctx.saved_tensors
+
+        grad_hidden = torch.empty_like(hidden) if ctx.needs_input_grad[0] else None
+        grad_weight = torch.zeros_like(weight) if ctx.needs_input_grad[1] else None
+        grad_bias   = torch.zeros_like(bias) if bias is not None and ctx.needs_input_grad[2] else None
+
+        for start in range(0, hidden.shape[0], ctx.chunk_size):
+            end    = start + ctx.chunk_size
+            chunk  = hidden[start:end]
+            # d loss / d logits = softmax - one_hot(target)
+            grad_logits = torch.exp(F.linear(chunk, weight, bias) - lse[start:end, None])
+            grad_logits[torch.arange(chunk.shape[0], device=chunk.device), target[start:end]] -= 1
+            grad_logits *= grad_losses[start:end, None]
+
+            if grad_hidden is not None:
+                grad_hidden[start:end] = grad_logits.mm(weight)
+            if grad_weight is not None:
+                grad_weight += grad_logits.t().mm(chunk)
+            if grad_bias is not None:
+                grad_bias += grad_logits.sum(dim=0)
+
+        return grad_hidden, grad_weight, grad_bias, None, None
+
 # ########################################################################################################################
 # if __name__ == '__main__':
 #
@@ -1,3 +1,4 @@
+import torch
 from torch import optim
 
 from cocoSource_xcnnfused import loss_fn
@@ -18,6 +19,14 @@ class Model():
         self.net.to(self.device)
         self.loss_fn = loss_fn
 
+        # config['mixedPrecision']: autocast with bfloat16 on the cpu, float16 with loss scaling on the gpu, the weights
+        # and the optimizer state stay float32
+        self.amp_device_type = 'cuda' if modelParam['cuda']['use_cuda'] else 'cpu'
+        self.amp_dtype = None
+        if config.get('mixedPrecision', False):
+            self.amp_dtype = torch.float16 if modelParam['cuda']['use_cuda'] else torch.bfloat16
+        self.scaler = torch.amp.GradScaler(self.amp_device_type, enabled=self.amp_dtype == torch.float16)
+
         if config['optimizer'] == 'adam':
             self.optimizer = optim.Adam(self.net.parameters(), lr=config['learningRate']['lr'], weight_decay=config['weight_decay'])
         elif config['optimizer'] == 'adamW':
@@ -67,6 +67,7 @@ class Trainer():
             for key in ['xTokens', 'yTokens', 'yWeights', 'cnn_features']:
                 dataDict[key] = dataDict[key].to(model.device)
             cur_it += 1
+            encoded = None
             batchTotalLoss = 0
             numbOfWordsInBatch = 0
             
@@ -89,14 +90,26 @@ class Trainer():
                     logits, current_hidden_state_Ref = model.net(cnn_features, xTokens,  is_train, current_hidden_state.detach())
                 '''
                 
-                logits, current_hidden_state = model.net(cnn_features, xTokens,  is_train)
-                sumLoss, meanLoss = model.loss_fn(logits, yTokens, yWeights)
+                # mixed precision if model.amp_dtype is not None, see Model
+                with torch.autocast(device_type=model.amp_device_type, dtype=model.amp_dtype, enabled=model.amp_dtype is not None):
+                    if is_train:
+                        # teacher forcing, the output layer is only applied to the non-padded positions
+                        sumLoss, meanLoss, current_hidden_state = model.net.forward_loss(cnn_features, xTokens, yTokens, yWeights)
+                    else:
+                        # without gradients the regions are encoded once and shared by the truncated sequences
+                        if encoded is None:
+                            encoded = model.net.encode_regions(cnn_features)
+                        logits, current_hidden_state = model.net(cnn_features, xTokens,  is_train, encoded=encoded)
+                        with torch.autocast(device_type=model.amp_device_type, enabled=False):
+                            sumLoss, meanLoss = model.loss_fn(logits.float(), yTokens, yWeights)
                 
                 
                 if mode == 'train':
                     model.optimizer.zero_grad()
-                    meanLoss.backward(retain_graph=False)
-                    model.optimizer.step()
+                    # the scaler only scales with float16, otherwise this is meanLoss.backward() and optimizer.step()
+                    model.scaler.scale(meanLoss).backward(retain_graph=False)
+                    model.scaler.step(model.optimizer)
+                    model.scaler.update()
                     if model.scheduler is not None:
                         model.scheduler.step()
                 
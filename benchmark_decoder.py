@@ -0,0 +1,79 @@
+"""
+Per-token latency of greedy decoding (imageCaptionModel.generate) for the Task1-Task4 models, eager versus
+config['compileMode'] or config['decodeTable'].
+
+The models are randomly initialized with the sizes of the training scripts, the latency does not depend on the weights.
+
+    python benchmark_decoder.py --compile-mode default --batch-sizes 1 64
+    python benchmark_decoder.py --variant decodeTable --batch-sizes 1 64
+"""
+import argparse
+import time
+
+import torch
+
+from task_models import TASKS, loadModelFile
+
+
+def perTokenLatency(net, cnn_features_shape, batch_size, repeats):
+    cnn_features  = torch.randn((batch_size,) + cnn_features_shape)
+    xTokens       = torch.ones(batch_size, 1, dtype=torch.long)  # start token
+    stateSize     = 2*net.hidden_state_sizes if net.cell_type == 'LSTM' else net.hidden_state_sizes
+    initial_state = torch.zeros(net.num_rnn_layers, batch_size, stateSize)
+
+    with torch.no_grad():
+        tokens, _ = net.generate(cnn_features, xTokens, initial_state)  # warm up (and compile)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            tokens, _ = net.generate(cnn_features, xTokens, initial_state)
+        return (time.perf_counter() - start) / repeats / tokens.shape[1]
+
+
+def main(args):
+    if args.variant == 'decodeTable':
+        name, variant = 'decodeTable', {'decodeTable': True}
+    else:
+        name, variant = args.compile_mode, {'compileMode': args.compile_mode}
+    print(f'{"model":8s}{"batch":>8s}{"eager [ms/token]":>20s}{name + " [ms/token]":>26s}{"speedup":>10s}')
+    for task in args.tasks:
+        modelFile = loadModelFile(task)
+        taskConfig, cnn_features_shape = TASKS[task]
+        for batch_size in args.batch_sizes:
+            latency = []
+            for variantConfig in [{}, variant]:
+                config = {
+                    'vocabulary_size': 10000,
+                    'embedding_size': 300,
+                    'number_of_cnn_features': 2048,
+                    'hidden_state_sizes': 512,
+                }
+                config.update(taskConfig)
+                config.update(variantConfig)
+                try:
+                    net = modelFile.imageCaptionModel(config)
+                    net.eval()
+                    latency.append(1000*perTokenLatency(net, cnn_features_shape, batch_size, args.repeats))
+                except Exception as error:
+                    print(f'{task:8s}{batch_size:8d}  failed: {error}')
+                    break
+            else:
+                print(f'{task:8s}{batch_size:8d}{latency[0]:20.3f}{latency[1]:26.3f}{latency[0] / latency[1]:10.2f}')
+    return
+
+
+########################################################################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tasks', nargs='+', default=list(TASKS.keys()))
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 64])
+    parser.add_argument('--variant', choices=['compile', 'decodeTable'], default='compile',
+                        help="compared to eager decoding: config['compileMode'] or config['decodeTable']")
+    parser.add_argument('--compile-mode', default='default', help="torch.compile mode, see config['compileMode']")
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    main(args)
@@ -0,0 +1,150 @@
+"""
+Training throughput and activation memory of imageCaptionModel.forward_loss, float32 versus config['mixedPrecision']
+(bfloat16 autocast on the cpu, float16 with a GradScaler on the gpu) and config['checkpointSegment'], the same steps as
+Trainer.run_epoch.
+
+The models are randomly initialized with the sizes of the training scripts. The memory is the size of the tensors saved
+for the backward pass, on the gpu also the peak allocated memory. With checkpointing the activations of one segment
+are recomputed during the backward pass on top of the saved ones (+recompute), the memory column is the sum of both
+relative to float32 without checkpointing.
+
+    python benchmark_training.py --tasks Task3 --batch-size 128 --seq-len 25
+    python benchmark_training.py --seq-len 100 --loss-chunk-size 1024 --checkpoint-segments 5 10 25 100
+"""
+import argparse
+import time
+
+import torch
+
+from task_models import TASKS, loadModelFile
+
+
+def trainStep(net, optimizer, scaler, amp_dtype, device, batch):
+    cnn_features, xTokens, yTokens, yWeights = batch
+    with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+        sumLoss, meanLoss, _ = net.forward_loss(cnn_features, xTokens, yTokens, yWeights)
+    optimizer.zero_grad()
+    scaler.scale(meanLoss).backward()
+    scaler.step(optimizer)
+    scaler.update()
+    return meanLoss
+
+
+def savedTensorBytes(net, amp_dtype, device, batch):
+    """Size of the tensors autograd keeps for the backward pass of one forward_loss."""
+    saved = {}
+
+    def pack(tensor):
+        saved[(tensor.untyped_storage().data_ptr(), tensor.dtype)] = tensor.untyped_storage().nbytes()
+        return tensor
+
+    cnn_features, xTokens, yTokens, yWeights = batch
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            _, meanLoss, _ = net.forward_loss(cnn_features, xTokens, yTokens, yWeights)
+    # the parameters (and their cached low precision copies) are not activations
+    parameters = {parameter.untyped_storage().data_ptr() for parameter in net.parameters()}
+    return sum(nbytes for (ptr, _), nbytes in saved.items() if ptr not in parameters)
+
+
+def measure(net, amp_dtype, device, batch, repeats):
+    optimizer = torch.optim.Adam(net.parameters(), lr=1e-4)
+    scaler    = torch.amp.GradScaler(device.type, enabled=amp_dtype == torch.float16)
+
+    trainStep(net, optimizer, scaler, amp_dtype, device, batch)  # warm up
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        trainStep(net, optimizer, scaler, amp_dtype, device, batch)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / repeats
+
+    peak = torch.cuda.max_memory_allocated() if device.type == 'cuda' else None
+
+    # the activations of one segment, recomputed during the backward pass of that segment
+    recompute = 0
+    segment = net.rnn.checkpoint_segment
+    if segment is not None:
+        cnn_features, xTokens, yTokens, yWeights = batch
+        segment_batch = (cnn_features, xTokens[:, :segment], yTokens[:, :segment], yWeights[:, :segment])
+        net.rnn.checkpoint_segment = None
+        recompute = savedTensorBytes(net, amp_dtype, device, segment_batch)
+        net.rnn.checkpoint_segment = segment
+    return {
+        'tokens_per_second': batch[3].sum().item() / elapsed,
+        'ms_per_step': 1000*elapsed,
+        'activations_mb': savedTensorBytes(net, amp_dtype, device, batch) / 2**20,
+        'recompute_mb': recompute / 2**20,
+        'peak_mb': None if peak is None else peak / 2**20,
+    }
+
+
+def main(args):
+    device    = torch.device('cuda' if torch.cuda.is_available() and not args.cpu else 'cpu')
+    mixed     = torch.float16 if device.type == 'cuda' else torch.bfloat16
+    precision = {'float32': None, str(mixed).replace('torch.', ''): mixed}
+    segments  = [None] + args.checkpoint_segments
+
+    print(f'device={device}, batch_size={args.batch_size}, seq_len={args.seq_len}')
+    print(f'{"model":8s}{"precision":>11s}{"segment":>9s}{"ms/step":>10s}{"tokens/s":>11s}{"activations [MB]":>18s}'
+          f'{"+recompute [MB]":>17s}{"peak [MB]":>11s}{"time":>7s}{"memory":>8s}')
+    for task in args.tasks:
+        modelFile = loadModelFile(task)
+        taskConfig, cnn_features_shape = TASKS[task]
+        torch.manual_seed(0)
+        batch = (torch.randn((args.batch_size,) + cnn_features_shape, device=device),
+                 torch.randint(0, 10000, (args.batch_size, args.seq_len), device=device),
+                 torch.randint(0, 10000, (args.batch_size, args.seq_len), device=device),
+                 torch.ones(args.batch_size, args.seq_len, device=device))
+        reference = None  # float32 without checkpointing, the time and memory columns are relative to it
+        for name, amp_dtype in precision.items():
+            for segment in segments:
+                config = {
+                    'vocabulary_size': 10000,
+                    'embedding_size': 300,
+                    'number_of_cnn_features': 2048,
+                    'hidden_state_sizes': 512,
+                    'lossChunkSize': args.loss_chunk_size,
+                    'checkpointSegment': segment,
+                }
+                config.update(taskConfig)
+                torch.manual_seed(0)
+                net = modelFile.imageCaptionModel(config).to(device)
+                net.train()
+                try:
+                    result = measure(net, amp_dtype, device, batch, args.repeats)
+                except Exception as error:
+                    print(f'{task:8s}{name:>11s}{str(segment):>9s}  failed: {error}')
+                    continue
+                if reference is None:
+                    reference = result
+                peak = '-' if result['peak_mb'] is None else f'{result["peak_mb"]:.0f}'
+                print(f'{task:8s}{name:>11s}{str(segment):>9s}{result["ms_per_step"]:10.1f}'
+                      f'{result["tokens_per_second"]:11.0f}{result["activations_mb"]:18.1f}'
+                      f'{result["recompute_mb"]:17.1f}{peak:>11s}'
+                      f'{result["ms_per_step"]/reference["ms_per_step"]:7.2f}'
+                      f'{(result["activations_mb"] + result["recompute_mb"])/reference["activations_mb"]:8.2f}')
+    return
+
+
+########################################################################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tasks', nargs='+', default=['Task3'])
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--seq-len', type=int, default=25)
+    parser.add_argument('--loss-chunk-size', type=int, default=None, help="see config['lossChunkSize']")
+    parser.add_argument('--checkpoint-segments', nargs='*', type=int, default=[],
+                        help="segment lengths for config['checkpointSegment'], also measured without checkpointing")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    parser.add_argument('--cpu', action='store_true', help='benchmark on the cpu even if a gpu is available')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    main(args)
@@ -0,0 +1,190 @@
+"""
+Load generator for the caption server (utils/server.py in the Task folders).
+
+Sends --requests captions of random cnn features, either open loop with Poisson arrivals at --rate requests per second
+or closed loop with --concurrency requests in flight, and prints the client side latency percentiles and throughput
+together with the server stats (queue depth, batch size distribution, server side latency).
+
+Without --port an in-process server with a randomly initialized model of --task is started (the latency does not depend
+on the weights, only on the caption lengths: --end-bias raises the end token logit so that the captions end after a
+varying number of tokens, else they run to the 40 token limit), with --port the requests go to a running server, e.g.
+validate_model.py with modelParam['serve'].
+
+    python load_generator.py --task Task3 --rate 200 --max-wait-ms 5 --max-batch-size 64
+    python load_generator.py --task Task3 --concurrency 1 --max-batch-size 1
+    python load_generator.py --port 8765 --rate 100
+    python load_generator.py --task Task3 --concurrency 64 --end-bias 0.1 --continuous
+    python load_generator.py --task Task3 --rate 50 --images 1000 --repeat 0.5 --cache-size 100000
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import time
+
+import numpy as np
+import torch
+
+from task_models import TASKS, loadModelFile, loadTaskModule
+
+
+class Client():
+    """
+    One connection to the server, the requests are pipelined and the responses matched by id.
+    """
+    def __init__(self, reader, writer):
+        self.reader  = reader
+        self.writer  = writer
+        self.futures = {}
+        self.ids     = itertools.count()
+        self.task    = asyncio.get_running_loop().create_task(self.read_responses())
+        return
+
+    async def read_responses(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                break
+            response = json.loads(line)
+            self.futures.pop(response.get('id'), None).set_result(response)
+
+    async def request(self, message):
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.futures[request_id] = future
+        self.writer.write(message(request_id).encode())
+        await self.writer.drain()
+        return await future
+
+    async def close(self):
+        self.writer.close()
+        self.task.cancel()
+        return
+
+
+async def run(args):
+    # utils/server.py imports the utils package of its Task
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), args.task))
+    serverModule = loadTaskModule(args.task, 'utils', 'server.py')
+    taskConfig, cnn_features_shape = TASKS[args.task]
+
+    server = None
+    port   = args.port
+    if port is None:
+        modelFile = loadModelFile(args.task)
+        config = {
+            'vocabulary_size': 10000,
+            'embedding_size': 300,
+            'number_of_cnn_features': 2048,
+            'hidden_state_sizes': 512,
+            'endToken': 0,
+        }
+        config.update(taskConfig)
+        torch.manual_seed(0)
+        net = modelFile.imageCaptionModel(config)
+        net.eval()
+        if args.end_bias != 0:
+            with torch.no_grad():
+                net.outputlayer.bias[config['endToken']] += args.end_bias
+        model  = argparse.Namespace(net=net, device='cpu')  # the parts of utils.model.Model the server uses
+        server = serverModule.CaptionServer(model, args.max_batch_size, args.max_wait_ms, continuous=args.continuous,
+                                            cache_size=args.cache_size)
+        listener = await asyncio.start_server(server.handle_connection, args.host, 0,
+                                              limit=serverModule.STREAM_LIMIT)
+        port = listener.sockets[0].getsockname()[1]
+        await server.start()
+
+    connections = max(1, args.connections)
+    clients = [Client(*await asyncio.open_connection(args.host, port, limit=serverModule.STREAM_LIMIT))
+               for _ in range(connections)]
+    # with probability --repeat a request is one of the images sent before (a re-upload), else a new one
+    rng      = np.random.default_rng(0)
+    features = rng.standard_normal((args.images,) + cnn_features_shape).astype(np.float32)
+    images   = [0]
+    for _ in range(args.requests - 1):
+        images.append(images[rng.integers(len(images))] if rng.random() < args.repeat else len(images) % args.images)
+
+    latencies       = []
+    caption_lengths = []
+    errors          = 0
+
+    async def one_request(index):
+        nonlocal errors
+        client = clients[index % connections]
+        start  = time.perf_counter()
+        response = await client.request(lambda request_id: serverModule.encodeRequest(features[images[index]], request_id))
+        if 'error' in response:
+            errors += 1
+        else:
+            caption_lengths.append(len(response['tokens']))
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    if args.rate is not None:
+        # open loop: Poisson arrivals, independent of how fast the server answers
+        tasks = []
+        for index in range(args.requests):
+            tasks.append(asyncio.get_running_loop().create_task(one_request(index)))
+            await asyncio.sleep(random.expovariate(args.rate))
+        await asyncio.gather(*tasks)
+    else:
+        # closed loop: every worker sends its next request when the previous one is answered
+        counter = itertools.count()
+
+        async def worker():
+            index = next(counter)
+            while index < args.requests:
+                await one_request(index)
+                index = next(counter)
+        await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+
+    stats = await clients[0].request(lambda request_id: json.dumps({'op': 'stats', 'id': request_id}) + '\n')
+    for client in clients:
+        await client.close()
+    if server is not None:
+        await server.stop()
+        listener.close()
+
+    latencies = 1000*np.array(latencies)
+    print(f'{args.requests} requests in {elapsed:.2f} s, {args.requests / elapsed:.1f} captions/s, {errors} errors')
+    print(f'client latency p50 {np.percentile(latencies, 50):.1f} ms, p99 {np.percentile(latencies, 99):.1f} ms')
+    print(f'server: mean batch size {stats["mean_batch_size"]:.1f}, latency p50 {stats["latency_p50_ms"]:.1f} ms, '
+          f'p99 {stats["latency_p99_ms"]:.1f} ms, queue depth {stats["queue_depth"]}')
+    print(f'batch sizes (size: batches): {stats["batch_sizes"]}')
+    if stats['cache'] is not None:
+        print(f'cache: {stats["cache"]}')
+    if caption_lengths:
+        print(f'caption length mean {np.mean(caption_lengths):.1f}, min {min(caption_lengths)}, '
+              f'max {max(caption_lengths)}')
+    return
+
+
+########################################################################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--task', default='Task3', choices=list(TASKS.keys()), help='model and cnn feature shape')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=None, help='port of a running server, None: in-process server')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--rate', type=float, default=None, help='open loop requests per second (Poisson arrivals)')
+    parser.add_argument('--concurrency', type=int, default=16, help='closed loop requests in flight (without --rate)')
+    parser.add_argument('--connections', type=int, default=4, help='tcp connections the requests are spread over')
+    parser.add_argument('--max-batch-size', type=int, default=64, help='in-process server, see CaptionServer')
+    parser.add_argument('--max-wait-ms', type=float, default=5.0, help='in-process server, see CaptionServer')
+    parser.add_argument('--continuous', action='store_true', help='in-process server, continuous batching')
+    parser.add_argument('--images', type=int, default=16, help='number of different cnn features')
+    parser.add_argument('--repeat', type=float, default=0.0, help='probability that a request repeats an earlier image')
+    parser.add_argument('--cache-size', type=int, default=0, help='in-process server, see CaptionServer')
+    parser.add_argument('--end-bias', type=float, default=0.0,
+                        help='in-process server, added to the end token logit of the random model (caption lengths)')
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    asyncio.run(run(args))
@@ -0,0 +1,37 @@
+"""
+The model variants of the Task folders for the benchmark and load generator scripts, with the source files of a Task
+loaded by path (every Task has its own cocoSource_xcnnfused.py and utils, which cannot be imported side by side).
+"""
+import importlib.util
+import os
+import sys
+
+# model config and the shape of the cnn features of one image for every model variant
+TASKS = {
+    'Task1': ({'cellType': 'RNN',  'num_rnn_layers': 1}, (2048,)),
+    'Task2': ({'cellType': 'GRU',  'num_rnn_layers': 2}, (2048,)),
+    'Task3': ({'cellType': 'LSTM', 'num_rnn_layers': 2}, (2048,)),
+    'Task4': ({'cellType': 'LSTM', 'num_rnn_layers': 2}, (36, 2048)),
+}
+
+
+def loadTaskModule(task, *path):
+    """
+    Args:
+        task: Task folder, e.g. 'Task3'
+        path: Path of the source file inside the Task folder, e.g. 'utils', 'server.py'
+
+    Returns:
+        module: The loaded module, named <task>_<file name>
+    """
+    fullPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), task, *path)
+    spec = importlib.util.spec_from_file_location(f'{task}_{os.path.splitext(path[-1])[0]}', fullPath)
+    module = importlib.util.module_from_spec(spec)
+    # registered as for an import, e.g. the server finds select_context in the module of the net
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def loadModelFile(task):
+    return loadTaskModule(task, 'cocoSource_xcnnfused.py')